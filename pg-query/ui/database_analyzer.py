@@ -1,12 +1,24 @@
+import json
+import hashlib
 import psycopg2
 import psycopg2.extras
 from typing import List, Dict, Any, Tuple, Optional
 
+from query_router import ReplicaRouter, ReplicaUnavailableError
+from utils import is_read_only_query, strip_sql_literals
+
 class DatabaseAnalyzer:
     """Simplified class to analyze PostgreSQL database schema and execute queries."""
 
-    def __init__(self, dbname: str, user: str, password: str, host: str = "localhost", port: str = "5432"):
-        """Initialize with database connection parameters."""
+    def __init__(self, dbname: str, user: str, password: str, host: str = "localhost", port: str = "5432",
+                 replica_dsns: Optional[List[str]] = None, max_replica_lag: float = 30.0,
+                 replica_strategy: str = "round_robin"):
+        """
+        Initialize with database connection parameters.
+
+        If replica_dsns is given, read-only queries are routed to those replicas;
+        anything missing from a replica DSN is taken from the primary's parameters.
+        """
         self.connection_params = {
             "dbname": dbname,
             "user": user,
@@ -16,7 +28,16 @@ class DatabaseAnalyzer:
         }
         self.connection = None
         self.schema_info = {}
-        self.column_semantics = {}  # Store basic meanings of column names
+        self.column_semantics = {}  # Inferred meanings of uncommented columns, keyed by "table.column"
+        self.replica_router = None
+        self.last_query_backend = "primary"
+        if replica_dsns:
+            self.replica_router = ReplicaRouter(
+                replica_dsns,
+                base_params=self.connection_params,
+                max_lag_seconds=max_replica_lag,
+                strategy=replica_strategy
+            )
 
     def connect(self) -> Tuple[bool, str]:
         """Establish connection to the database."""
@@ -28,6 +49,8 @@ class DatabaseAnalyzer:
 
     def close(self) -> str:
         """Close the database connection."""
+        if self.replica_router:
+            self.replica_router.close()
         if self.connection:
             self.connection.close()
             return "Database connection closed."
@@ -310,9 +333,11 @@ class DatabaseAnalyzer:
 
         return description
 
-    def generate_schema_for_llm(self) -> str:
+    def generate_schema_for_llm(self, tables: Optional[List[str]] = None) -> str:
         """
         Generate a schema description for the LLM with simple format.
+
+        If tables is given, only those tables and the relationships between them are included.
         """
         if not self.schema_info:
             self.analyze_schema()
@@ -321,6 +346,9 @@ class DatabaseAnalyzer:
 
         # Describe each table and its columns
         for table_name, table_info in self.schema_info["tables"].items():
+            if tables is not None and table_name not in tables:
+                continue
+
             schema_text += f"## Table: {table_name}"
 
             # Add table comment if available
@@ -333,24 +361,113 @@ class DatabaseAnalyzer:
             schema_text += "|------------|------|-------------|\n"
 
             for column in table_info["columns"]:
-                comment = column.get("comment", "")
+                comment = column.get("comment") or self.column_semantics.get(f"{table_name}.{column['name']}", "")
                 schema_text += f"| {column['name']} | {column['type']} | {comment} |\n"
 
             schema_text += "\n"
 
+        relationships = [
+            rel for rel in self.schema_info["relationships"]
+            if tables is None or (rel["table"] in tables and rel["references_table"] in tables)
+        ]
+
         # Add relationships section
-        if self.schema_info["relationships"]:
+        if relationships:
             schema_text += "## Relationships\n\n"
 
-            for rel in self.schema_info["relationships"]:
+            for rel in relationships:
                 schema_text += f"- {rel['table']}.{rel['column']} → {rel['references_table']}.{rel['references_column']}\n"
 
             schema_text += "\n"
 
         return schema_text
 
+    def columns_without_comments(self) -> List[Dict[str, Any]]:
+        """
+        Columns that have no comment in the database, for LLM semantic inference.
+
+        Returns:
+            List of dictionaries with table_name, column_name, data_type and sample_values
+        """
+        if not self.schema_info:
+            self.analyze_schema()
+
+        columns_info = []
+        for table_name, table_info in self.schema_info["tables"].items():
+            sample_rows = self.schema_info.get("sample_data", {}).get(table_name, [])
+            for column in table_info["columns"]:
+                if column.get("comment"):
+                    continue
+                columns_info.append({
+                    "table_name": table_name,
+                    "column_name": column["name"],
+                    "data_type": column["type"],
+                    "sample_values": [row[column["name"]] for row in sample_rows
+                                      if row.get(column["name"]) is not None],
+                })
+        return columns_info
+
+    def schema_fingerprint(self) -> str:
+        """
+        Return a short hash of the tables, columns, types and relationships.
+
+        Comments and sample data are left out so that only structural changes
+        invalidate anything keyed by the fingerprint.
+        """
+        if not self.schema_info:
+            self.analyze_schema()
+
+        structure = {
+            "tables": {
+                table_name: [(column["name"], column["type"]) for column in table_info["columns"]]
+                for table_name, table_info in self.schema_info["tables"].items()
+            },
+            "relationships": self.schema_info["relationships"]
+        }
+        return hashlib.sha256(json.dumps(structure, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+    def validate_query(self, query: str) -> Tuple[bool, str]:
+        """Check a query with EXPLAIN on the primary without executing it."""
+        # EXPLAIN only covers the first statement; anything after it would really run
+        statements = [part for part in strip_sql_literals(query).split(';') if part.strip()]
+        if len(statements) != 1:
+            return False, "Only a single SQL statement can be validated"
+
+        if not self.connection:
+            self.connect()
+
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute(f"EXPLAIN {query}")
+            return True, "Query is valid"
+        except Exception as e:
+            return False, str(e)
+        finally:
+            cursor.close()
+            self.connection.rollback()
+
     def execute_query(self, query: str) -> Tuple[List[Dict[str, Any]], List[str]]:
-        """Execute an SQL query and return the results as a list of dictionaries."""
+        """
+        Execute an SQL query and return the results as a list of dictionaries.
+
+        Read-only queries go to a read replica when replicas are configured;
+        everything else, and reads no replica can serve, runs on the primary.
+        The backend that served the query is stored in last_query_backend.
+        """
+        read_only = is_read_only_query(query)
+
+        if self.replica_router and read_only:
+            try:
+                results, columns, backend = self.replica_router.execute(query)
+                self.last_query_backend = backend
+                return results, columns
+            except ReplicaUnavailableError as e:
+                print(f"Falling back to primary: {e}")
+            except Exception as e:
+                raise Exception(f"Error executing query: {e}")
+
+        self.last_query_backend = "primary"
+
         if not self.connection:
             self.connect()
 
@@ -388,8 +505,11 @@ class DatabaseAnalyzer:
                     result_dict[column] = row[i]
                 results.append(result_dict)
 
-            # Explicitly commit the transaction if successful
-            self.connection.commit()
+            # Commit writes; a read-only transaction has nothing to commit
+            if read_only:
+                self.connection.rollback()
+            else:
+                self.connection.commit()
             return results, columns
         except Exception as e:
             # Explicitly rollback the transaction on error
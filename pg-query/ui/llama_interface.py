@@ -1,45 +1,343 @@
-import json
+import time
+import random
 import httpx
 import asyncio
-from typing import List, Dict, Any
+import uuid
+import itertools
+from contextlib import aclosing
+from typing import List, Dict, Any, Callable, Tuple, Optional
+
+from utils import extract_sql_from_response
+from result_explainer import explain_trivial_result
+from result_summary import summarize_results, DEFAULT_TOKEN_BUDGET
+from llm_backends import LlamaBackendPool
+from model_routing import ModelRouter
+
+# Spreads sessions over the llama-server slots
+SLOT_COUNTER = itertools.count()
+
+
+def build_sql_prompt_prefix(schema_for_llm: str, grammar_mode: bool = False) -> str:
+    """
+    The part of the SQL generation prompt that does not depend on the question.
+
+    It is kept byte-for-byte stable so llama-server can reuse its KV cache
+    for everything up to the question.
+    """
+    if grammar_mode:
+        output_format = "Provide only ONE query as plain SQL ending with a semicolon."
+    else:
+        output_format = "Provide only ONE query using triple backticks, not multiple options."
+
+    return f"""
+You are an expert SQL query generator for PostgreSQL databases.
+Given the database schema below, generate a SQL query to answer the question.
+
+IMPORTANT GUIDELINES:
+1. Use appropriate joins based on the relationships defined in the schema.
+2. Ensure data types match when making comparisons.
+3. For date/time operations, use appropriate PostgreSQL functions.
+4. {output_format}
+
+REALLY IMPORTANT USE ILIKE STATEMENTS with % for everything that is text in the query
+
+Just the SQL Statement suffice, do not explain or send anything further
+
+{schema_for_llm}
+
+Question:
+"""
+
+
+def build_sql_prompt(schema_for_llm: str, question: str, grammar_mode: bool = False) -> str:
+    """Full SQL generation prompt: the stable prefix followed by the question."""
+    return build_sql_prompt_prefix(schema_for_llm, grammar_mode) + f"{question}\n"
+
 
 class LlamaInterface:
     """Minimal interface for LLM Runtime API."""
 
-    def __init__(self, host="llama-service", port="8080"):
-        """Initialize the LLM Runtime interface with host and port."""
+    def __init__(self, host="llama-service", port="8080", endpoints=None, backend_pool=None, model_router=None):
+        """
+        Initialize the LLM Runtime interface with host and port.
+
+        To spread requests over several llama-server replicas, pass either a list
+        of "host:port" endpoints or a LlamaBackendPool shared between sessions.
+        To run tasks on different models, pass a ModelRouter instead.
+        """
         self.host = host
         self.port = port
+        self.model_router = model_router or ModelRouter.single(
+            backend_pool or LlamaBackendPool(endpoints or [f"{host}:{port}"])
+        )
+        # Pool of the SQL generation tier, which slot pinning and prompt caching refer to
+        self.backend_pool = self.model_router.primary_tier("sql").pool
+        # Requests of one session stick to one replica to keep its KV cache warm
+        self.session_key = uuid.uuid4().hex
+        # Slot that SQL generation prompts are pinned to; None lets the server choose
+        self.id_slot = None
+        self.last_timings = {}
+        self.prompt_cache_stats = {
+            "requests": 0,
+            "prompt_tokens": 0,
+            "cached_tokens": 0,
+            "prompt_ms": 0.0,
+        }
+
+    async def get_total_slots_async(self) -> int:
+        """Number of parallel slots the llama-server was started with."""
+        backend = await self.backend_pool.acquire_async(self.session_key)
+        try:
+            async with httpx.AsyncClient(timeout=10) as client:
+                response = await client.get(f'{backend.url}/props')
+                return int(response.json().get('total_slots', 1))
+        except Exception as e:
+            print(f"Could not read llama-server slots: {e}")
+            return 1
+        finally:
+            self.backend_pool.release(backend)
+
+    def assign_slot(self) -> int:
+        """Pin this session's SQL generation to one of the server's slots."""
+        total_slots = asyncio.run(self.get_total_slots_async())
+        self.id_slot = next(SLOT_COUNTER) % total_slots
+        return self.id_slot
+
+    def record_timings(self, data: Dict[str, Any]):
+        """Accumulate prompt-eval time and KV-cache reuse from a llama-server response."""
+        timings = data.get('timings') or {}
+        prompt_tokens = timings.get('prompt_n', 0)
+        # Newer servers report the reused tokens directly; older ones only the prompt total
+        if 'cache_n' in timings:
+            cached_tokens = timings['cache_n']
+        else:
+            cached_tokens = max(data.get('tokens_evaluated', prompt_tokens) - prompt_tokens, 0)
 
-    async def get_llama_response_async(self, prompt):
-        """Get a response from the LLM Runtime API asynchronously."""
+        self.last_timings = {
+            "prompt_tokens": prompt_tokens,
+            "cached_tokens": cached_tokens,
+            "prompt_ms": timings.get('prompt_ms', 0.0),
+            "predicted_tokens": timings.get('predicted_n', 0),
+            "predicted_ms": timings.get('predicted_ms', 0.0),
+        }
+        self.prompt_cache_stats["requests"] += 1
+        self.prompt_cache_stats["prompt_tokens"] += prompt_tokens
+        self.prompt_cache_stats["cached_tokens"] += cached_tokens
+        self.prompt_cache_stats["prompt_ms"] += self.last_timings["prompt_ms"]
+
+    def get_prompt_cache_report(self) -> Dict[str, Any]:
+        """Prefix-hit rate and prompt-eval time over all requests of this session."""
+        stats = self.prompt_cache_stats
+        total = stats["prompt_tokens"] + stats["cached_tokens"]
+        return {
+            "requests": stats["requests"],
+            "prefix_hit_rate": round(stats["cached_tokens"] / total, 3) if total else 0.0,
+            "avg_prompt_ms": round(stats["prompt_ms"] / stats["requests"], 1) if stats["requests"] else 0.0,
+            "last_prompt_ms": self.last_timings.get("prompt_ms", 0.0),
+            "last_cached_tokens": self.last_timings.get("cached_tokens", 0),
+            "slot": self.id_slot,
+        }
+
+    async def warm_prompt_cache_async(self, prefix: str) -> Dict[str, Any]:
+        """Evaluate a prompt prefix on this session's slot so the next request can reuse it."""
+        json_data = {
+            'prompt': prefix,
+            'n_predict': 1,
+            'cache_prompt': True,
+        }
+        if self.id_slot is not None:
+            json_data['id_slot'] = self.id_slot
+
+        data = await self.model_router.post("sql", json_data, self.session_key, request_class="background")
+        self.record_timings(data)
+        return self.last_timings
+
+    def warm_prompt_cache(self, prefix: str) -> Dict[str, Any]:
+        """Synchronous wrapper for warm_prompt_cache_async."""
+        return asyncio.run(self.warm_prompt_cache_async(prefix))
+
+    async def get_llama_response_async(self, prompt, n_predict=None, grammar=None, stop_at_sql_block=False,
+                                       temperature=None, seed=None, id_slot=None, request_class="sql",
+                                       group=None):
+        """
+        Get a response from the LLM Runtime API asynchronously.
+
+        If a GBNF grammar is given, llama-server only samples tokens the grammar allows.
+        If stop_at_sql_block is set, the stream is closed as soon as the first complete
+        fenced SQL block has arrived, which makes llama-server stop generating.
+        Prompts are always sent with cache_prompt so a shared prefix is not re-evaluated;
+        id_slot pins the request to one server slot. request_class is the task
+        (see llm_backends.REQUEST_CLASSES): it selects the model tier, the default
+        sampling parameters and the scheduling class. Requests sharing a group
+        count as one towards the session's concurrency limit. An AdmissionError
+        is raised if the request is not admitted.
+        """
         json_data = {
             'prompt': prompt,
-            'temperature': 0.1,
-            'repetition_penalty': 1.18,
-            'n_predict': 500,
             'stream': True,
+            'cache_prompt': True,
+            # Timings on every chunk, so they are known even if the stream is closed early
+            'timings_per_token': True,
         }
+        if n_predict is not None:
+            json_data['n_predict'] = n_predict
+        if temperature is not None:
+            json_data['temperature'] = temperature
+        if grammar:
+            json_data['grammar'] = grammar
+        if seed is not None:
+            json_data['seed'] = seed
+        if id_slot is not None:
+            json_data['id_slot'] = id_slot
+
+        full_response = ""
+        last_data = {}
+        async with aclosing(self.model_router.stream(request_class, json_data, self.session_key,
+                                                             group=group)) as events:
+            async for data in events:
+                if 'timings' in data:
+                    last_data = data
+                if data.get('stop') is False:
+                    full_response += data.get('content', '')
+                    if stop_at_sql_block and full_response.count('```') >= 2 and extract_sql_from_response(full_response):
+                        # Leaving the stream closes the connection and aborts the generation
+                        break
 
-        async with httpx.AsyncClient(timeout=120) as client:
-            async with client.stream('POST', f'http://{self.host}:{self.port}/completion', json=json_data) as response:
-                full_response = ""
-                async for chunk in response.aiter_bytes():
-                    try:
-                        data = json.loads(chunk.decode('utf-8')[6:])
-                        if data['stop'] is False:
-                            full_response += data['content']
-                    except:
-                        pass
+        if last_data:
+            self.record_timings(last_data)
 
         return full_response
 
-    def get_llama_response(self, prompt):
+    def get_llama_response(self, prompt, n_predict=None, grammar=None, stop_at_sql_block=False, id_slot=None,
+                           request_class="sql"):
         """Synchronous wrapper for get_llama_response_async."""
-        return asyncio.run(self.get_llama_response_async(prompt))
+        return asyncio.run(self.get_llama_response_async(prompt, n_predict, grammar, stop_at_sql_block,
+                                                         id_slot=id_slot, request_class=request_class))
+
+    async def generate_sql_candidates_async(self,
+                                            prompt: str,
+                                            num_candidates: int,
+                                            validate: Callable[[str], Tuple[bool, str]],
+                                            grammar: str = None) -> Dict[str, Any]:
+        """
+        Generate several SQL candidates concurrently and return the first valid one.
+
+        Each candidate uses its own seed and a different temperature so they occupy
+        separate llama-server slots and do not come out identical. Candidates are
+        validated as they complete; once one passes, the remaining generations are
+        cancelled, which closes their streams.
+
+        Args:
+            prompt: SQL generation prompt
+            num_candidates: Number of concurrent generations
+            validate: Called with each candidate's SQL (in a worker thread), returns (valid, message)
+            grammar: Optional GBNF grammar; the output is then the SQL itself
+
+        Returns:
+            Dictionary with the chosen "sql_query" and its "raw_response" (the first
+            candidate with any SQL if none is valid), "valid", and per-candidate "attempts"
+        """
+        start = time.time()
+        temperatures = [round(0.1 + 0.6 * i / max(num_candidates - 1, 1), 2) for i in range(num_candidates)]
+        # The candidates count as one request of the session, so the per-user limit does not serialize them
+        group = uuid.uuid4().hex
+
+        async def generate(temperature):
+            seed = random.randint(0, 2**31 - 1)
+            response = await self.get_llama_response_async(prompt, grammar=grammar,
+                                                            stop_at_sql_block=not grammar,
+                                                            temperature=temperature, seed=seed, group=group)
+            return temperature, seed, response
+
+        tasks = [asyncio.create_task(generate(temperature)) for temperature in temperatures]
+        result = {"sql_query": "", "raw_response": "", "valid": False, "attempts": []}
+
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                try:
+                    temperature, seed, response = await next_done
+                except Exception as e:
+                    result["attempts"].append({"temperature": None, "seed": None, "sql_query": "",
+                                               "valid": False, "message": f"Generation failed: {e}",
+                                               "seconds": round(time.time() - start, 2)})
+                    continue
+
+                sql_query = response.strip() if grammar else extract_sql_from_response(response)
+                if sql_query:
+                    valid, message = await asyncio.to_thread(validate, sql_query)
+                else:
+                    valid, message = False, "No SQL found in the response"
+
+                result["attempts"].append({"temperature": temperature, "seed": seed, "sql_query": sql_query,
+                                           "valid": valid, "message": message,
+                                           "seconds": round(time.time() - start, 2)})
+
+                if valid:
+                    result.update(sql_query=sql_query, raw_response=response, valid=True)
+                    break
+                if sql_query and not result["sql_query"]:
+                    result.update(sql_query=sql_query, raw_response=response)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        return result
+
+    def generate_sql_candidates(self,
+                                prompt: str,
+                                num_candidates: int,
+                                validate: Callable[[str], Tuple[bool, str]],
+                                grammar: str = None) -> Dict[str, Any]:
+        """Synchronous wrapper for generate_sql_candidates_async."""
+        return asyncio.run(self.generate_sql_candidates_async(prompt, num_candidates, validate, grammar))
+
+    async def repair_sql_async(self, question: str, sql_query: str, errors: List[str], schema_excerpt: str,
+                               grammar: str = None) -> str:
+        """
+        Ask for a corrected query given the precise errors found by local validation.
+
+        Only the tables the query touches are sent, so this is much cheaper than
+        the full-schema generation prompt.
+        """
+        errors_str = "\n".join(f"- {error}" for error in errors)
+        prompt = f"""
+You are an expert SQL query generator for PostgreSQL databases.
+The query below was written to answer the question but has these errors:
+{errors_str}
+
+{schema_excerpt}
+
+Question: {question}
+
+SQL Query:
+```sql
+{sql_query}
+```
+
+Return only the corrected query {"ending with a semicolon" if grammar else "between triple backticks"}, without any explanation.
+"""
+        return await self.get_llama_response_async(prompt, n_predict=300, grammar=grammar,
+                                                   stop_at_sql_block=not grammar)
+
+    def repair_sql(self, question: str, sql_query: str, errors: List[str], schema_excerpt: str,
+                   grammar: str = None) -> str:
+        """Synchronous wrapper for repair_sql_async."""
+        return asyncio.run(self.repair_sql_async(question, sql_query, errors, schema_excerpt, grammar))
+
+    async def explain_results_async(self, question: str, sql_query: str, results: List[Dict[str, Any]], error: str = None,
+                                    token_budget: int = DEFAULT_TOKEN_BUDGET) -> str:
+        """
+        Explain the results in natural language; simple result shapes are answered without the LLM.
+
+        Larger results are sent as a compact summary of at most token_budget tokens.
+        """
+        columns = list(results[0].keys()) if results else []
+        if not error:
+            explanation = explain_trivial_result(question, results, columns)
+            if explanation is not None:
+                return explanation
 
-    async def explain_results_async(self, question: str, sql_query: str, results: List[Dict[str, Any]], error: str = None) -> str:
-        """Explain the results in natural language."""
         if error:
             prompt = f"""
 Question: {question}
@@ -52,22 +350,24 @@ Please explain what went wrong with this query in simple terms and suggest how t
 Be specific about any syntax errors or invalid references.
 """
         else:
-            # Convert results to a string - limit to 10 results to manage context length
-            results_str = json.dumps(results[:10], indent=2, default=str)
+            # Compact rows plus statistics over all rows, within the token budget
+            results_str = summarize_results(results, columns, token_budget)
 
             prompt = f"""
 Question: {question}
 
 SQL Query: {sql_query}
 
-Results: {results_str}
+Results:
+{results_str}
 
 Provide a natural language explanation of these results that directly answers the original question.
 Keep your explanation clear, concise, and focused on what the user actually asked.
 If the results contain a lot of data, summarize the key points.
 """
 
-        explanation = await self.get_llama_response_async(prompt)
+        explanation = await self.get_llama_response_async(
+            prompt, request_class="error_analysis" if error else "explanation")
         return explanation.strip()
 
     def explain_results(self, question: str, sql_query: str, results: List[Dict[str, Any]], error: str = None) -> str:
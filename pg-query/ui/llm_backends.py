@@ -0,0 +1,776 @@
+import json
+import time
+import httpx
+import asyncio
+import itertools
+import threading
+from collections import deque
+from contextlib import aclosing
+from typing import List, Dict, Any, Optional, AsyncIterator, Callable
+
+# Request fields that only affect where or how fast a request runs, not the tokens it produces
+ROUTING_FIELDS = ('id_slot', 'cache_prompt', 'timings_per_token')
+
+# llama-server answers 503 when all of its slots are taken: busy, not broken
+BUSY_STATUS = 503
+# Pause before a request all of whose backends were busy waits for admission again
+BUSY_RETRY_DELAY = 0.5
+
+# Scheduling classes of LLM traffic: lower priority values are served first,
+# max_wait is the longest a request may queue before it is rejected, and
+# preemptible requests are cancelled when higher priority work is waiting
+REQUEST_CLASSES = {
+    "sql": {"priority": 0, "max_wait": 30.0, "preemptible": False},
+    "explanation": {"priority": 1, "max_wait": 45.0, "preemptible": False},
+    "error_analysis": {"priority": 1, "max_wait": 45.0, "preemptible": False},
+    "background": {"priority": 2, "max_wait": 300.0, "preemptible": True},
+}
+
+
+class AdmissionError(Exception):
+    """An LLM request was not admitted to llama-server."""
+
+
+class QueueFullError(AdmissionError):
+    """The request queue is full of work with the same or higher priority."""
+
+
+class QueueTimeoutError(AdmissionError):
+    """The request waited longer than its class allows."""
+
+
+class PreemptedError(AdmissionError):
+    """A background request was cancelled to make room for higher priority work."""
+
+
+class LlamaBackend:
+    """Health and load state of a single llama-server replica."""
+
+    def __init__(self, endpoint: str):
+        endpoint = endpoint.strip().rstrip('/')
+        self.url = endpoint if endpoint.startswith(('http://', 'https://')) else f'http://{endpoint}'
+        self.healthy = True
+        self.total_slots = None
+        self.idle_slots = None
+        self.in_flight = 0
+        self.in_flight_at_poll = 0
+        self.failures = 0
+        self.ejected_until = 0.0
+        self.last_polled = 0.0
+        self.last_error = ""
+        self.requests = 0
+
+    def available(self, now: float) -> bool:
+        """Whether the backend is healthy and not ejected."""
+        return self.healthy and now >= self.ejected_until
+
+    def free_slots(self) -> float:
+        """Idle slots as last polled, minus requests this client started since."""
+        if self.idle_slots is None:
+            return -self.in_flight
+        return self.idle_slots - max(self.in_flight - self.in_flight_at_poll, 0)
+
+
+class LlamaBackendPool:
+    """
+    Client-side load balancer over several llama-server replicas.
+
+    Backends are polled on /health and /slots. Each request goes to the
+    backend with the most free slots; a session sticks to its previous backend
+    while that backend still has a free slot, so its KV-cache prefix stays warm.
+    Backends that fail are ejected with exponential backoff.
+    """
+
+    def __init__(self,
+                 endpoints: List[str],
+                 poll_interval: float = 5.0,
+                 base_backoff: float = 2.0,
+                 max_backoff: float = 60.0,
+                 coalesce: bool = True,
+                 max_queue: int = 32,
+                 max_per_user: int = 2):
+        """
+        Initialize the pool.
+
+        Args:
+            endpoints: "host:port" or full URLs of the llama-server replicas
+            poll_interval: Seconds between health/slot polls of a backend
+            base_backoff: Ejection time after the first failure; doubles with every further failure
+            max_backoff: Upper bound for the ejection time
+            coalesce: Share one upstream stream between concurrent identical streaming requests
+            max_queue: Maximum number of requests waiting for a slot
+            max_per_user: Maximum number of requests a session may run at once
+        """
+        if not endpoints:
+            raise ValueError("At least one llama-server endpoint is required")
+
+        self.backends = [LlamaBackend(endpoint) for endpoint in endpoints]
+        self.poll_interval = poll_interval
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.affinity = {}
+        self.coalescer = RequestCoalescer() if coalesce else None
+        self.scheduler = LlamaScheduler(self.capacity, max_queue=max_queue, max_per_user=max_per_user)
+        # The pool is shared by sessions that each run their own event loop
+        self._lock = threading.Lock()
+
+    async def poll_backend_async(self, client: httpx.AsyncClient, backend: LlamaBackend):
+        """Poll one backend's /health and /slots endpoints."""
+        try:
+            health = await client.get(f'{backend.url}/health')
+            if health.status_code != 200:
+                # 503 while the model is still loading
+                backend.healthy = False
+                backend.last_error = f"/health returned {health.status_code}"
+                return
+            backend.healthy = True
+            backend.last_error = ""
+
+            slots = await client.get(f'{backend.url}/slots')
+            if slots.status_code == 200:
+                slots_info = slots.json()
+                backend.total_slots = len(slots_info)
+                backend.idle_slots = sum(
+                    1 for slot in slots_info
+                    if not slot.get('is_processing', slot.get('state', 0) != 0)
+                )
+                backend.in_flight_at_poll = backend.in_flight
+            else:
+                # /slots disabled on this server: balance on in-flight requests only
+                backend.idle_slots = None
+                if backend.total_slots is None:
+                    props = await client.get(f'{backend.url}/props')
+                    backend.total_slots = int(props.json().get('total_slots', 1))
+        except Exception as e:
+            self.report_failure(backend, e)
+
+    async def refresh_async(self, force: bool = False):
+        """Poll every backend whose last poll is older than the poll interval."""
+        now = time.time()
+        with self._lock:
+            due = [b for b in self.backends if force or now - b.last_polled >= self.poll_interval]
+            # Claim the poll so concurrent requests do not poll the same backend again
+            for backend in due:
+                backend.last_polled = now
+        if not due:
+            return
+        async with httpx.AsyncClient(timeout=2) as client:
+            await asyncio.gather(*(self.poll_backend_async(client, backend) for backend in due))
+        # Capacity may have changed
+        self.scheduler.dispatch()
+
+    def capacity(self) -> int:
+        """Number of requests the available backends can process at once."""
+        now = time.time()
+        return sum(backend.total_slots or 1 for backend in self.backends if backend.available(now))
+
+    async def acquire_async(self, session_key: Optional[str] = None,
+                            exclude: Optional[List[LlamaBackend]] = None) -> LlamaBackend:
+        """
+        Pick a backend for a request and count it as in flight.
+
+        Call release() when the request is done.
+        """
+        await self.refresh_async()
+        exclude = exclude or []
+        now = time.time()
+
+        with self._lock:
+            candidates = [b for b in self.backends if b.available(now) and b not in exclude]
+            if not candidates:
+                # Everything is ejected: try the backend that comes back first
+                remaining = [b for b in self.backends if b not in exclude] or self.backends
+                candidates = sorted(remaining, key=lambda b: b.ejected_until)[:1]
+
+            backend = None
+            sticky = self.affinity.get(session_key) if session_key is not None else None
+            if sticky in candidates and (sticky.idle_slots is None or sticky.free_slots() > 0):
+                backend = sticky
+            if backend is None:
+                backend = max(candidates, key=lambda b: (b.free_slots(), -b.in_flight, -b.requests))
+
+            backend.in_flight += 1
+            backend.requests += 1
+            if session_key is not None:
+                self.affinity[session_key] = backend
+        return backend
+
+    def release(self, backend: LlamaBackend):
+        """Mark a request on a backend as finished."""
+        with self._lock:
+            backend.in_flight = max(backend.in_flight - 1, 0)
+            backend.in_flight_at_poll = min(backend.in_flight_at_poll, backend.in_flight)
+
+    def report_success(self, backend: LlamaBackend):
+        """Reset the failure count of a backend after a successful request."""
+        with self._lock:
+            backend.failures = 0
+            backend.ejected_until = 0.0
+
+    def report_busy(self, backend: LlamaBackend):
+        """Note that a backend had no free slot, without ejecting it."""
+        with self._lock:
+            backend.idle_slots = 0
+            backend.last_error = "no slot available"
+
+    def report_failure(self, backend: LlamaBackend, error: Exception):
+        """Eject a backend for an exponentially growing backoff period."""
+        with self._lock:
+            backend.failures += 1
+            backoff = min(self.base_backoff * 2 ** (backend.failures - 1), self.max_backoff)
+            backend.ejected_until = time.time() + backoff
+            backend.last_error = str(error)
+        print(f"llama-server {backend.url} failed ({error}); ejected for {backoff:.0f}s")
+
+    def status(self) -> List[Dict[str, Any]]:
+        """Current state of every backend for display."""
+        now = time.time()
+        return [{
+            "backend": backend.url,
+            "available": backend.available(now),
+            "idle_slots": backend.idle_slots,
+            "total_slots": backend.total_slots,
+            "in_flight": backend.in_flight,
+            "requests": backend.requests,
+            "failures": backend.failures,
+            "ejected_for": round(max(backend.ejected_until - now, 0), 1),
+            "last_error": backend.last_error,
+        } for backend in self.backends]
+
+
+class _Ticket:
+    """A request waiting for, or holding, a llama-server slot."""
+
+    def __init__(self, request_class: str, settings: Dict[str, Any], user_key: Optional[str], seq: int,
+                 group: Optional[str] = None):
+        self.request_class = request_class
+        self.priority = settings["priority"]
+        self.max_wait = settings["max_wait"]
+        self.preemptible = settings["preemptible"]
+        self.user_key = user_key
+        self.group = group
+        self.seq = seq
+        self.enqueued_at = time.time()
+        self.loop = asyncio.get_running_loop()
+        self.ready = asyncio.Event()
+        self.task = None
+        self.admitted = False
+        self.preempted = False
+        self.rejection = None
+
+
+class LlamaScheduler:
+    """
+    Client-side admission control for llama-server.
+
+    At most one request per server slot runs at a time. Waiting requests are
+    admitted by priority class and then arrival order, each user may run at
+    most max_per_user requests at once (the requests of one fan-out group,
+    such as parallel SQL candidates, count as one), and a request that cannot be admitted
+    within its class's max_wait is rejected. When the queue is full a new
+    request is rejected right away unless it outranks a queued one, which is
+    then rejected instead. Preemptible (background) requests are cancelled
+    when higher priority work is waiting for their slot.
+    """
+
+    def __init__(self,
+                 capacity: Callable[[], int],
+                 max_queue: int = 32,
+                 max_per_user: int = 2,
+                 request_classes: Optional[Dict[str, Dict[str, Any]]] = None):
+        """
+        Initialize the scheduler.
+
+        Args:
+            capacity: Returns the number of requests that may run at once
+            max_queue: Maximum number of waiting requests
+            max_per_user: Maximum number of running requests per user
+            request_classes: Scheduling classes, defaults to REQUEST_CLASSES
+        """
+        self.capacity = capacity
+        self.max_queue = max_queue
+        self.max_per_user = max_per_user
+        self.request_classes = request_classes or REQUEST_CLASSES
+
+        self.queue = []
+        self.running = []
+        self.seq = itertools.count()
+        self.wait_times = {name: deque(maxlen=200) for name in self.request_classes}
+        self.counters = {name: {"admitted": 0, "rejected": 0, "timed_out": 0, "preempted": 0}
+                         for name in self.request_classes}
+        # Sessions run their own event loops, so state is guarded by a thread lock
+        self._lock = threading.Lock()
+
+    def _user_running(self, user_key: Optional[str]) -> int:
+        """Number of running requests of a user; the requests of one group count once."""
+        if user_key is None:
+            return 0
+        return len({ticket.group or ticket.seq for ticket in self.running if ticket.user_key == user_key})
+
+    def _over_user_limit(self, ticket: _Ticket) -> bool:
+        """Whether admitting a request would exceed its user's limit. Lock held."""
+        if not self.max_per_user or ticket.user_key is None:
+            return False
+        if ticket.group is not None and any(t.group == ticket.group and t.user_key == ticket.user_key
+                                            for t in self.running):
+            # Its group already holds one of the user's places
+            return False
+        return self._user_running(ticket.user_key) >= self.max_per_user
+
+    def _wake(self, ticket: _Ticket):
+        """Wake a waiting request from any thread."""
+        try:
+            ticket.loop.call_soon_threadsafe(ticket.ready.set)
+        except RuntimeError:
+            # The request's loop has already been closed
+            pass
+
+    def _dispatch(self):
+        """Admit waiting requests while there is capacity; preempt background work if needed. Lock held."""
+        capacity = max(self.capacity(), 1)
+        self.queue.sort(key=lambda t: (t.priority, t.seq))
+
+        for ticket in list(self.queue):
+            if len(self.running) >= capacity:
+                break
+            if self._over_user_limit(ticket):
+                continue
+            self.queue.remove(ticket)
+            ticket.admitted = True
+            self.running.append(ticket)
+            self.wait_times[ticket.request_class].append(time.time() - ticket.enqueued_at)
+            self.counters[ticket.request_class]["admitted"] += 1
+            self._wake(ticket)
+
+        if len(self.running) < capacity:
+            return
+
+        # Free slots for waiting work that outranks running background requests
+        urgent = [t for t in self.queue if not t.preemptible]
+        already_preempted = sum(1 for t in self.running if t.preempted)
+        victims = sorted(
+            (t for t in self.running if t.preemptible and not t.preempted and t.task is not None),
+            key=lambda t: t.seq, reverse=True
+        )
+        for ticket in urgent[already_preempted:]:
+            candidates = [v for v in victims if v.priority > ticket.priority]
+            if not candidates:
+                break
+            victim = candidates[0]
+            victims.remove(victim)
+            victim.preempted = True
+            self.counters[victim.request_class]["preempted"] += 1
+            try:
+                victim.loop.call_soon_threadsafe(victim.task.cancel)
+            except RuntimeError:
+                pass
+
+    async def admit(self, request_class: str = "sql", user_key: Optional[str] = None,
+                    group: Optional[str] = None) -> _Ticket:
+        """
+        Wait until a request may be sent to llama-server.
+
+        Requests of a user that share a group (e.g. the candidates of one
+        question) count as a single request towards max_per_user.
+
+        Raises:
+            QueueFullError: If the queue is full of work that is at least as important
+            QueueTimeoutError: If the request waited longer than its class allows
+        """
+        if request_class not in self.request_classes:
+            raise ValueError(f"Unknown request class '{request_class}'")
+
+        with self._lock:
+            ticket = _Ticket(request_class, self.request_classes[request_class], user_key, next(self.seq), group)
+            ticket.task = asyncio.current_task()
+
+            if len(self.queue) >= self.max_queue:
+                lowest = max(self.queue, key=lambda t: (t.priority, t.seq))
+                if lowest.priority <= ticket.priority:
+                    self.counters[request_class]["rejected"] += 1
+                    raise QueueFullError(f"LLM request queue is full ({len(self.queue)} waiting)")
+                # Make room by rejecting the least important queued request
+                self.queue.remove(lowest)
+                lowest.rejection = QueueFullError("Rejected from the LLM request queue by higher priority work")
+                self.counters[lowest.request_class]["rejected"] += 1
+                self._wake(lowest)
+
+            self.queue.append(ticket)
+            self._dispatch()
+
+        try:
+            await asyncio.wait_for(ticket.ready.wait(), timeout=ticket.max_wait)
+        except asyncio.TimeoutError:
+            with self._lock:
+                if not ticket.admitted:
+                    if ticket in self.queue:
+                        self.queue.remove(ticket)
+                    self.counters[request_class]["timed_out"] += 1
+                    raise QueueTimeoutError(
+                        f"LLM request ({request_class}) waited more than {ticket.max_wait:.0f}s for a free slot"
+                    )
+        except BaseException:
+            # Cancelled while waiting
+            with self._lock:
+                if ticket in self.queue:
+                    self.queue.remove(ticket)
+            if ticket.admitted:
+                self.release(ticket)
+            raise
+
+        if ticket.rejection is not None:
+            raise ticket.rejection
+        return ticket
+
+    def release(self, ticket: _Ticket):
+        """Free the slot of a finished request and admit the next ones."""
+        with self._lock:
+            if ticket in self.running:
+                self.running.remove(ticket)
+            self._dispatch()
+
+    def saturated(self) -> bool:
+        """Whether a new request would have to wait for a slot."""
+        with self._lock:
+            return bool(self.queue) or len(self.running) >= max(self.capacity(), 1)
+
+    def dispatch(self):
+        """Admit waiting requests after the capacity has changed."""
+        with self._lock:
+            self._dispatch()
+
+    def status(self) -> List[Dict[str, Any]]:
+        """Queue depth, running requests and wait times per class for display."""
+        with self._lock:
+            rows = []
+            for name, settings in self.request_classes.items():
+                waits = sorted(self.wait_times[name])
+                rows.append({
+                    "class": name,
+                    "priority": settings["priority"],
+                    "queued": sum(1 for t in self.queue if t.request_class == name),
+                    "running": sum(1 for t in self.running if t.request_class == name),
+                    "avg_wait_s": round(sum(waits) / len(waits), 3) if waits else None,
+                    "p95_wait_s": round(waits[int(0.95 * (len(waits) - 1))], 3) if waits else None,
+                    **self.counters[name],
+                })
+            return rows
+
+
+class _Flight:
+    """One upstream stream and the events it has produced so far."""
+
+    def __init__(self):
+        self.events = []
+        self.done = False
+        self.error = None
+        self.subscribers = 0
+        self.future = None
+        # (event loop, asyncio.Event) of every waiting subscriber
+        self.waiters = set()
+
+
+class RequestCoalescer:
+    """
+    Share one upstream stream between concurrent identical /completion requests.
+
+    Requests with the same prompt and sampling parameters that arrive while a
+    matching stream is running subscribe to it: they get the events produced
+    so far and then every further event as it arrives. Upstream streams run on
+    a private event loop thread, because every Streamlit session runs its own
+    loop; a stream is aborted once its last subscriber leaves.
+    """
+
+    def __init__(self):
+        self.flights = {}
+        self.requests = 0
+        self.upstream_requests = 0
+        self.coalesced_requests = 0
+        self._lock = threading.Lock()
+        self._loop = None
+
+    @staticmethod
+    def request_key(json_data: Dict[str, Any]) -> str:
+        """Key identifying the tokens a request can produce."""
+        return json.dumps({k: v for k, v in json_data.items() if k not in ROUTING_FIELDS}, sort_keys=True)
+
+    def _get_loop(self) -> asyncio.AbstractEventLoop:
+        """Start the event loop thread the upstream streams run on."""
+        if self._loop is None:
+            self._loop = asyncio.new_event_loop()
+            threading.Thread(target=self._loop.run_forever, name="llm-coalescer", daemon=True).start()
+        return self._loop
+
+    def _publish(self, flight: _Flight, event: Optional[Dict[str, Any]] = None,
+                 done: bool = False, error: Optional[BaseException] = None):
+        """Append an event (or the end of the stream) and wake every subscriber."""
+        with self._lock:
+            if event is not None:
+                flight.events.append(event)
+            if done:
+                flight.done = True
+                flight.error = error
+            waiters = list(flight.waiters)
+        for loop, ready in waiters:
+            try:
+                loop.call_soon_threadsafe(ready.set)
+            except RuntimeError:
+                # The subscriber's loop has already been closed
+                pass
+
+    async def _run_upstream(self, key: str, flight: _Flight, pool: 'LlamaBackendPool',
+                            json_data: Dict[str, Any], session_key: Optional[str], timeout: float,
+                            request_class: str, group: Optional[str]):
+        """Run the upstream stream and publish its events."""
+        error = None
+        try:
+            async with aclosing(_stream_upstream(pool, json_data, session_key, timeout, request_class,
+                                                group)) as events:
+                async for data in events:
+                    self._publish(flight, data)
+        except asyncio.CancelledError:
+            error = asyncio.CancelledError()
+        except Exception as e:
+            error = e
+        finally:
+            with self._lock:
+                if self.flights.get(key) is flight:
+                    del self.flights[key]
+            self._publish(flight, done=True, error=error)
+
+    async def stream(self, pool: 'LlamaBackendPool', json_data: Dict[str, Any],
+                     session_key: Optional[str] = None, timeout: float = 120,
+                     request_class: str = "sql", group: Optional[str] = None) -> AsyncIterator[Dict[str, Any]]:
+        """Yield the events of a request, sharing the upstream stream with identical requests."""
+        # Requests of different classes are scheduled differently, so they do not share a stream
+        key = f"{request_class}:{self.request_key(json_data)}"
+        loop = asyncio.get_running_loop()
+        ready = asyncio.Event()
+
+        with self._lock:
+            self.requests += 1
+            flight = self.flights.get(key)
+            if flight is None:
+                flight = _Flight()
+                self.flights[key] = flight
+                self.upstream_requests += 1
+                start = True
+            else:
+                self.coalesced_requests += 1
+                start = False
+            flight.subscribers += 1
+            flight.waiters.add((loop, ready))
+
+        if start:
+            flight.future = asyncio.run_coroutine_threadsafe(
+                self._run_upstream(key, flight, pool, json_data, session_key, timeout, request_class, group),
+                self._get_loop()
+            )
+
+        position = 0
+        try:
+            while True:
+                with self._lock:
+                    pending = flight.events[position:]
+                    finished = flight.done
+                    error = flight.error
+                    if not pending and not finished:
+                        ready.clear()
+                for event in pending:
+                    yield event
+                position += len(pending)
+                if pending:
+                    continue
+                if finished:
+                    if error is not None:
+                        raise error
+                    return
+                await ready.wait()
+        finally:
+            with self._lock:
+                flight.waiters.discard((loop, ready))
+                flight.subscribers -= 1
+                abandoned = flight.subscribers == 0 and not flight.done
+                if abandoned and self.flights.get(key) is flight:
+                    # Nobody is listening any more; later identical requests start a new stream
+                    del self.flights[key]
+            if abandoned and flight.future is not None:
+                # Closing the upstream stream makes llama-server stop generating
+                flight.future.cancel()
+
+    def status(self) -> Dict[str, int]:
+        """Coalescing counters for display."""
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "upstream_requests": self.upstream_requests,
+                "coalesced_requests": self.coalesced_requests,
+                "in_flight_streams": len(self.flights),
+                "subscribers": sum(flight.subscribers for flight in self.flights.values()),
+            }
+
+
+async def stream_completion(pool: LlamaBackendPool,
+                            json_data: Dict[str, Any],
+                            session_key: Optional[str] = None,
+                            timeout: float = 120,
+                            request_class: str = "sql",
+                            group: Optional[str] = None) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Stream a /completion request through the pool and yield each server-sent event.
+
+    The request waits for admission by the pool's scheduler under its request
+    class (see REQUEST_CLASSES) and may raise an AdmissionError; requests of a
+    session sharing a group count once towards the per-user limit. Identical
+    concurrent requests share one upstream stream when the pool coalesces.
+    Consume it with contextlib.aclosing() so that leaving the loop early
+    closes the stream right away.
+    """
+    if pool.coalescer is None:
+        source = _stream_upstream(pool, json_data, session_key, timeout, request_class, group)
+    else:
+        source = pool.coalescer.stream(pool, json_data, session_key, timeout, request_class, group)
+    async with aclosing(source) as events:
+        async for data in events:
+            yield data
+
+
+def _status_code(error: Exception) -> Optional[int]:
+    """HTTP status of a failed request, None for transport errors."""
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code
+    return None
+
+
+def _report_attempt_error(pool: LlamaBackendPool, backend: LlamaBackend, error: Exception) -> bool:
+    """
+    Account for a failed attempt on a backend; True if the backend was only busy.
+
+    Client errors (4xx) are raised right away: the request itself is at fault,
+    e.g. a grammar llama-server rejects, so every backend would reject it and
+    none is ejected. Transport errors and other 5xx responses eject the backend.
+    """
+    status = _status_code(error)
+    if status is not None and status < 500:
+        raise error
+    if status == BUSY_STATUS:
+        pool.report_busy(backend)
+        return True
+    pool.report_failure(backend, error)
+    return False
+
+
+async def _readmit(pool: LlamaBackendPool, ticket: _Ticket, deadline: float, session_key: Optional[str],
+                   group: Optional[str]) -> _Ticket:
+    """Give up the slot of a request no backend had room for and wait to be admitted again."""
+    pool.scheduler.release(ticket)
+    if time.time() + BUSY_RETRY_DELAY > deadline:
+        raise QueueTimeoutError(
+            f"LLM request ({ticket.request_class}) found every llama-server busy for {ticket.max_wait:.0f}s"
+        )
+    await asyncio.sleep(BUSY_RETRY_DELAY)
+    return await pool.scheduler.admit(ticket.request_class, session_key, group)
+
+
+async def _stream_upstream(pool: LlamaBackendPool,
+                           json_data: Dict[str, Any],
+                           session_key: Optional[str] = None,
+                           timeout: float = 120,
+                           request_class: str = "sql",
+                           group: Optional[str] = None) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Stream a /completion request from one backend of the pool once it is admitted.
+
+    A backend that fails before the first event is ejected and the request is
+    retried on the next one. A request llama-server rejects (4xx) is not
+    retried, and when every backend is busy (503) the request waits for
+    admission again, at most its class's max_wait.
+    """
+    await pool.refresh_async()
+    ticket = await pool.scheduler.admit(request_class, session_key, group)
+    deadline = time.time() + ticket.max_wait
+    try:
+        attempted = []
+        while True:
+            backend = await pool.acquire_async(session_key, exclude=attempted)
+            started = False
+            all_busy = False
+            try:
+                async with httpx.AsyncClient(timeout=timeout) as client:
+                    async with client.stream('POST', f'{backend.url}/completion', json=json_data) as response:
+                        response.raise_for_status()
+                        async for line in response.aiter_lines():
+                            if not line.startswith('data: '):
+                                continue
+                            try:
+                                data = json.loads(line[6:])
+                            except json.JSONDecodeError:
+                                continue
+                            started = True
+                            yield data
+                pool.report_success(backend)
+                return
+            except (httpx.TransportError, httpx.HTTPStatusError) as e:
+                busy = _report_attempt_error(pool, backend, e)
+                attempted.append(backend)
+                if started:
+                    raise
+                if len(attempted) >= len(pool.backends):
+                    if not busy:
+                        raise
+                    all_busy = True
+            finally:
+                pool.release(backend)
+            if all_busy:
+                ticket = await _readmit(pool, ticket, deadline, session_key, group)
+                attempted = []
+    except asyncio.CancelledError:
+        if ticket.preempted:
+            raise PreemptedError(f"LLM request ({request_class}) was preempted by higher priority work") from None
+        raise
+    finally:
+        pool.scheduler.release(ticket)
+
+
+async def post_completion(pool: LlamaBackendPool,
+                          json_data: Dict[str, Any],
+                          session_key: Optional[str] = None,
+                          timeout: float = 300,
+                          request_class: str = "sql") -> Dict[str, Any]:
+    """
+    Send a non-streaming /completion request through the pool once admitted and return the JSON response.
+
+    Failures are handled as in _stream_upstream().
+    """
+    await pool.refresh_async()
+    ticket = await pool.scheduler.admit(request_class, session_key)
+    deadline = time.time() + ticket.max_wait
+    try:
+        attempted = []
+        while True:
+            backend = await pool.acquire_async(session_key, exclude=attempted)
+            all_busy = False
+            try:
+                async with httpx.AsyncClient(timeout=timeout) as client:
+                    response = await client.post(f'{backend.url}/completion', json=json_data)
+                    response.raise_for_status()
+                pool.report_success(backend)
+                return response.json()
+            except (httpx.TransportError, httpx.HTTPStatusError) as e:
+                busy = _report_attempt_error(pool, backend, e)
+                attempted.append(backend)
+                if len(attempted) >= len(pool.backends):
+                    if not busy:
+                        raise
+                    all_busy = True
+            finally:
+                pool.release(backend)
+            if all_busy:
+                ticket = await _readmit(pool, ticket, deadline, session_key, None)
+                attempted = []
+    except asyncio.CancelledError:
+        if ticket.preempted:
+            raise PreemptedError(f"LLM request ({request_class}) was preempted by higher priority work") from None
+        raise
+    finally:
+        pool.scheduler.release(ticket)
@@ -1,37 +1,72 @@
-import json
+import os
+import re
+import time
 import httpx
 import asyncio
-import re
-from typing import List, Dict, Any, Optional
+import threading
+from contextlib import aclosing
+from typing import List, Dict, Any, Optional, Callable
+
+from llm_backends import LlamaBackendPool, PreemptedError
+from model_routing import ModelRouter
+from semantic_cache import SemanticCache
+
+# Semantic inference is background work that interactive requests may preempt
+MAX_PREEMPTION_RETRIES = 3
+
 
 class LLMSemanticAnalyzer:
     """Class to analyze and infer column semantics using LLM with enhanced context awareness."""
 
-    def __init__(self, llm_service_host="llama-service", llm_service_port="8080"):
+    def __init__(self, llm_service_host="llama-service", llm_service_port="8080", endpoints=None, backend_pool=None,
+                 model_router=None):
         """Initialize the semantic analyzer with LLM service connection details."""
         self.llm_service_host = llm_service_host
         self.llm_service_port = llm_service_port
+        self.model_router = model_router or ModelRouter.single(
+            backend_pool or LlamaBackendPool(endpoints or [f"{llm_service_host}:{llm_service_port}"])
+        )
+
+    async def get_model_name_async(self) -> str:
+        """Name of the model serving semantic inference, as reported by llama-server /props."""
+        pool = self.model_router.primary_tier("background").pool
+        backend = pool.backends[0]
+        try:
+            async with httpx.AsyncClient(timeout=10) as client:
+                props = (await client.get(f'{backend.url}/props')).json()
+            model = props.get('model_path') or props.get('default_generation_settings', {}).get('model', '')
+            if model:
+                return os.path.basename(model)
+        except Exception as e:
+            print(f"Could not read the llama-server model name: {e}")
+        return backend.url
+
+    async def get_llm_response(self, prompt: str, n_predict: int = 200) -> str:
+        """
+        Get a response from the LLM Runtime API.
 
-    async def get_llm_response(self, prompt: str) -> str:
-        """Get a response from the LLM Runtime API."""
+        Requests run in the background scheduling class; a request preempted by
+        interactive work is retried after a short pause.
+        """
         json_data = {
             'prompt': prompt,
             'temperature': 0.1,
-            'n_predict': 200,
+            'n_predict': n_predict,
             'stream': True,
         }
 
-        async with httpx.AsyncClient(timeout=60) as client:
-            async with client.stream('POST', f'http://{self.llm_service_host}:{self.llm_service_port}/completion',
-                                    json=json_data) as response:
-                full_response = ""
-                async for chunk in response.aiter_bytes():
-                    try:
-                        data = json.loads(chunk.decode('utf-8')[6:])
-                        if data['stop'] is False:
-                            full_response += data['content']
-                    except:
-                        pass
+        for attempt in range(MAX_PREEMPTION_RETRIES + 1):
+            full_response = ""
+            try:
+                async with aclosing(self.model_router.stream("background", json_data, timeout=60)) as events:
+                    async for data in events:
+                        if data.get('stop') is False:
+                            full_response += data.get('content', '')
+                break
+            except PreemptedError:
+                if attempt == MAX_PREEMPTION_RETRIES:
+                    raise
+                await asyncio.sleep(2 ** attempt)
 
         return full_response.strip()
 
@@ -208,13 +243,29 @@ Response:"""
 
     async def batch_infer_column_semantics_async(self,
                                               columns_info: List[Dict[str, Any]],
-                                              foreign_keys: Optional[List[Dict[str, str]]] = None) -> Dict[str, str]:
+                                              foreign_keys: Optional[List[Dict[str, str]]] = None,
+                                              max_concurrency: int = 2,
+                                              cache: Optional[SemanticCache] = None,
+                                              schema_fingerprint: str = "",
+                                              on_table_done: Optional[Callable[[str, Dict[str, str]], None]] = None,
+                                              on_table_failed: Optional[Callable[[str, Exception], None]] = None
+                                              ) -> Dict[str, str]:
         """
         Process multiple columns in batch to reduce API calls.
 
+        One prompt is sent per table, at most max_concurrency at a time. With a
+        cache, columns already described for this schema fingerprint and model
+        are not sent again, and new descriptions are stored. A table whose
+        inference fails is logged and skipped; the other tables still complete.
+
         Args:
             columns_info: List of dictionaries with table_name, column_name, data_type, and optional sample_values
             foreign_keys: Optional list of foreign key relationships for context
+            max_concurrency: Maximum number of table prompts in flight
+            cache: Optional persistent cache of descriptions
+            schema_fingerprint: Schema fingerprint the cache entries belong to
+            on_table_done: Called with the table name and its inferred descriptions as each table finishes
+            on_table_failed: Called with the table name and the exception of each table that failed
 
         Returns:
             Dictionary mapping column keys (table.column) to their semantic descriptions
@@ -227,11 +278,59 @@ Response:"""
                 columns_by_table[table_name] = []
             columns_by_table[table_name].append(col_info)
 
-        # Process each table's columns with better context
         all_semantics = {}
-        for table_name, table_columns in columns_by_table.items():
-            # Build comprehensive prompt for this table's columns
-            prompt = f"""You are an expert database analyst helping infer the semantic meaning of database columns.
+        model_name = await self.get_model_name_async() if cache else ""
+        semaphore = asyncio.Semaphore(max(max_concurrency, 1))
+
+        async def process_table(table_name: str, table_columns: List[Dict[str, Any]]):
+            keys = {
+                f"{c['table_name']}.{c['column_name']}": (c['table_name'], c['column_name'], c['data_type'])
+                for c in table_columns
+            }
+            cached = cache.get_many(list(keys.values()), schema_fingerprint, model_name) if cache else {}
+            pending = [c for c in table_columns if f"{c['table_name']}.{c['column_name']}" not in cached]
+
+            semantics = {}
+            if pending:
+                async with semaphore:
+                    semantics = await self._infer_table_columns_async(table_name, pending, foreign_keys)
+                if cache and semantics:
+                    cache.put_many({keys[key]: description for key, description in semantics.items()},
+                                   schema_fingerprint, model_name)
+
+            inferred = {**cached, **semantics}
+            all_semantics.update(inferred)
+            if on_table_done:
+                on_table_done(table_name, inferred)
+
+        results = await asyncio.gather(*(
+            process_table(table_name, table_columns) for table_name, table_columns in columns_by_table.items()
+        ), return_exceptions=True)
+        for table_name, result in zip(columns_by_table, results):
+            if not isinstance(result, BaseException):
+                continue
+            if not isinstance(result, Exception):
+                # Cancellation and interpreter exits are not a table's failure
+                raise result
+            print(f"Semantic inference failed for table {table_name}: {result}")
+            if on_table_failed:
+                on_table_failed(table_name, result)
+
+        # Fill in any missing columns with generic descriptions
+        for col_info in columns_info:
+            col_key = f"{col_info['table_name']}.{col_info['column_name']}"
+            if col_key not in all_semantics:
+                all_semantics[col_key] = f"Column related to {col_info['column_name'].replace('_', ' ')}"
+
+        return all_semantics
+
+    async def _infer_table_columns_async(self,
+                                         table_name: str,
+                                         table_columns: List[Dict[str, Any]],
+                                         foreign_keys: Optional[List[Dict[str, str]]] = None) -> Dict[str, str]:
+        """Infer the columns of one table with a single prompt; returns the descriptions that could be parsed."""
+        # Build comprehensive prompt for this table's columns
+        prompt = f"""You are an expert database analyst helping infer the semantic meaning of database columns.
 I'll provide information about multiple columns from the table '{table_name}'. For each column, infer its business meaning based on:
 1. The table name (what entity the table represents)
 2. The column name (what property or attribute it might store)
@@ -242,29 +341,29 @@ I'll provide information about multiple columns from the table '{table_name}'. F
 Here's what I need for each column:
 """
 
-            # Add column-specific information
-            for i, col_info in enumerate(table_columns):
-                column_name = col_info['column_name']
-                data_type = col_info['data_type']
-                sample_values = col_info.get('sample_values', [])
+        # Add column-specific information
+        for i, col_info in enumerate(table_columns):
+            column_name = col_info['column_name']
+            data_type = col_info['data_type']
+            sample_values = col_info.get('sample_values', [])
 
-                prompt += f"Column {i+1}: {column_name} ({data_type})\n"
+            prompt += f"Column {i+1}: {column_name} ({data_type})\n"
 
-                if sample_values and len(sample_values) > 0:
-                    values_str = ", ".join(str(v) for v in sample_values[:5])
-                    prompt += f"Sample Values: {values_str}\n"
+            if sample_values and len(sample_values) > 0:
+                values_str = ", ".join(str(v) for v in sample_values[:5])
+                prompt += f"Sample Values: {values_str}\n"
 
-                # Add foreign key context
-                if foreign_keys:
-                    for fk in foreign_keys:
-                        if fk.get("table") == table_name and fk.get("column") == column_name:
-                            prompt += f"References: {fk.get('foreign_table')}.{fk.get('foreign_column')}\n"
-                        elif fk.get("foreign_table") == table_name and fk.get("foreign_column") == column_name:
-                            prompt += f"Referenced by: {fk.get('table')}.{fk.get('column')}\n"
+            # Add foreign key context
+            if foreign_keys:
+                for fk in foreign_keys:
+                    if fk.get("table") == table_name and fk.get("column") == column_name:
+                        prompt += f"References: {fk.get('foreign_table')}.{fk.get('foreign_column')}\n"
+                    elif fk.get("foreign_table") == table_name and fk.get("foreign_column") == column_name:
+                        prompt += f"Referenced by: {fk.get('table')}.{fk.get('column')}\n"
 
-                prompt += "\n"
+            prompt += "\n"
 
-            prompt += """For each column, provide a single-line response in this exact format:
+        prompt += """For each column, provide a single-line response in this exact format:
 Column 1: [concise, specific business meaning]
 Column 2: [concise, specific business meaning]
 ...and so on.
@@ -273,50 +372,147 @@ Make sure each description is a single, complete sentence that explains the busi
 Do not include any introductory text or explanations beyond these specific answers.
 """
 
-            response = await self.get_llm_response(prompt)
-
-            # Parse the response
-            lines = response.strip().split('\n')
-            semantics = {}
-
-            for line in lines:
-                line = line.strip()
-                if not line:
-                    continue
+        # About one line of output per column
+        response = await self.get_llm_response(prompt, n_predict=40 * len(table_columns) + 40)
 
-                # Try to match "Column X: description" pattern
-                match = re.match(r'Column\s+(\d+):\s+(.*)', line, re.IGNORECASE)
-                if match:
-                    col_idx = int(match.group(1)) - 1
-                    description = match.group(2).strip()
+        # Parse the response
+        lines = response.strip().split('\n')
+        semantics = {}
 
-                    if 0 <= col_idx < len(table_columns):
-                        col_info = table_columns[col_idx]
-                        col_key = f"{col_info['table_name']}.{col_info['column_name']}"
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
 
-                        # Clean up the description
-                        description = re.sub(r'^(This column|It)\s+', '', description, flags=re.IGNORECASE)
-                        description = description.strip()
-                        if description and not description.endswith('.'):
-                            description += '.'
-                        if description:
-                            description = description[0].upper() + description[1:]
+            # Try to match "Column X: description" pattern
+            match = re.match(r'Column\s+(\d+):\s+(.*)', line, re.IGNORECASE)
+            if match:
+                col_idx = int(match.group(1)) - 1
+                description = match.group(2).strip()
 
-                        semantics[col_key] = description
+                if 0 <= col_idx < len(table_columns):
+                    col_info = table_columns[col_idx]
+                    col_key = f"{col_info['table_name']}.{col_info['column_name']}"
 
-            # Add to overall results
-            all_semantics.update(semantics)
+                    # Clean up the description
+                    description = re.sub(r'^(This column|It)\s+', '', description, flags=re.IGNORECASE)
+                    description = description.strip()
+                    if description and not description.endswith('.'):
+                        description += '.'
+                    if description:
+                        description = description[0].upper() + description[1:]
 
-            # Fill in any missing columns with generic descriptions
-            for col_info in table_columns:
-                col_key = f"{col_info['table_name']}.{col_info['column_name']}"
-                if col_key not in all_semantics:
-                    all_semantics[col_key] = f"Column related to {col_info['column_name'].replace('_', ' ')}"
+                    semantics[col_key] = description
 
-        return all_semantics
+        return semantics
 
     def batch_infer_column_semantics(self,
                                    columns_info: List[Dict[str, Any]],
-                                   foreign_keys: Optional[List[Dict[str, str]]] = None) -> Dict[str, str]:
+                                   foreign_keys: Optional[List[Dict[str, str]]] = None,
+                                   max_concurrency: int = 2,
+                                   cache: Optional[SemanticCache] = None,
+                                   schema_fingerprint: str = "",
+                                   on_table_done: Optional[Callable[[str, Dict[str, str]], None]] = None,
+                                   on_table_failed: Optional[Callable[[str, Exception], None]] = None
+                                   ) -> Dict[str, str]:
         """Synchronous wrapper for batch_infer_column_semantics_async."""
-        return asyncio.run(self.batch_infer_column_semantics_async(columns_info, foreign_keys))
+        return asyncio.run(self.batch_infer_column_semantics_async(
+            columns_info, foreign_keys, max_concurrency, cache, schema_fingerprint, on_table_done, on_table_failed
+        ))
+
+
+class SemanticInferenceJob:
+    """
+    Infer descriptions of uncommented columns in a background thread.
+
+    Descriptions are written into DatabaseAnalyzer.column_semantics table by
+    table as they arrive, so generate_schema_for_llm() picks them up
+    progressively; version increases with every update.
+    """
+
+    def __init__(self,
+                 analyzer: LLMSemanticAnalyzer,
+                 db_analyzer,
+                 cache: Optional[SemanticCache] = None,
+                 max_concurrency: int = 2):
+        """
+        Prepare the job from the analyzed schema of db_analyzer.
+
+        The database is not queried from the background thread; columns and
+        sample values are taken from db_analyzer.schema_info.
+        """
+        self.analyzer = analyzer
+        self.db_analyzer = db_analyzer
+        self.cache = cache
+        self.max_concurrency = max_concurrency
+        self.schema_fingerprint = db_analyzer.schema_fingerprint()
+        self.columns_info = db_analyzer.columns_without_comments()
+        self.foreign_keys = [
+            {"table": rel["table"], "column": rel["column"],
+             "foreign_table": rel["references_table"], "foreign_column": rel["references_column"]}
+            for rel in db_analyzer.schema_info.get("relationships", [])
+        ]
+
+        self.total_tables = len({c["table_name"] for c in self.columns_info})
+        self.completed_tables = 0
+        self.failed_tables = {}
+        self.described_columns = 0
+        self.version = 0
+        self.started_at = None
+        self.finished_at = None
+        self.error = None
+        self._thread = None
+
+    def _table_done(self, table_name: str, semantics: Dict[str, str]):
+        """Publish the descriptions of one table."""
+        self.db_analyzer.column_semantics.update(semantics)
+        self.completed_tables += 1
+        self.described_columns += len(semantics)
+        if semantics:
+            self.version += 1
+
+    def _table_failed(self, table_name: str, error: Exception):
+        """Record a table whose columns could not be described."""
+        self.failed_tables[table_name] = str(error)
+
+    def _run(self):
+        """Thread body."""
+        try:
+            self.analyzer.batch_infer_column_semantics(
+                self.columns_info, self.foreign_keys,
+                max_concurrency=self.max_concurrency,
+                cache=self.cache,
+                schema_fingerprint=self.schema_fingerprint,
+                on_table_done=self._table_done,
+                on_table_failed=self._table_failed
+            )
+        except Exception as e:
+            self.error = str(e)
+            print(f"Semantic inference failed: {e}")
+        finally:
+            self.finished_at = time.time()
+
+    def start(self) -> 'SemanticInferenceJob':
+        """Start the background thread."""
+        self.started_at = time.time()
+        self._thread = threading.Thread(target=self._run, name="semantic-inference", daemon=True)
+        self._thread.start()
+        return self
+
+    @property
+    def running(self) -> bool:
+        """Whether the job is still running."""
+        return self._thread is not None and self._thread.is_alive()
+
+    def status(self) -> Dict[str, Any]:
+        """Progress of the job for display."""
+        end = self.finished_at or time.time()
+        return {
+            "running": self.running,
+            "tables": f"{self.completed_tables}/{self.total_tables}",
+            "failed_tables": dict(self.failed_tables),
+            "described_columns": self.described_columns,
+            "columns_to_describe": len(self.columns_info),
+            "seconds": round(end - self.started_at, 1) if self.started_at else 0.0,
+            "error": self.error,
+        }
@@ -0,0 +1,221 @@
+import os
+import json
+import time
+import threading
+from collections import deque
+from contextlib import aclosing
+from typing import List, Dict, Any, Optional, AsyncIterator, Callable, Tuple
+
+from llm_backends import LlamaBackendPool, stream_completion, post_completion
+
+# JSON routing configuration; see ModelRouter.from_config for the format
+DEFAULT_ROUTING_CONFIG = os.getenv("LLM_ROUTING_CONFIG", "")
+
+# Sampling parameters used unless the task or the caller sets them
+DEFAULT_SAMPLING = {
+    'temperature': 0.1,
+    'repetition_penalty': 1.18,
+    'n_predict': 500,
+}
+
+# Task settings that are routing options rather than llama-server parameters
+ROUTING_OPTIONS = ('tier', 'fallback', 'max_first_token_s')
+
+# Example configuration: SQL on the large model, explanations on the small one
+EXAMPLE_ROUTING_CONFIG = {
+    "tiers": {
+        "large": {"endpoints": ["textsql-service:8080"]},
+        "small": {"endpoints": ["llama-service:8080"]},
+    },
+    "tasks": {
+        "sql": {"tier": "large", "fallback": "small", "max_first_token_s": 15},
+        "explanation": {"tier": "small", "fallback": "large", "n_predict": 300},
+        "error_analysis": {"tier": "small", "fallback": "large", "n_predict": 300},
+        "background": {"tier": "small", "n_predict": 200},
+    },
+}
+
+
+class ModelTier:
+    """A model deployment: its backend pool and recent time-to-first-token."""
+
+    def __init__(self, name: str, pool: LlamaBackendPool):
+        self.name = name
+        self.pool = pool
+        self.first_token_seconds = deque(maxlen=20)
+
+    def recent_first_token(self) -> Optional[float]:
+        """Median time to first token over the recent requests, or None if unknown."""
+        if not self.first_token_seconds:
+            return None
+        values = sorted(self.first_token_seconds)
+        return values[len(values) // 2]
+
+    def available(self) -> bool:
+        """Whether any backend of the tier is healthy and not ejected."""
+        now = time.time()
+        return any(backend.available(now) for backend in self.pool.backends)
+
+
+class ModelRouter:
+    """
+    Route each LLM task to a model tier.
+
+    Every task (the request classes of llm_backends.REQUEST_CLASSES) has a
+    primary tier, optional sampling parameters and an optional fallback tier.
+    A request goes to the fallback when the primary tier is down, when all of
+    its slots are busy, or when its recent time to first token exceeds
+    max_first_token_s, and the fallback is not in the same state.
+    """
+
+    def __init__(self, tiers: Dict[str, ModelTier], tasks: Dict[str, Dict[str, Any]], default_tier: str):
+        """
+        Initialize the router.
+
+        Args:
+            tiers: Model tiers by name
+            tasks: Routing settings and sampling parameters per task
+            default_tier: Tier for tasks that have no settings
+        """
+        for task, settings in tasks.items():
+            for key in ('tier', 'fallback'):
+                if settings.get(key) is not None and settings[key] not in tiers:
+                    raise ValueError(f"Task '{task}' refers to unknown tier '{settings[key]}'")
+        if default_tier not in tiers:
+            raise ValueError(f"Unknown default tier '{default_tier}'")
+
+        self.tiers = tiers
+        self.tasks = tasks
+        self.default_tier = default_tier
+        self.decisions = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def single(cls, pool: LlamaBackendPool) -> 'ModelRouter':
+        """Router that sends every task to one pool."""
+        return cls({"default": ModelTier("default", pool)}, {}, "default")
+
+    @classmethod
+    def from_config(cls, config: Dict[str, Any],
+                    pool_factory: Callable[[Tuple[str, ...]], LlamaBackendPool]) -> 'ModelRouter':
+        """
+        Build a router from a configuration like EXAMPLE_ROUTING_CONFIG.
+
+        "tiers" maps tier names to {"endpoints": [...]}; "tasks" maps task names to
+        {"tier", "fallback", "max_first_token_s", <llama-server sampling parameters>}.
+        The default tier is the one of the "sql" task, or else the first tier.
+        pool_factory creates (or returns a shared) pool for a tuple of endpoints.
+        """
+        if not config.get("tiers"):
+            raise ValueError("Routing configuration needs at least one tier")
+        tiers = {
+            name: ModelTier(name, pool_factory(tuple(tier["endpoints"])))
+            for name, tier in config["tiers"].items()
+        }
+        tasks = config.get("tasks", {})
+        default_tier = tasks.get("sql", {}).get("tier") or next(iter(tiers))
+        return cls(tiers, tasks, default_tier)
+
+    def primary_tier(self, task: str) -> ModelTier:
+        """The tier a task is configured to run on."""
+        return self.tiers[self.tasks.get(task, {}).get("tier") or self.default_tier]
+
+    def route(self, task: str) -> Tuple[ModelTier, str]:
+        """
+        Choose the tier for a request.
+
+        Returns:
+            Tuple of (tier, reason) where reason is "primary", "unavailable",
+            "saturated" or "slow"
+        """
+        settings = self.tasks.get(task, {})
+        primary = self.primary_tier(task)
+        fallback = self.tiers.get(settings.get("fallback")) if settings.get("fallback") else None
+        if fallback is None or fallback is primary:
+            return primary, "primary"
+
+        if not primary.available():
+            return (fallback, "unavailable") if fallback.available() else (primary, "primary")
+
+        if primary.pool.scheduler.saturated() and not fallback.pool.scheduler.saturated():
+            return fallback, "saturated"
+
+        max_first_token = settings.get("max_first_token_s")
+        primary_latency = primary.recent_first_token()
+        if max_first_token and primary_latency is not None and primary_latency > max_first_token:
+            fallback_latency = fallback.recent_first_token()
+            if fallback_latency is None or fallback_latency <= max_first_token:
+                return fallback, "slow"
+
+        return primary, "primary"
+
+    def record(self, task: str, tier: ModelTier, reason: str):
+        """Count a routing decision."""
+        with self._lock:
+            key = (task, tier.name, reason)
+            self.decisions[key] = self.decisions.get(key, 0) + 1
+
+    def request_data(self, task: str, tier: ModelTier, json_data: Dict[str, Any]) -> Dict[str, Any]:
+        """Request body for a tier: default and task sampling parameters overridden by the caller's."""
+        sampling = {k: v for k, v in self.tasks.get(task, {}).items() if k not in ROUTING_OPTIONS}
+        data = {**DEFAULT_SAMPLING, **sampling, **json_data}
+        if tier is not self.primary_tier(task):
+            # Slot numbers belong to the primary tier's servers
+            data.pop('id_slot', None)
+        return data
+
+    async def stream(self, task: str, json_data: Dict[str, Any],
+                     session_key: Optional[str] = None, timeout: float = 120,
+                     group: Optional[str] = None) -> AsyncIterator[Dict[str, Any]]:
+        """Stream a /completion request for a task from the tier it is routed to."""
+        tier, reason = self.route(task)
+        self.record(task, tier, reason)
+
+        start = time.time()
+        first = True
+        async with aclosing(stream_completion(tier.pool, self.request_data(task, tier, json_data),
+                                              session_key, timeout, request_class=task,
+                                              group=group)) as events:
+            async for data in events:
+                if first:
+                    tier.first_token_seconds.append(time.time() - start)
+                    first = False
+                yield data
+
+    async def post(self, task: str, json_data: Dict[str, Any],
+                   session_key: Optional[str] = None, timeout: float = 300,
+                   request_class: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Send a non-streaming /completion request to a task's primary tier.
+
+        request_class defaults to the task; prompt-cache warming of the SQL tier,
+        for example, runs as background work.
+        """
+        tier = self.primary_tier(task)
+        self.record(task, tier, "primary")
+        return await post_completion(tier.pool, self.request_data(task, tier, json_data),
+                                     session_key, timeout, request_class=request_class or task)
+
+    def status(self) -> List[Dict[str, Any]]:
+        """Routing decisions per task and tier for display."""
+        with self._lock:
+            decisions = dict(self.decisions)
+        rows = []
+        for (task, tier_name, reason), count in sorted(decisions.items()):
+            latency = self.tiers[tier_name].recent_first_token()
+            rows.append({
+                "task": task,
+                "tier": tier_name,
+                "reason": reason,
+                "requests": count,
+                "tier_first_token_s": round(latency, 2) if latency is not None else None,
+            })
+        return rows
+
+
+def load_routing_config(text: str = DEFAULT_ROUTING_CONFIG) -> Optional[Dict[str, Any]]:
+    """Parse a JSON routing configuration; None if it is empty."""
+    text = (text or "").strip()
+    if not text:
+        return None
+    return json.loads(text)
@@ -0,0 +1,283 @@
+import time
+import threading
+import itertools
+import psycopg2
+import psycopg2.extras
+import psycopg2.pool
+from concurrent.futures import ThreadPoolExecutor
+from psycopg2.extensions import parse_dsn
+from typing import List, Dict, Any, Tuple, Optional
+
+# Lag of a streaming replica in seconds, and whether its WAL receiver is running.
+# A replica that is streaming and has replayed everything it received is reported
+# as 0 even if the primary has been idle for a while; without a streaming receiver
+# the received LSN says nothing about the primary, so the replay timestamp is used.
+# The status column is NULL for roles without pg_read_all_stats, while the row is
+# still there as long as the receiver runs.
+REPLICA_LAG_QUERY = """
+    WITH receiver AS (SELECT status FROM pg_stat_wal_receiver)
+    SELECT pg_is_in_recovery(),
+           CASE
+               WHEN NOT pg_is_in_recovery() THEN 0
+               WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn()
+                    AND EXISTS (SELECT 1 FROM receiver WHERE coalesce(status, 'streaming') = 'streaming') THEN 0
+               ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+           END,
+           EXISTS (SELECT 1 FROM receiver)
+"""
+
+
+def prepare_connection(connection):
+    """Put a pooled replica connection into read-only autocommit mode once."""
+    if not connection.autocommit:
+        connection.set_session(readonly=True, autocommit=True)
+
+
+class ReplicaUnavailableError(Exception):
+    """Raised when no read replica can serve a query."""
+
+
+class ReplicaBackend:
+    """Connection pool and health state for a single read replica."""
+
+    def __init__(self, connection_params: Dict[str, str], max_connections: int = 4):
+        self.connection_params = connection_params
+        self.name = f"{connection_params.get('host', 'localhost')}:{connection_params.get('port', '5432')}"
+        self.max_connections = max_connections
+        self.pool = None
+        self.in_flight = 0
+        self.lag_seconds = None
+        self.in_recovery = None
+        self.healthy = True
+        self.last_checked = 0.0
+        self.last_error = ""
+        self.queries_served = 0
+
+    def get_pool(self) -> psycopg2.pool.ThreadedConnectionPool:
+        """Create the connection pool lazily on first use."""
+        if self.pool is None:
+            self.pool = psycopg2.pool.ThreadedConnectionPool(0, self.max_connections, **self.connection_params)
+        return self.pool
+
+    def close(self):
+        """Close every pooled connection."""
+        if self.pool is not None:
+            self.pool.closeall()
+            self.pool = None
+
+
+class ReplicaRouter:
+    """Route read-only queries to a set of PostgreSQL read replicas.
+
+    Replicas whose replay lag exceeds ``max_lag_seconds`` (measured with
+    ``pg_last_xact_replay_timestamp()``) are skipped, as are replicas whose WAL
+    receiver is not running. The remaining replicas are balanced either
+    round-robin or by the number of queries currently in flight. Lag is checked
+    by a background thread, so queries never wait for a replica probe.
+    """
+
+    STRATEGIES = ("round_robin", "least_busy")
+
+    def __init__(self,
+                 replica_dsns: List[str],
+                 base_params: Optional[Dict[str, str]] = None,
+                 max_lag_seconds: float = 30.0,
+                 strategy: str = "round_robin",
+                 lag_check_interval: float = 5.0,
+                 max_connections: int = 4,
+                 connect_timeout: int = 3):
+        """
+        Initialize the router.
+
+        Args:
+            replica_dsns: libpq DSNs or URIs of the replicas, e.g. "host=replica1 port=5433"
+            base_params: Connection parameters used for anything a DSN leaves out (usually the primary's)
+            max_lag_seconds: Replicas lagging further behind than this are not used
+            strategy: "round_robin" or "least_busy"
+            lag_check_interval: Seconds between lag checks of the same replica
+            max_connections: Pool size per replica
+            connect_timeout: Seconds to wait for a replica connection, unless its DSN sets connect_timeout
+        """
+        if strategy not in self.STRATEGIES:
+            raise ValueError(f"Unknown replica balancing strategy: {strategy}")
+
+        self.max_lag_seconds = max_lag_seconds
+        self.strategy = strategy
+        self.lag_check_interval = lag_check_interval
+        self.replicas = []
+        for dsn in replica_dsns:
+            params = dict(base_params or {})
+            params.update(parse_dsn(dsn))
+            params.setdefault("connect_timeout", str(connect_timeout))
+            self.replicas.append(ReplicaBackend(params, max_connections))
+        # Longest a first round of checks can take to connect
+        self.first_check_timeout = max(
+            [float(replica.connection_params["connect_timeout"]) for replica in self.replicas] or [0.0])
+
+        self._lock = threading.Lock()
+        self._round_robin = itertools.count()
+        self._stop = threading.Event()
+        self._checker = None
+        self._first_check_done = threading.Event()
+
+    def check_replica(self, replica: ReplicaBackend):
+        """Measure the replay lag of a replica and update its health state."""
+        replica.last_checked = time.time()
+        connection = None
+        try:
+            connection = replica.get_pool().getconn()
+            prepare_connection(connection)
+            cursor = connection.cursor()
+            cursor.execute(REPLICA_LAG_QUERY)
+            in_recovery, lag, receiving = cursor.fetchone()
+            cursor.close()
+            replica.get_pool().putconn(connection)
+
+            replica.in_recovery = in_recovery
+            # A replica that has never replayed a transaction reports NULL lag
+            replica.lag_seconds = float(lag) if lag is not None else float("inf")
+            if in_recovery and not receiving:
+                # Disconnected from the primary: it may be arbitrarily stale
+                replica.healthy = False
+                replica.last_error = "WAL receiver is not running"
+            else:
+                replica.healthy = True
+                replica.last_error = ""
+        except psycopg2.pool.PoolError:
+            # Every connection is busy with user queries: keep the last state and
+            # check again next round rather than marking a busy replica unhealthy
+            pass
+        except Exception as e:
+            if connection is not None and replica.pool is not None:
+                replica.pool.putconn(connection, close=True)
+            replica.healthy = False
+            replica.last_error = str(e)
+            print(f"Replica {replica.name} check failed: {e}")
+
+    def refresh_lag(self, force: bool = False):
+        """Re-check, in parallel, every replica whose last check is older than the check interval."""
+        now = time.time()
+        due = [replica for replica in self.replicas
+               if force or now - replica.last_checked >= self.lag_check_interval]
+        if due:
+            with ThreadPoolExecutor(max_workers=len(due), thread_name_prefix="replica-check") as executor:
+                list(executor.map(self.check_replica, due))
+
+    def _check_loop(self):
+        """Thread body: keep the lag of every replica current."""
+        while not self._stop.wait(self.lag_check_interval):
+            self.refresh_lag()
+
+    def start(self):
+        """
+        Check every replica once, then keep checking them in a background thread.
+
+        Callers arriving while the first round of checks runs wait for it, at
+        most the connect timeout, rather than finding no replica checked yet.
+        """
+        with self._lock:
+            starting = self._checker is None
+            if starting:
+                self._checker = threading.Thread(target=self._check_loop, name="replica-lag", daemon=True)
+        if not starting:
+            self._first_check_done.wait(self.first_check_timeout)
+            return
+        try:
+            self.refresh_lag(force=True)
+        finally:
+            self._first_check_done.set()
+        self._checker.start()
+
+    def choose_replica(self) -> Optional[ReplicaBackend]:
+        """Pick a healthy, sufficiently fresh replica, or None if there is none."""
+        # Only the first query waits, for one parallel round of checks bounded by the connect timeout
+        self.start()
+
+        candidates = [
+            replica for replica in self.replicas
+            if replica.healthy
+            and replica.lag_seconds is not None
+            and replica.lag_seconds <= self.max_lag_seconds
+        ]
+        if not candidates:
+            return None
+
+        with self._lock:
+            if self.strategy == "least_busy":
+                replica = min(candidates, key=lambda r: (r.in_flight, r.queries_served))
+            else:
+                replica = candidates[next(self._round_robin) % len(candidates)]
+            replica.in_flight += 1
+
+        return replica
+
+    def execute(self, query: str) -> Tuple[List[Dict[str, Any]], List[str], str]:
+        """
+        Execute a read-only query on a replica.
+
+        Returns:
+            Tuple of (results, columns, replica name)
+
+        Raises:
+            ReplicaUnavailableError: if no replica is usable; the caller should use the primary
+        """
+        replica = self.choose_replica()
+        if replica is None:
+            raise ReplicaUnavailableError("No healthy read replica within the lag limit")
+
+        connection = None
+        try:
+            try:
+                connection = replica.get_pool().getconn()
+                prepare_connection(connection)
+            except psycopg2.pool.PoolError as e:
+                # Pool exhausted: the replica is busy, not broken
+                raise ReplicaUnavailableError(f"Replica {replica.name} busy: {e}")
+            except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+                if connection is not None:
+                    replica.pool.putconn(connection, close=True)
+                    connection = None
+                replica.healthy = False
+                replica.last_error = str(e)
+                raise ReplicaUnavailableError(f"Replica {replica.name} unavailable: {e}")
+
+            cursor = connection.cursor(cursor_factory=psycopg2.extras.DictCursor)
+            try:
+                cursor.execute(query)
+                columns = [desc[0] for desc in cursor.description] if cursor.description else []
+                results = [dict(zip(columns, row)) for row in cursor.fetchall()] if columns else []
+            except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+                replica.pool.putconn(connection, close=True)
+                connection = None
+                replica.healthy = False
+                replica.last_error = str(e)
+                raise ReplicaUnavailableError(f"Replica {replica.name} failed: {e}")
+            finally:
+                if connection is not None:
+                    cursor.close()
+
+            replica.queries_served += 1
+            return results, columns, replica.name
+        finally:
+            if connection is not None:
+                replica.pool.putconn(connection)
+            with self._lock:
+                replica.in_flight -= 1
+
+    def status(self) -> List[Dict[str, Any]]:
+        """Return the current state of every replica for display."""
+        return [{
+            "replica": replica.name,
+            "healthy": replica.healthy,
+            "in_recovery": replica.in_recovery,
+            "lag_seconds": replica.lag_seconds,
+            "in_flight": replica.in_flight,
+            "queries_served": replica.queries_served,
+            "last_error": replica.last_error,
+        } for replica in self.replicas]
+
+    def close(self):
+        """Stop the lag checks and close the connection pools of all replicas."""
+        self._stop.set()
+        for replica in self.replicas:
+            replica.close()
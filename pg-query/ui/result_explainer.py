@@ -0,0 +1,79 @@
+import datetime
+from decimal import Decimal
+from typing import List, Dict, Any, Optional
+
+# Largest result that is listed in full instead of being summarised by the LLM
+MAX_LISTED_ROWS = 10
+MAX_LISTED_COLUMNS = 8
+
+
+def humanize_column(column: str) -> str:
+    """Turn a column name such as total_revenue into a label such as "Total revenue"."""
+    label = column.replace("_", " ").strip()
+    return label[:1].upper() + label[1:] if label else column
+
+
+def is_number(value: Any) -> bool:
+    """Whether a result value is numeric (booleans are not)."""
+    return isinstance(value, (int, float, Decimal)) and not isinstance(value, bool)
+
+
+def format_value(value: Any) -> str:
+    """Format a single result value for display."""
+    if value is None:
+        return "no value"
+    if isinstance(value, bool):
+        return "yes" if value else "no"
+    if isinstance(value, int):
+        return f"{value:,}"
+    if isinstance(value, (float, Decimal)):
+        if float(value).is_integer():
+            return f"{int(value):,}"
+        return f"{float(value):,.2f}"
+    if isinstance(value, datetime.datetime):
+        return value.strftime("%Y-%m-%d %H:%M")
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    return str(value)
+
+
+def explain_trivial_result(question: str, results: List[Dict[str, Any]], columns: List[str]) -> Optional[str]:
+    """
+    Answer from the result itself when its shape makes an LLM summary unnecessary.
+
+    Handles empty results, a single value, a single row, a short list of values
+    and a short list of label/number pairs (e.g. a GROUP BY count). Returns None
+    for anything else, which should be explained by the LLM.
+    """
+    columns = columns or (list(results[0].keys()) if results else [])
+
+    if not results:
+        return f'No data matched the question "{question.strip()}".'
+
+    if len(results) == 1 and len(columns) == 1:
+        return f"**{humanize_column(columns[0])}:** {format_value(results[0][columns[0]])}"
+
+    if len(results) == 1 and len(columns) <= MAX_LISTED_COLUMNS:
+        lines = [f"- **{humanize_column(column)}:** {format_value(results[0][column])}" for column in columns]
+        return "The query returned one row:\n" + "\n".join(lines)
+
+    if len(results) > MAX_LISTED_ROWS:
+        return None
+
+    if len(columns) == 1:
+        lines = [f"- {format_value(row[columns[0]])}" for row in results]
+        return f"The query returned {len(results)} values of {humanize_column(columns[0]).lower()}:\n" + "\n".join(lines)
+
+    if len(columns) == 2:
+        numeric = [
+            column for column in columns
+            if all(row[column] is None or is_number(row[column]) for row in results)
+        ]
+        if len(numeric) == 1:
+            value_column = numeric[0]
+            label_column = columns[0] if columns[1] == value_column else columns[1]
+            lines = [f"- {format_value(row[label_column])}: {format_value(row[value_column])}" for row in results]
+            return (f"{humanize_column(value_column)} by {humanize_column(label_column).lower()}:\n"
+                    + "\n".join(lines))
+
+    return None
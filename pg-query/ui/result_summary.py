@@ -0,0 +1,111 @@
+import datetime
+import numpy as np
+import pandas as pd
+from decimal import Decimal
+from typing import List, Dict, Any
+
+from result_explainer import is_number
+
+# Rough token estimate for prompt budgeting; llama tokenizers average about 4 characters per token
+CHARS_PER_TOKEN = 4
+DEFAULT_TOKEN_BUDGET = 800
+MAX_CELL_CHARS = 60
+TOP_CATEGORIES = 5
+
+
+def estimate_tokens(text: str) -> int:
+    """Approximate number of tokens in a text."""
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def compact_value(value: Any) -> str:
+    """Format a value for the compact row encoding."""
+    if value is None or (isinstance(value, float) and np.isnan(value)):
+        return "NULL"
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, (float, Decimal)):
+        number = float(value)
+        if number.is_integer():
+            return str(int(number))
+        if abs(number) < 1:
+            return f"{number:.4g}"
+        return f"{number:.2f}".rstrip("0").rstrip(".")
+    if isinstance(value, datetime.datetime):
+        return value.strftime("%Y-%m-%d %H:%M")
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    text = str(value).replace("\n", " ").replace("|", "/")
+    return text if len(text) <= MAX_CELL_CHARS else text[:MAX_CELL_CHARS - 3] + "..."
+
+
+def column_statistics(name: str, series: pd.Series) -> str:
+    """One line of statistics over a whole result column."""
+    total = len(series)
+    non_null = series.dropna()
+    null_rate = 1 - len(non_null) / total if total else 0.0
+    parts = [f"nulls {null_rate:.0%}"]
+
+    values = non_null.tolist()
+    if values and all(is_number(v) for v in values):
+        numbers = non_null.astype(float).to_numpy()
+        parts = [f"numeric: min {compact_value(numbers.min())}, max {compact_value(numbers.max())}, "
+                 f"mean {compact_value(numbers.mean())}, sum {compact_value(numbers.sum())}"] + parts
+    elif values and all(isinstance(v, (datetime.date, datetime.datetime)) for v in values):
+        dates = pd.to_datetime(non_null)
+        earliest, latest = dates.min().to_pydatetime(), dates.max().to_pydatetime()
+        if not any(isinstance(v, datetime.datetime) for v in values):
+            earliest, latest = earliest.date(), latest.date()
+        parts = [f"date: min {compact_value(earliest)}, max {compact_value(latest)}"] + parts
+    elif values:
+        counts = non_null.astype(str).value_counts()
+        top = ", ".join(f"{compact_value(value)} ({count})" for value, count in counts.head(TOP_CATEGORIES).items())
+        parts = [f"{len(counts)} distinct, top: {top}"] + parts
+
+    return f"- {name}: " + "; ".join(parts)
+
+
+def summarize_results(results: List[Dict[str, Any]], columns: List[str],
+                      token_budget: int = DEFAULT_TOKEN_BUDGET) -> str:
+    """
+    Encode a query result compactly for an LLM prompt.
+
+    The header lists the columns once and each row follows as pipe-separated
+    values, as many rows as fit in token_budget. When not every row fits,
+    per-column statistics over the whole result (min/max/mean/sum of numbers,
+    date ranges, top categories and null rates) come first, so the model
+    still sees the full result.
+    """
+    columns = columns or (list(results[0].keys()) if results else [])
+    if not results:
+        return "No rows."
+
+    header = f"{len(results)} rows; columns: {' | '.join(columns)}"
+    rows = [" | ".join(compact_value(row.get(column)) for column in columns) for row in results]
+
+    if estimate_tokens("\n".join([header] + rows)) <= token_budget:
+        return "\n".join([header] + rows)
+
+    frame = pd.DataFrame(results, columns=columns)
+    statistics = ["Statistics over all rows:"]
+    for column in columns:
+        line = column_statistics(column, frame[column])
+        # Keep at least half of the budget for sample rows
+        if estimate_tokens("\n".join([header] + statistics + [line])) > token_budget // 2:
+            statistics.append(f"- (statistics for {len(columns) - len(statistics) + 1} more columns omitted)")
+            break
+        statistics.append(line)
+
+    lines = [header] + statistics
+    used = estimate_tokens("\n".join(lines)) + 10
+    shown = []
+    for row in rows:
+        cost = estimate_tokens(row)
+        if used + cost > token_budget:
+            break
+        shown.append(row)
+        used += cost
+
+    lines.append(f"First {len(shown)} of {len(results)} rows:")
+    lines.extend(shown)
+    return "\n".join(lines)
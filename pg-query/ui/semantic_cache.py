@@ -0,0 +1,74 @@
+import os
+import time
+import sqlite3
+import threading
+from typing import List, Dict, Tuple
+
+DEFAULT_SEMANTIC_CACHE_PATH = os.getenv("SEMANTIC_CACHE_PATH", "/tmp/semantic_cache.db")
+
+# (table, column, data type)
+ColumnKey = Tuple[str, str, str]
+
+
+class SemanticCache:
+    """
+    Persistent cache of inferred column descriptions.
+
+    Entries are keyed by (table, column, data type, schema fingerprint, model),
+    so a description is reused until the schema or the model changes.
+    """
+
+    def __init__(self, path: str = DEFAULT_SEMANTIC_CACHE_PATH):
+        """Open (or create) the SQLite cache file."""
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS column_semantics (
+                table_name TEXT NOT NULL,
+                column_name TEXT NOT NULL,
+                data_type TEXT NOT NULL,
+                schema_fingerprint TEXT NOT NULL,
+                model TEXT NOT NULL,
+                description TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                PRIMARY KEY (table_name, column_name, data_type, schema_fingerprint, model)
+            )
+        """)
+        self._db.commit()
+
+    def get_many(self, columns: List[ColumnKey], schema_fingerprint: str, model: str) -> Dict[str, str]:
+        """Cached descriptions of the given columns, keyed by "table.column"."""
+        found = {}
+        with self._lock:
+            for table_name, column_name, data_type in columns:
+                row = self._db.execute("""
+                    SELECT description FROM column_semantics
+                    WHERE table_name = ? AND column_name = ? AND data_type = ?
+                      AND schema_fingerprint = ? AND model = ?
+                """, (table_name, column_name, data_type, schema_fingerprint, model)).fetchone()
+                if row:
+                    found[f"{table_name}.{column_name}"] = row[0]
+        return found
+
+    def put_many(self, descriptions: Dict[ColumnKey, str], schema_fingerprint: str, model: str):
+        """Store inferred descriptions."""
+        now = time.time()
+        with self._lock:
+            self._db.executemany("""
+                INSERT OR REPLACE INTO column_semantics
+                    (table_name, column_name, data_type, schema_fingerprint, model, description, created_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, [
+                (table_name, column_name, data_type, schema_fingerprint, model, description, now)
+                for (table_name, column_name, data_type), description in descriptions.items()
+            ])
+            self._db.commit()
+
+    def stats(self, schema_fingerprint: str) -> Dict[str, int]:
+        """Number of cached descriptions for a schema."""
+        with self._lock:
+            entries = self._db.execute(
+                "SELECT COUNT(*) FROM column_semantics WHERE schema_fingerprint = ?", (schema_fingerprint,)
+            ).fetchone()[0]
+        return {"entries": entries}
@@ -0,0 +1,226 @@
+import os
+import re
+import json
+import time
+import sqlite3
+import threading
+import numpy as np
+from typing import List, Dict, Any, Tuple, Optional, Callable
+
+DEFAULT_CACHE_PATH = os.getenv("SQL_CACHE_PATH", "/tmp/sql_cache.db")
+DEFAULT_SEED_PATH = os.getenv(
+    "SQL_CACHE_SEED_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "db", "query_example.json")
+)
+
+# Numbers, quoted strings and capitalised words (names such as 'Excavator' or Seattle)
+LITERAL_PATTERN = re.compile(r"\d+(?:[.,:/-]\d+)*|'[^']*'|\"[^\"]*\"|\b[A-Z][\w-]*")
+
+
+def question_literals(question: str) -> frozenset:
+    """
+    Values a question names, which its SQL hard-codes as literals.
+
+    Questions that differ only in such a value ("orders in 2023" and "orders
+    in 2024") embed almost identically but need different SQL. The first word
+    is skipped, as it is capitalised anyway.
+    """
+    text = question.strip()
+    literals = set()
+    for match in LITERAL_PATTERN.finditer(text):
+        if match.start() == 0 and match.group()[0].isupper():
+            continue
+        literals.add(match.group().strip("'\"").lower())
+    return frozenset(literals)
+
+
+class QuestionEmbedder:
+    """Lazily loaded sentence-transformers model for embedding questions."""
+
+    def __init__(self, model_name: str = "all-MiniLM-L6-v2"):
+        self.model_name = model_name
+        self.model = None
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        """Return L2-normalized float32 embeddings, one row per text."""
+        if self.model is None:
+            from sentence_transformers import SentenceTransformer
+            self.model = SentenceTransformer(self.model_name, device="cpu")
+        return np.asarray(self.model.encode(texts, normalize_embeddings=True), dtype=np.float32)
+
+
+class SQLCache:
+    """
+    Persistent cache mapping (question embedding, schema fingerprint) to validated SQL.
+
+    A lookup returns the cached SQL when the closest cached question is at least
+    hit_threshold similar and names the same values (numbers, quoted strings,
+    capitalised words), and questions between suggest_threshold and
+    hit_threshold, or close ones naming other values, as "did you mean"
+    suggestions.
+    """
+
+    def __init__(self,
+                 path: str = DEFAULT_CACHE_PATH,
+                 embedder: Optional[QuestionEmbedder] = None,
+                 hit_threshold: float = 0.92,
+                 suggest_threshold: float = 0.75):
+        """Open (or create) the SQLite cache file."""
+        self.path = path
+        self.embedder = embedder or QuestionEmbedder()
+        self.hit_threshold = hit_threshold
+        self.suggest_threshold = suggest_threshold
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS sql_cache (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                schema_fingerprint TEXT NOT NULL,
+                question TEXT NOT NULL,
+                sql_query TEXT NOT NULL,
+                embedding BLOB NOT NULL,
+                source TEXT NOT NULL,
+                hits INTEGER NOT NULL DEFAULT 0,
+                created_at REAL NOT NULL,
+                UNIQUE (schema_fingerprint, question)
+            )
+        """)
+        self._db.commit()
+
+        # Embedding matrices per schema fingerprint, loaded on first use
+        self._index = {}
+
+    def _load_index(self, schema_fingerprint: str) -> Dict[str, Any]:
+        """Load the embeddings of one schema into memory."""
+        if schema_fingerprint not in self._index:
+            rows = self._db.execute(
+                "SELECT id, question, sql_query, embedding FROM sql_cache WHERE schema_fingerprint = ?",
+                (schema_fingerprint,)
+            ).fetchall()
+            entries = [{"id": row[0], "question": row[1], "sql_query": row[2]} for row in rows]
+            if rows:
+                matrix = np.vstack([np.frombuffer(row[3], dtype=np.float32) for row in rows])
+            else:
+                matrix = np.zeros((0, 0), dtype=np.float32)
+            self._index[schema_fingerprint] = {"entries": entries, "matrix": matrix}
+        return self._index[schema_fingerprint]
+
+    def lookup(self, question: str, schema_fingerprint: str,
+               hit_threshold: Optional[float] = None,
+               suggest_threshold: Optional[float] = None,
+               max_suggestions: int = 3) -> Tuple[Optional[Dict[str, Any]], List[Dict[str, Any]]]:
+        """
+        Find cached SQL for a question.
+
+        The thresholds default to the ones the cache was created with.
+
+        Returns:
+            Tuple of (hit, suggestions). hit is the matching entry or None; each
+            entry is a dict with id, question, sql_query and similarity.
+        """
+        with self._lock:
+            if not self._load_index(schema_fingerprint)["entries"]:
+                return None, []
+
+        embedding = self.embedder.embed([question.strip()])[0]
+
+        with self._lock:
+            index = self._load_index(schema_fingerprint)
+            similarities = index["matrix"] @ embedding
+            order = np.argsort(-similarities)
+
+            matches = []
+            for i in order[:max_suggestions + 1]:
+                entry = dict(index["entries"][i])
+                entry["similarity"] = float(similarities[i])
+                matches.append(entry)
+
+        hit_threshold = self.hit_threshold if hit_threshold is None else hit_threshold
+        suggest_threshold = self.suggest_threshold if suggest_threshold is None else suggest_threshold
+
+        if matches[0]["similarity"] >= hit_threshold:
+            if question_literals(matches[0]["question"]) == question_literals(question):
+                self.record_hit(matches[0]["id"])
+                return matches[0], []
+            # Its SQL would answer the question with the other question's values
+            matches[0]["literal_mismatch"] = True
+
+        suggestions = [m for m in matches if m["similarity"] >= suggest_threshold]
+        return None, suggestions[:max_suggestions]
+
+    def add(self, question: str, sql_query: str, schema_fingerprint: str, source: str = "execution"):
+        """Store SQL that executed successfully for a question."""
+        question = question.strip()
+        embedding = self.embedder.embed([question])[0]
+
+        with self._lock:
+            self._db.execute("""
+                INSERT INTO sql_cache (schema_fingerprint, question, sql_query, embedding, source, created_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (schema_fingerprint, question)
+                DO UPDATE SET sql_query = excluded.sql_query, embedding = excluded.embedding,
+                              source = excluded.source
+            """, (schema_fingerprint, question, sql_query, embedding.tobytes(), source, time.time()))
+            self._db.commit()
+            # Reload this schema's index on next lookup
+            self._index.pop(schema_fingerprint, None)
+
+    def invalidate(self, entry_id: int):
+        """Remove an entry whose SQL no longer validates or executes, so it is not reused again."""
+        with self._lock:
+            self._db.execute("DELETE FROM sql_cache WHERE id = ?", (entry_id,))
+            self._db.commit()
+            # The entry may be in any schema's index; reload them on next lookup
+            self._index.clear()
+
+    def record_hit(self, entry_id: int):
+        """Count a cache hit for an entry."""
+        with self._lock:
+            self._db.execute("UPDATE sql_cache SET hits = hits + 1 WHERE id = ?", (entry_id,))
+            self._db.commit()
+
+    def seed_from_examples(self,
+                           schema_fingerprint: str,
+                           validate: Callable[[str], Tuple[bool, str]],
+                           seed_path: str = DEFAULT_SEED_PATH) -> int:
+        """
+        Seed the cache from a query_example.json style file of {"title", "query"} entries.
+
+        Only queries that pass validate (e.g. an EXPLAIN against the database) are
+        added, and only once per schema fingerprint. Returns the number of entries added.
+        """
+        if not os.path.exists(seed_path):
+            print(f"SQL cache seed file not found: {seed_path}")
+            return 0
+
+        with self._lock:
+            already_seeded = self._db.execute(
+                "SELECT COUNT(*) FROM sql_cache WHERE schema_fingerprint = ? AND source = 'seed'",
+                (schema_fingerprint,)
+            ).fetchone()[0]
+        if already_seeded:
+            return 0
+
+        with open(seed_path) as f:
+            examples = json.load(f)
+
+        added = 0
+        for example in examples:
+            valid, message = validate(example["query"])
+            if not valid:
+                print(f"Skipping seed query '{example['title']}': {message}")
+                continue
+            self.add(example["title"], example["query"], schema_fingerprint, source="seed")
+            added += 1
+
+        return added
+
+    def stats(self, schema_fingerprint: str) -> Dict[str, int]:
+        """Return entry and hit counts for a schema."""
+        with self._lock:
+            entries, hits = self._db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(hits), 0) FROM sql_cache WHERE schema_fingerprint = ?",
+                (schema_fingerprint,)
+            ).fetchone()
+        return {"entries": entries, "hits": hits}
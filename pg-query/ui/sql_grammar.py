@@ -0,0 +1,126 @@
+import re
+import json
+from typing import List, Dict, Any
+
+# Functions the grammar allows; anything else has to be written another way
+SQL_FUNCTIONS = [
+    "COUNT", "SUM", "AVG", "MIN", "MAX", "COALESCE", "NULLIF", "ROUND", "ABS", "CEIL", "FLOOR",
+    "LOWER", "UPPER", "TRIM", "LENGTH", "CONCAT", "SUBSTRING", "STRING_AGG", "ARRAY_AGG",
+    "DATE_TRUNC", "DATE_PART", "AGE", "TO_CHAR", "NOW", "GREATEST", "LEAST",
+    "ROW_NUMBER", "RANK", "DENSE_RANK", "LAG", "LEAD",
+]
+
+SQL_TYPES = ["INTEGER", "BIGINT", "NUMERIC", "DECIMAL", "FLOAT", "TEXT", "VARCHAR", "DATE", "TIMESTAMP", "INTERVAL", "BOOLEAN"]
+
+DATE_FIELDS = ["YEAR", "QUARTER", "MONTH", "WEEK", "DAY", "DOW", "HOUR", "MINUTE", "EPOCH"]
+
+# Everything except the table and column names, which are filled in from the schema.
+# Keywords are upper case and aliases lower case, so an alias can never swallow a keyword.
+SQL_GRAMMAR_RULES = r"""
+root ::= select-stmt ";"
+
+select-stmt ::= "SELECT" ws ("DISTINCT" ws)? select-list ws "FROM" ws from-list join-clause* where-clause? group-clause? having-clause? order-clause? limit-clause?
+
+select-list ::= select-item (ows "," ows select-item)*
+select-item ::= "*" | alias "." "*" | expr (ws "AS" ws alias)?
+
+from-list ::= table-ref (ows "," ows table-ref)*
+table-ref ::= table-name (ws ("AS" ws)? alias)? | "(" ows select-body ows ")" ws ("AS" ws)? alias
+select-body ::= "SELECT" ws ("DISTINCT" ws)? select-list ws "FROM" ws from-list join-clause* where-clause? group-clause? having-clause? order-clause? limit-clause?
+
+join-clause ::= ws (join-type ws)? "JOIN" ws table-ref ws "ON" ws expr
+join-type ::= "INNER" | "LEFT" | "LEFT OUTER" | "RIGHT" | "RIGHT OUTER" | "FULL" | "FULL OUTER" | "CROSS"
+
+where-clause ::= ws "WHERE" ws expr
+group-clause ::= ws "GROUP BY" ws group-item (ows "," ows group-item)*
+group-item ::= expr | alias
+having-clause ::= ws "HAVING" ws expr
+order-clause ::= ws "ORDER BY" ws order-item (ows "," ows order-item)*
+order-item ::= (expr | alias) (ws ("ASC" | "DESC"))? (ws "NULLS" ws ("FIRST" | "LAST"))?
+limit-clause ::= ws "LIMIT" ws number (ws "OFFSET" ws number)?
+
+expr ::= and-expr (ws "OR" ws and-expr)*
+and-expr ::= not-expr (ws "AND" ws not-expr)*
+not-expr ::= ("NOT" ws)? predicate
+predicate ::= sum predicate-tail?
+predicate-tail ::= (
+    ows comp-op ows sum
+  | ws "IS" ws ("NOT" ws)? ("NULL" | "TRUE" | "FALSE")
+  | ws ("NOT" ws)? ("ILIKE" | "LIKE") ws sum
+  | ws ("NOT" ws)? "IN" ows "(" ows (select-body | expr-list) ows ")"
+  | ws ("NOT" ws)? "BETWEEN" ws sum ws "AND" ws sum
+)
+comp-op ::= "=" | "<>" | "!=" | "<=" | ">=" | "<" | ">"
+
+sum ::= product (ows ("+" | "-" | "||") ows product)*
+product ::= unary (ows ("*" | "/" | "%") ows unary)*
+unary ::= "-"? primary ("::" type-name)?
+
+primary ::= (
+    column-ref
+  | literal
+  | function-call
+  | extract-call
+  | case-expr
+  | "EXISTS" ows "(" ows select-body ows ")"
+  | "(" ows select-body ows ")"
+  | "(" ows expr ows ")"
+)
+
+function-call ::= function-name "(" ows (("DISTINCT" ws)? expr-list | "*")? ows ")" over-clause?
+over-clause ::= ws "OVER" ows "(" ows ("PARTITION BY" ws expr-list)? ows ("ORDER BY" ws order-item (ows "," ows order-item)*)? ows ")"
+extract-call ::= "EXTRACT(" date-field ws "FROM" ws expr ")"
+case-expr ::= "CASE" (ws "WHEN" ws expr ws "THEN" ws expr)+ (ws "ELSE" ws expr)? ws "END"
+expr-list ::= expr (ows "," ows expr)*
+
+column-ref ::= (alias ".")? column-name
+literal ::= string | number | "TRUE" | "FALSE" | "NULL" | "CURRENT_DATE" | "CURRENT_TIMESTAMP" | ("DATE" | "TIMESTAMP" | "INTERVAL") ws string
+string ::= "'" ([^'\n] | "''")* "'"
+number ::= [0-9]+ ("." [0-9]+)?
+
+alias ::= [a-z_] [a-z0-9_]*
+ws ::= [ \t\n]+
+ows ::= [ \t\n]*
+"""
+
+
+def gbnf_literal(text: str) -> str:
+    """Quote a string as a GBNF literal."""
+    return json.dumps(text, ensure_ascii=False)
+
+
+def sql_identifier(name: str) -> str:
+    """Write an identifier the way it has to appear in PostgreSQL SQL."""
+    if re.fullmatch(r'[a-z_][a-z0-9_]*', name):
+        return name
+    return '"' + name.replace('"', '""') + '"'
+
+
+def gbnf_alternatives(values: List[str]) -> str:
+    """A GBNF alternation of literal strings, longest first."""
+    return " | ".join(gbnf_literal(value) for value in sorted(set(values), key=lambda v: (-len(v), v)))
+
+
+def build_sql_grammar(schema_info: Dict[str, Any]) -> str:
+    """
+    Build a llama.cpp GBNF grammar that only admits one SELECT statement over the schema.
+
+    Table and column names are restricted to the ones in DatabaseAnalyzer.schema_info;
+    aliases are free lower-case identifiers. The statement must end with a semicolon,
+    after which the grammar is complete and generation stops.
+    """
+    tables = [sql_identifier(table_name) for table_name in schema_info["tables"]]
+    columns = [
+        sql_identifier(column["name"])
+        for table_info in schema_info["tables"].values()
+        for column in table_info["columns"]
+    ]
+
+    schema_rules = (
+        f"table-name ::= {gbnf_alternatives(tables)}\n"
+        f"column-name ::= {gbnf_alternatives(columns)}\n"
+        f"function-name ::= {gbnf_alternatives(SQL_FUNCTIONS + [name.lower() for name in SQL_FUNCTIONS])}\n"
+        f"type-name ::= {gbnf_alternatives(SQL_TYPES)}\n"
+        f"date-field ::= {gbnf_alternatives(DATE_FIELDS)}\n"
+    )
+    return SQL_GRAMMAR_RULES.strip() + "\n\n" + schema_rules
@@ -0,0 +1,273 @@
+import difflib
+import sqlglot
+import sqlglot.expressions as exp
+from sqlglot.errors import ParseError
+from sqlglot.optimizer.scope import Scope, traverse_scope
+from typing import List, Dict, Any, Optional, Tuple
+
+
+def normalize_identifier(identifier: exp.Expression) -> str:
+    """Fold an unquoted identifier to lower case the way PostgreSQL does."""
+    if isinstance(identifier, exp.Identifier) and identifier.quoted:
+        return identifier.name
+    return identifier.name.lower()
+
+
+class SQLValidator:
+    """
+    Validate SQL locally against the schema collected by DatabaseAnalyzer.
+
+    Tables, aliases and columns are resolved against schema_info without
+    touching the database, and join conditions are checked against the
+    foreign key relationships.
+    """
+
+    def __init__(self, schema_info: Dict[str, Any]):
+        """Build column and relationship lookups from DatabaseAnalyzer.schema_info."""
+        self.columns = {
+            table_name: {column["name"]: column["type"] for column in table_info["columns"]}
+            for table_name, table_info in schema_info.get("tables", {}).items()
+        }
+        self.relationships = schema_info.get("relationships", [])
+
+        # Both directions of every foreign key, and what each foreign key column points at
+        self.join_keys = set()
+        self.references = {}
+        for rel in self.relationships:
+            source = (rel["table"], rel["column"])
+            target = (rel["references_table"], rel["references_column"])
+            self.join_keys.add((source, target))
+            self.join_keys.add((target, source))
+            self.references[source] = target
+
+    def validate(self, sql: str) -> Dict[str, Any]:
+        """
+        Validate a SQL statement.
+
+        Returns:
+            Dictionary with "valid" (no errors found), "errors" (problems PostgreSQL
+            would reject), "warnings" (suspicious but legal constructs such as joins
+            that do not follow a foreign key) and "tables" (schema tables referenced)
+        """
+        result = {"valid": True, "errors": [], "warnings": [], "tables": []}
+
+        try:
+            statements = [s for s in sqlglot.parse(sql, read="postgres") if s is not None]
+        except ParseError as e:
+            messages = [error.get("description", str(e)) for error in e.errors] or [str(e)]
+            result["errors"].append(f"Syntax error: {messages[0]}")
+            result["valid"] = False
+            return result
+
+        if len(statements) != 1:
+            result["errors"].append(f"Expected exactly one SQL statement, found {len(statements)}")
+            result["valid"] = False
+            return result
+
+        statement = statements[0]
+        tables = set()
+
+        scopes = traverse_scope(statement)
+        if scopes:
+            for scope in scopes:
+                self._check_scope(scope, result, tables)
+        else:
+            # Not a query sqlglot can scope (e.g. INSERT ... VALUES); check the tables only
+            for table in statement.find_all(exp.Table):
+                self._check_table(table, result, tables)
+
+        result["tables"] = sorted(tables)
+        result["errors"] = list(dict.fromkeys(result["errors"]))
+        result["warnings"] = list(dict.fromkeys(result["warnings"]))
+        result["valid"] = not result["errors"]
+        return result
+
+    def _check_table(self, table: exp.Table, result: Dict[str, Any], tables: set) -> Optional[str]:
+        """Check that a table exists; return its name, or None if it cannot be checked."""
+        if not isinstance(table.this, exp.Identifier):
+            # Table functions such as generate_series()
+            return None
+        if table.db and table.db.lower() != "public":
+            # System catalogs and other schemas are not part of schema_info
+            return None
+
+        table_name = normalize_identifier(table.this)
+        if table_name not in self.columns:
+            message = f"Table '{table_name}' does not exist"
+            suggestion = difflib.get_close_matches(table_name, self.columns.keys(), n=1)
+            if suggestion:
+                message += f"; did you mean '{suggestion[0]}'?"
+            result["errors"].append(message)
+            return None
+
+        tables.add(table_name)
+        return table_name
+
+    def _resolve_sources(self, scope: Scope, result: Dict[str, Any], tables: set) -> Dict[str, Any]:
+        """
+        Map every name visible in a scope to a schema table name, a set of
+        derived column names, or None for sources whose columns are unknown.
+        Names from enclosing scopes are included for correlated subqueries.
+        """
+        resolved = {}
+        current = scope
+        while current is not None:
+            for name, source in current.sources.items():
+                if name in resolved:
+                    continue
+                if isinstance(source, exp.Table):
+                    if current is scope:
+                        resolved[name] = self._check_table(source, result, tables)
+                    else:
+                        resolved[name] = self._table_name(source)
+                elif isinstance(source, Scope) and isinstance(source.expression, (exp.Select, exp.SetOperation)):
+                    selects = source.expression.named_selects
+                    resolved[name] = None if "*" in selects else set(selects)
+                else:
+                    resolved[name] = None
+            current = current.parent
+        return resolved
+
+    def _table_name(self, table: exp.Table) -> Optional[str]:
+        """Name of a schema table, or None if it is not one."""
+        if not isinstance(table.this, exp.Identifier):
+            return None
+        table_name = normalize_identifier(table.this)
+        return table_name if table_name in self.columns else None
+
+    def _resolve_column(self, column: exp.Column, scope: Scope,
+                        sources: Dict[str, Any]) -> Tuple[Optional[Tuple[str, str]], Optional[str]]:
+        """
+        Resolve a column reference.
+
+        Returns:
+            Tuple of ((table, column) if it belongs to a schema table, error message or None)
+        """
+        column_name = normalize_identifier(column.this) if isinstance(column.this, exp.Identifier) else None
+        if column_name is None:
+            return None, None
+
+        qualifier = column.table
+        if qualifier:
+            if qualifier not in sources:
+                return None, f"Unknown table or alias '{qualifier}' in '{column.sql(dialect='postgres')}'"
+            source = sources[qualifier]
+            if isinstance(source, str):
+                if column_name not in self.columns[source]:
+                    return None, self._missing_column_message(column_name, qualifier, [source])
+                return (source, column_name), None
+            if isinstance(source, set) and column_name not in source:
+                return None, f"Column '{column_name}' is not an output of subquery '{qualifier}'"
+            return None, None
+
+        # Output aliases can be referenced from ORDER BY / GROUP BY / HAVING
+        if isinstance(scope.expression, exp.Select):
+            aliases = {e.alias.lower() for e in scope.expression.expressions if isinstance(e, exp.Alias)}
+            if column_name in aliases:
+                return None, None
+
+        local_sources = {name: sources[name] for name in scope.sources if name in sources}
+        owners = []
+        for source in local_sources.values():
+            if source is None:
+                return None, None
+            if isinstance(source, str) and column_name in self.columns[source]:
+                owners.append(source)
+            elif isinstance(source, set) and column_name in source:
+                owners.append(source)
+
+        table_owners = [owner for owner in owners if isinstance(owner, str)]
+        if len(owners) > 1:
+            if len(set(table_owners)) == len(table_owners) and len(table_owners) > 1:
+                return None, (f"Column reference '{column_name}' is ambiguous; it exists in "
+                              f"{', '.join(sorted(table_owners))}. Qualify it with a table alias")
+            return None, None
+        if owners:
+            return ((owners[0], column_name) if table_owners else None), None
+
+        # Correlated reference to an enclosing query
+        for name, source in sources.items():
+            if name in local_sources:
+                continue
+            if source is None or (isinstance(source, set) and column_name in source):
+                return None, None
+            if isinstance(source, str) and column_name in self.columns[source]:
+                return (source, column_name), None
+
+        schema_tables = sorted({source for source in local_sources.values() if isinstance(source, str)})
+        if not schema_tables and not local_sources:
+            return None, None
+        return None, self._missing_column_message(column_name, None, schema_tables)
+
+    def _missing_column_message(self, column_name: str, qualifier: Optional[str], table_names: List[str]) -> str:
+        """Error message for a column that does not exist, with the closest match if any."""
+        reference = f"{qualifier}.{column_name}" if qualifier else column_name
+        message = f"Column '{reference}' does not exist in {', '.join(table_names) or 'the referenced tables'}"
+
+        candidates = {}
+        for table_name in table_names:
+            for name in self.columns[table_name]:
+                candidates.setdefault(name, table_name)
+        suggestion = difflib.get_close_matches(column_name, candidates.keys(), n=1)
+        if suggestion:
+            message += f"; did you mean '{candidates[suggestion[0]]}.{suggestion[0]}'?"
+        return message
+
+    def _check_scope(self, scope: Scope, result: Dict[str, Any], tables: set):
+        """Check the tables, columns and join conditions of a single query scope."""
+        sources = self._resolve_sources(scope, result, tables)
+
+        resolved_columns = {}
+        for column in scope.columns:
+            # sqlglot also lists columns of nested subqueries; those are checked in their own scope
+            if column.find_ancestor(exp.Select) is not scope.expression and isinstance(scope.expression, exp.Select):
+                continue
+            resolved, error = self._resolve_column(column, scope, sources)
+            if error:
+                result["errors"].append(error)
+            resolved_columns[id(column)] = resolved
+
+        if isinstance(scope.expression, exp.Select):
+            for join in scope.expression.args.get("joins") or []:
+                condition = join.args.get("on")
+                if condition is not None:
+                    self._check_join_condition(condition, resolved_columns, result)
+
+    def _check_join_condition(self, condition: exp.Expression,
+                              resolved_columns: Dict[int, Optional[Tuple[str, str]]],
+                              result: Dict[str, Any]):
+        """Warn about equality joins between tables that do not follow a foreign key."""
+        for equality in condition.find_all(exp.EQ):
+            left, right = equality.left, equality.right
+            if not isinstance(left, exp.Column) or not isinstance(right, exp.Column):
+                continue
+            left_key = resolved_columns.get(id(left))
+            right_key = resolved_columns.get(id(right))
+            if not left_key or not right_key or left_key[0] == right_key[0]:
+                continue
+            if (left_key, right_key) in self.join_keys:
+                continue
+            # Two foreign keys to the same column, e.g. payments.rental_id = rental_items.rental_id
+            if left_key in self.references and self.references.get(left_key) == self.references.get(right_key):
+                continue
+
+            message = (f"Join condition '{equality.sql(dialect='postgres')}' does not follow a foreign key "
+                       f"between {left_key[0]} and {right_key[0]}")
+            known = [
+                f"{rel['table']}.{rel['column']} = {rel['references_table']}.{rel['references_column']}"
+                for rel in self.relationships
+                if {rel["table"], rel["references_table"]} == {left_key[0], right_key[0]}
+            ]
+            if known:
+                message += f"; known keys: {', '.join(known)}"
+            result["warnings"].append(message)
+
+    def related_tables(self, tables: List[str]) -> List[str]:
+        """The given tables plus every table directly linked to them by a foreign key."""
+        related = set(tables)
+        for rel in self.relationships:
+            if rel["table"] in tables:
+                related.add(rel["references_table"])
+            if rel["references_table"] in tables:
+                related.add(rel["table"])
+        return sorted(related)
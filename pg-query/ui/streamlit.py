@@ -4,12 +4,24 @@ import time
 import json
 import re
 import asyncio
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Tuple
 
 # Import our modified module
 from database_analyzer import DatabaseAnalyzer
-from llama_interface import LlamaInterface
+from llama_interface import LlamaInterface, build_sql_prompt, build_sql_prompt_prefix
+from llm_backends import LlamaBackendPool, AdmissionError
+from model_routing import ModelRouter, DEFAULT_ROUTING_CONFIG, EXAMPLE_ROUTING_CONFIG, load_routing_config
 from utils import extract_sql_from_response
+from sql_cache import SQLCache
+from sql_validator import SQLValidator
+from sql_grammar import build_sql_grammar
+from result_explainer import explain_trivial_result
+from result_summary import summarize_results, DEFAULT_TOKEN_BUDGET
+from llm_semantic_analyzer import LLMSemanticAnalyzer, SemanticInferenceJob
+from semantic_cache import SemanticCache
+
+# Targeted repair prompts to try when local validation finds errors
+MAX_SQL_REPAIR_ATTEMPTS = 1
 
 # Set page config
 st.set_page_config(
@@ -18,6 +30,36 @@ st.set_page_config(
     layout="wide"
 )
 
+@st.cache_resource
+def get_sql_cache():
+    """Question-to-SQL cache shared by all sessions."""
+    return SQLCache()
+
+
+@st.cache_resource
+def get_semantic_cache():
+    """Inferred column descriptions shared by all sessions."""
+    return SemanticCache()
+
+
+@st.cache_resource
+def get_llm_backend_pool(endpoints: Tuple[str, ...]):
+    """llama-server load balancer shared by all sessions using the same endpoints."""
+    return LlamaBackendPool(list(endpoints))
+
+
+@st.cache_resource
+def get_model_router(routing_config: str):
+    """Per-task model routing shared by all sessions using the same configuration."""
+    return ModelRouter.from_config(load_routing_config(routing_config), get_llm_backend_pool)
+
+
+def choose_cached_sql(entry: Dict[str, Any]):
+    """Callback for a "did you mean" suggestion: answer with its cached SQL."""
+    get_sql_cache().record_hit(entry['id'])
+    st.session_state['cached_sql_choice'] = entry
+
+
 def main():
     st.title("SQL Assistant")
     st.write("Ask questions about your PostgreSQL database in plain English")
@@ -43,15 +85,45 @@ def main():
     llama_host = st.sidebar.text_input("LLM Runtime API Host", "textsql-service")
     llama_port = st.sidebar.text_input("LLM Runtime API Port", "8080")
 
+    extra_llm_endpoints = st.sidebar.text_area(
+        "Additional LLM Runtime endpoints (host:port, one per line)", "",
+        help="Requests are balanced across all endpoints by free server slots; failing endpoints are skipped for a while.")
+
+    with st.sidebar.expander("Model Routing"):
+        routing_config = st.text_area(
+            "Per-task routing (JSON)", DEFAULT_ROUTING_CONFIG, height=150,
+            help="Maps tasks (sql, explanation, error_analysis, background) to model tiers, fallback tiers "
+                 "and sampling parameters. Leave empty to send every task to the endpoints above. Example:\n"
+                 + json.dumps(EXAMPLE_ROUTING_CONFIG))
+
+    pin_llm_slot = st.sidebar.checkbox("Pin SQL generation to a server slot", value=True,
+                                       help="Keeps the schema prompt in one llama-server slot's KV cache.")
+    warm_llm_cache = st.sidebar.checkbox("Pre-warm the schema prompt after connecting", value=True)
+
     # Initialize LLM button
     if st.sidebar.button("Initialize LLM Runtime Interface"):
         with st.spinner("Initializing LLM Runtime interface..."):
             try:
                 # Initialize the LLM Runtime interface
-                llama_interface = LlamaInterface(
-                    host=llama_host,
-                    port=llama_port
-                )
+                endpoints = [f"{llama_host}:{llama_port}"] + [
+                    line.strip() for line in extra_llm_endpoints.splitlines() if line.strip()
+                ]
+                if routing_config.strip():
+                    llama_interface = LlamaInterface(
+                        host=llama_host,
+                        port=llama_port,
+                        model_router=get_model_router(routing_config.strip())
+                    )
+                else:
+                    llama_interface = LlamaInterface(
+                        host=llama_host,
+                        port=llama_port,
+                        backend_pool=get_llm_backend_pool(tuple(dict.fromkeys(endpoints)))
+                    )
+
+                # Pin this session's SQL generation to one llama-server slot
+                if pin_llm_slot:
+                    llama_interface.assign_slot()
 
                 # Store in session state
                 st.session_state['llama_interface'] = llama_interface
@@ -69,6 +141,42 @@ def main():
     db_user = st.sidebar.text_input("Username")
     db_password = st.sidebar.text_input("Password", type="password")
 
+    # Optional read replicas for read-only queries
+    with st.sidebar.expander("Read Replicas"):
+        replica_dsns_text = st.text_area("Replica DSNs (one per line)", "",
+                                         placeholder="host=rentalco-replica port=5432")
+        replica_strategy = st.selectbox("Balancing", ["round_robin", "least_busy"])
+        max_replica_lag = st.number_input("Max Replica Lag (seconds)", min_value=0.0, value=30.0, step=5.0)
+    replica_dsns = [line.strip() for line in replica_dsns_text.splitlines() if line.strip()]
+
+    # Grammar-constrained generation: the model can only emit one SELECT over real tables/columns
+    use_sql_grammar = st.sidebar.checkbox("Constrain SQL generation with a grammar", value=False,
+                                          help="Sends a GBNF grammar built from the schema to llama-server. "
+                                               "Only single SELECT statements without CTEs can be generated.")
+
+    # Concurrent candidates use separate llama-server slots; the first valid query wins
+    sql_candidates = st.sidebar.number_input("Parallel SQL candidates", min_value=1, max_value=8, value=1,
+                                             help="Generate several queries at once with different seeds and "
+                                                  "temperatures, and use the first one that passes validation.")
+
+    fast_explanations = st.sidebar.checkbox("Answer simple results without the LLM", value=True,
+                                            help="Empty results, single values, single rows and short lists "
+                                                 "are answered directly from the result.")
+
+    explanation_token_budget = st.sidebar.number_input(
+        "Result tokens in the explanation prompt", min_value=100, max_value=4000, value=DEFAULT_TOKEN_BUDGET,
+        step=100, help="Results are sent as compact rows plus statistics over all rows, within this budget.")
+
+    # Question-to-SQL cache settings
+    with st.sidebar.expander("Question Cache"):
+        use_sql_cache = st.checkbox("Reuse SQL for known questions", value=True)
+        cache_hit_threshold = st.slider("Reuse similarity threshold", 0.80, 1.00, 0.92, 0.01)
+        cache_suggest_threshold = st.slider("\"Did you mean\" threshold", 0.50, 1.00, 0.75, 0.01)
+
+    infer_semantics = st.sidebar.checkbox("Describe uncommented columns with the LLM", value=True,
+                                          help="Runs in the background after connecting; descriptions are "
+                                               "added to the schema in the prompt as they arrive and cached.")
+
     # Connect button
     if st.sidebar.button("Connect to Database"):
         if not all([db_name, db_user, db_password]):
@@ -84,7 +192,10 @@ def main():
                         user=db_user,
                         password=db_password,
                         host=db_host,
-                        port=db_port
+                        port=db_port,
+                        replica_dsns=replica_dsns,
+                        max_replica_lag=max_replica_lag,
+                        replica_strategy=replica_strategy
                     )
 
                     # Try to connect
@@ -99,23 +210,90 @@ def main():
                             schema_description = db_analyzer.generate_schema_description()
                             schema_for_llm = db_analyzer.generate_schema_for_llm()
 
+                        # Seed the question cache with the validated example queries
+                        schema_fingerprint = db_analyzer.schema_fingerprint()
+                        if use_sql_cache:
+                            with st.spinner("Seeding question cache..."):
+                                try:
+                                    get_sql_cache().seed_from_examples(schema_fingerprint, db_analyzer.validate_query)
+                                except Exception as e:
+                                    st.sidebar.warning(f"Question cache unavailable: {str(e)}")
+
                         # Store components in session state
                         st.session_state['db_analyzer'] = db_analyzer
+                        st.session_state['schema_fingerprint'] = schema_fingerprint
+                        st.session_state['sql_validator'] = SQLValidator(schema_info)
+                        st.session_state['sql_grammar'] = build_sql_grammar(schema_info)
                         st.session_state['schema_description'] = schema_description
                         st.session_state['schema_for_llm'] = schema_for_llm
                         st.session_state['connected'] = True
 
                         st.sidebar.success("Successfully connected and analyzed the database schema!")
+
+                        # Fill in descriptions of uncommented columns in the background
+                        st.session_state['semantic_job'] = None
+                        st.session_state['semantics_version'] = 0
+                        if infer_semantics:
+                            job = SemanticInferenceJob(
+                                LLMSemanticAnalyzer(model_router=st.session_state['llama_interface'].model_router),
+                                db_analyzer,
+                                cache=get_semantic_cache()
+                            )
+                            if job.columns_info:
+                                st.session_state['semantic_job'] = job.start()
+
+                        # Evaluate the constant prompt prefix now, so the first question only prefills itself
+                        if warm_llm_cache:
+                            with st.spinner("Pre-warming the LLM prompt cache..."):
+                                try:
+                                    st.session_state['llama_interface'].warm_prompt_cache(
+                                        build_sql_prompt_prefix(schema_for_llm, grammar_mode=use_sql_grammar))
+                                except Exception as e:
+                                    st.sidebar.warning(f"Could not pre-warm the LLM prompt cache: {str(e)}")
                     else:
                         st.sidebar.error(message)
                 except Exception as e:
                     st.sidebar.error(f"Error: {str(e)}")
 
+    # KV-cache reuse reported by llama-server
+    if st.session_state['llm_initialized']:
+        with st.sidebar.expander("LLM Prompt Cache"):
+            st.json(st.session_state['llama_interface'].get_prompt_cache_report())
+
+        model_router = st.session_state['llama_interface'].model_router
+        if len(model_router.tiers) > 1:
+            with st.sidebar.expander("Model Routing Decisions"):
+                st.dataframe(pd.DataFrame(model_router.status()))
+
+        backend_pool = st.session_state['llama_interface'].backend_pool
+        if len(backend_pool.backends) > 1:
+            with st.sidebar.expander("LLM Backends"):
+                st.dataframe(pd.DataFrame(backend_pool.status()))
+        with st.sidebar.expander("LLM Request Queue"):
+            st.dataframe(pd.DataFrame(backend_pool.scheduler.status()))
+        if backend_pool.coalescer:
+            with st.sidebar.expander("LLM Request Coalescing"):
+                st.json(backend_pool.coalescer.status())
+
     # Option to view database schema
     if st.session_state.get('connected', False):
+        # Pick up column descriptions inferred since the last run
+        semantic_job = st.session_state.get('semantic_job')
+        if semantic_job and semantic_job.version != st.session_state.get('semantics_version'):
+            st.session_state['schema_for_llm'] = st.session_state['db_analyzer'].generate_schema_for_llm()
+            st.session_state['semantics_version'] = semantic_job.version
+        if semantic_job:
+            with st.sidebar.expander("Column Descriptions"):
+                st.json(semantic_job.status())
+
         with st.sidebar.expander("View Database Schema"):
             st.text(st.session_state.get('schema_description', "No schema description available"))
 
+        replica_router = st.session_state['db_analyzer'].replica_router
+        if replica_router:
+            with st.sidebar.expander("Replica Status"):
+                st.dataframe(pd.DataFrame(replica_router.status()))
+
     # Main area for question input
     st.header("Ask a Question")
 
@@ -133,8 +311,13 @@ def main():
         elif not st.session_state['connected']:
             st.info("Connect to a database to start asking questions.")
 
+    # A "did you mean" suggestion picked on the previous run
+    cached_choice = st.session_state.pop('cached_sql_choice', None)
+    if cached_choice:
+        question = cached_choice['question']
+
     # Process the question when submitted
-    if submit_button and question:
+    if (submit_button and question) or cached_choice:
         if not st.session_state['connected'] or not st.session_state['llm_initialized']:
             st.error("Please make sure the LLM Runtime interface is initialized and you're connected to a database.")
         else:
@@ -143,46 +326,114 @@ def main():
 
             with results_container:
                 try:
-                    with st.spinner("Generating SQL query with LLM..."):
-                        # Generate SQL with LLM using schema
-                        prompt = f"""
-You are an expert SQL query generator for PostgreSQL databases.
-Given the database schema below, generate a SQL query to answer the question.
-
-{st.session_state['schema_for_llm']}
-
-Question: {question}
-
-IMPORTANT GUIDELINES:
-1. Use appropriate joins based on the relationships defined in the schema.
-2. Ensure data types match when making comparisons.
-3. For date/time operations, use appropriate PostgreSQL functions.
-4. Provide only ONE query using triple backticks, not multiple options.
-
-REALLY IMPORTANT USE ILIKE STATEMENTS with % for everything that is text in the query
-
-Just the SQL Statement suffice, do not explain or send anything further
-"""
-                        raw_response = st.session_state['llama_interface'].get_llama_response(prompt)
-
-                        # Display the raw response in an expander for debugging
-                        with st.expander("Raw LLM Response", expanded=False):
-                            st.text(raw_response)
-
-                        # Extract SQL query from the response
-                        sql_query = extract_sql_from_response(raw_response)
-
-                        # Validate we got a proper SQL query
-                        if not sql_query:
-                            st.error("Failed to generate a valid SQL query. The LLM did not provide a query in the correct format (between triple backticks).")
-                            # Display the raw response for debugging
-                            with st.expander("Raw LLM Response", expanded=True):
-                                st.text(raw_response)
-                            st.stop()  # Stop execution if no valid query was found
-
-                        # Display the extracted SQL
+                    # Look the question up in the question-to-SQL cache first
+                    cache_hit = cached_choice
+                    cache_suggestions = []
+                    if not cache_hit and use_sql_cache:
+                        try:
+                            cache_hit, cache_suggestions = get_sql_cache().lookup(
+                                question, st.session_state['schema_fingerprint'],
+                                hit_threshold=cache_hit_threshold,
+                                suggest_threshold=cache_suggest_threshold)
+                        except Exception as e:
+                            st.warning(f"Question cache unavailable: {str(e)}")
+
+                    # Cached SQL that no longer passes the schema check is dropped, not reused
+                    if cache_hit:
+                        validation = st.session_state['sql_validator'].validate(cache_hit['sql_query'])
+                        if not validation['valid']:
+                            get_sql_cache().invalidate(cache_hit['id'])
+                            st.warning("Cached SQL for a similar question no longer matches the schema; "
+                                       "generating a new query.")
+                            cache_hit = None
+
+                    if cache_hit:
+                        sql_query = cache_hit['sql_query']
+                        st.info(f"Reusing the SQL of a known question: \"{cache_hit['question']}\" "
+                                f"(similarity {cache_hit['similarity']:.2f})")
                         st.subheader("Generated SQL Query")
                         st.code(sql_query, language="sql")
+                    else:
+                        if cache_suggestions:
+                            st.markdown("**Did you mean:**")
+                            for suggestion in cache_suggestions:
+                                # A close question naming other values is never reused without a click
+                                note = ", other values" if suggestion.get('literal_mismatch') else ""
+                                st.button(f"{suggestion['question']} ({suggestion['similarity']:.2f}{note})",
+                                          key=f"did_you_mean_{suggestion['id']}",
+                                          on_click=choose_cached_sql, args=(suggestion,))
+
+                        with st.spinner("Generating SQL query with LLM..."):
+                            sql_grammar = st.session_state['sql_grammar'] if use_sql_grammar else None
+
+                            # Generate SQL with LLM using schema; the question comes last so the
+                            # instructions and schema form a prefix llama-server keeps cached
+                            prompt = build_sql_prompt(st.session_state['schema_for_llm'], question,
+                                                      grammar_mode=bool(sql_grammar))
+                            if sql_candidates > 1:
+                                validator = st.session_state['sql_validator']
+                                db_analyzer = st.session_state['db_analyzer']
+
+                                def check_candidate(candidate_sql):
+                                    """Local schema check first, then EXPLAIN on the database."""
+                                    validation = validator.validate(candidate_sql)
+                                    if not validation['valid']:
+                                        return False, "; ".join(validation['errors'])
+                                    return db_analyzer.validate_query(candidate_sql)
+
+                                generation = st.session_state['llama_interface'].generate_sql_candidates(
+                                    prompt, sql_candidates, check_candidate, grammar=sql_grammar)
+                                raw_response = generation['raw_response']
+                                sql_query = generation['sql_query']
+
+                                with st.expander("SQL Candidates", expanded=False):
+                                    st.dataframe(pd.DataFrame(generation['attempts']))
+                            else:
+                                raw_response = st.session_state['llama_interface'].get_llama_response(
+                                    prompt, grammar=sql_grammar, stop_at_sql_block=not sql_grammar,
+                                    id_slot=st.session_state['llama_interface'].id_slot)
+
+                                # Extract SQL query from the response; grammar output is the query itself
+                                sql_query = raw_response.strip() if sql_grammar else extract_sql_from_response(raw_response)
+
+                            # Display the raw response in an expander for debugging
+                            with st.expander("Raw LLM Response", expanded=False):
+                                st.text(raw_response)
+
+                            # Validate we got a proper SQL query
+                            if not sql_query:
+                                st.error("Failed to generate a valid SQL query. The LLM did not provide a query in the correct format (between triple backticks).")
+                                # Display the raw response for debugging
+                                with st.expander("Raw LLM Response", expanded=True):
+                                    st.text(raw_response)
+                                st.stop()  # Stop execution if no valid query was found
+
+                            # Check the SQL against the cached schema before it reaches PostgreSQL
+                            validator = st.session_state['sql_validator']
+                            validation = validator.validate(sql_query)
+                            for attempt in range(MAX_SQL_REPAIR_ATTEMPTS):
+                                if validation['valid']:
+                                    break
+                                st.warning("Local validation found problems:\n\n" +
+                                           "\n".join(f"- {error}" for error in validation['errors']))
+                                with st.spinner("Repairing SQL query with LLM..."):
+                                    schema_excerpt = st.session_state['db_analyzer'].generate_schema_for_llm(
+                                        tables=validator.related_tables(validation['tables']) or None)
+                                    repaired_response = st.session_state['llama_interface'].repair_sql(
+                                        question, sql_query, validation['errors'], schema_excerpt, sql_grammar)
+                                    repaired_sql = (repaired_response.strip() if sql_grammar
+                                                    else extract_sql_from_response(repaired_response))
+                                if not repaired_sql:
+                                    break
+                                sql_query = repaired_sql
+                                validation = validator.validate(sql_query)
+
+                            for warning in validation['warnings']:
+                                st.caption(f"Warning: {warning}")
+
+                            # Display the extracted SQL
+                            st.subheader("Generated SQL Query")
+                            st.code(sql_query, language="sql")
 
                     # Execute the query
                     with st.spinner("Executing query..."):
@@ -199,21 +450,33 @@ Just the SQL Statement suffice, do not explain or send anything further
 
                             # Now execute the query
                             results, columns = st.session_state['db_analyzer'].execute_query(sql_query)
+                            st.caption(f"Served by: {st.session_state['db_analyzer'].last_query_backend}")
+
+                            # Empty, single-value and short list results are answered without the LLM
+                            explanation = explain_trivial_result(question, results, columns) if fast_explanations else None
+                            if explanation is not None:
+                                st.caption("Answered directly from the result")
 
                             # Generate explanation
-                            with st.spinner("Generating explanation with LLM..."):
-                                explanation_prompt = f"""
+                            if explanation is None:
+                                with st.spinner("Generating explanation with LLM..."):
+                                    explanation_prompt = f"""
 Question: {question}
 
 SQL Query: {sql_query}
 
-Results: {json.dumps(results[:10], indent=2, default=str)}
+Results:
+{summarize_results(results, columns, explanation_token_budget)}
 
 Provide a natural language explanation of these results that directly answers the original question.
 Keep your explanation clear, concise, and focused on what the user actually asked.
 If the results contain a lot of data, summarize the key points.
 """
-                                explanation = st.session_state['llama_interface'].get_llama_response(explanation_prompt)
+                                    try:
+                                        explanation = st.session_state['llama_interface'].get_llama_response(
+                                            explanation_prompt, request_class="explanation")
+                                    except AdmissionError as e:
+                                        explanation = f"No explanation available right now: {e}"
 
                             # Display explanation
                             st.subheader("Answer")
@@ -235,6 +498,13 @@ If the results contain a lot of data, summarize the key points.
                                         mime="text/csv"
                                     )
 
+                            # Remember SQL that worked for this question
+                            if use_sql_cache and not cache_hit:
+                                try:
+                                    get_sql_cache().add(question, sql_query, st.session_state['schema_fingerprint'])
+                                except Exception as e:
+                                    print(f"Could not cache SQL: {e}")
+
                             # Add to query history
                             st.session_state['query_history'].append({
                                 "question": question,
@@ -247,6 +517,13 @@ If the results contain a lot of data, summarize the key points.
                         except Exception as e:
                             st.error(f"Error executing the query: {str(e)}")
 
+                            # Do not reuse cached SQL that failed
+                            if cache_hit:
+                                try:
+                                    get_sql_cache().invalidate(cache_hit['id'])
+                                except Exception as cache_error:
+                                    print(f"Could not invalidate cached SQL: {cache_error}")
+
                             # Generate explanation for the error
                             with st.spinner("Analyzing the error with LLM..."):
                                 error_prompt = f"""
@@ -259,7 +536,11 @@ Error: {str(e)}
 Please explain what went wrong with this query in simple terms and suggest how to fix it.
 Be specific about any syntax errors or invalid references.
 """
-                                error_explanation = st.session_state['llama_interface'].get_llama_response(error_prompt)
+                                try:
+                                    error_explanation = st.session_state['llama_interface'].get_llama_response(
+                                        error_prompt, request_class="error_analysis")
+                                except AdmissionError as e:
+                                    error_explanation = f"No error analysis available right now: {e}"
 
                             st.subheader("Error Analysis")
                             st.write(error_explanation)
@@ -284,6 +565,14 @@ Be specific about any syntax errors or invalid references.
 
                                         st.success("Query executed successfully!")
 
+                                        if use_sql_cache:
+                                            try:
+                                                get_sql_cache().add(question, fixed_query,
+                                                                    st.session_state['schema_fingerprint'],
+                                                                    source="fixed")
+                                            except Exception as e:
+                                                print(f"Could not cache SQL: {e}")
+
                                         # Display results
                                         if results and columns:
                                             st.subheader("Query Results")
@@ -331,6 +620,7 @@ Be specific about any syntax errors or invalid references.
                     try:
                         # Execute the query
                         results, columns = st.session_state['db_analyzer'].execute_query(manual_query)
+                        st.caption(f"Served by: {st.session_state['db_analyzer'].last_query_backend}")
 
                         # Display results
                         st.success("Query executed successfully!")
@@ -33,3 +33,46 @@ def extract_sql_from_response(response: str) -> str:
     sql_query = re.sub(r'^sql\s+', '', sql_query)
 
     return sql_query
+
+
+# Statements that can only read data
+READ_ONLY_STATEMENTS = ("select", "with", "show", "explain", "values", "table")
+
+# Constructs that write or lock even inside an otherwise read-only statement,
+# e.g. data-modifying CTEs, SELECT ... INTO, row locks and sequence updates
+WRITE_PATTERN = re.compile(
+    r'\b(insert|update|delete|merge|truncate|into|nextval|setval|pg_advisory_\w*lock\w*)\b'
+    r'|\bfor\s+(no\s+key\s+update|key\s+share|share)\b',
+    re.IGNORECASE
+)
+
+
+def strip_sql_literals(query: str) -> str:
+    """Remove comments, string literals and quoted identifiers from a SQL query."""
+    query = re.sub(r'--[^\n]*', ' ', query)
+    query = re.sub(r'/\*.*?\*/', ' ', query, flags=re.DOTALL)
+    query = re.sub(r'\$(\w*)\$.*?\$\1\$', "''", query, flags=re.DOTALL)
+    query = re.sub(r"'(?:[^']|'')*'", "''", query)
+    query = re.sub(r'"(?:[^"]|"")*"', '""', query)
+    return query
+
+
+def is_read_only_query(query: str) -> bool:
+    """
+    Check whether a SQL query only reads data and can run on a read replica.
+
+    Anything that cannot be classified with certainty is treated as a write,
+    so it stays on the primary.
+    """
+    statements = [s.strip() for s in strip_sql_literals(query).split(';') if s.strip()]
+    if not statements:
+        return False
+
+    for statement in statements:
+        first_word = statement.split(None, 1)[0].lower().lstrip('(')
+        if first_word not in READ_ONLY_STATEMENTS:
+            return False
+        if WRITE_PATTERN.search(statement):
+            return False
+
+    return True
@@ -0,0 +1,222 @@
+import os
+import re
+import json
+import math
+import hashlib
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Optional, Tuple
+
+# Where lexical indexes are stored, one file per collection
+RAG_INDEX_DIR = os.getenv("RAG_INDEX_DIR", "/tmp/rag-index")
+# "hybrid" fuses BM25 with vector search, "dense" uses vector search only
+RAG_RETRIEVAL = os.getenv("RAG_RETRIEVAL", "hybrid")
+# Reciprocal rank fusion constant; larger values flatten the contribution of top ranks
+RRF_K = int(os.getenv("RAG_RRF_K", "60"))
+
+# Words, numbers and identifiers such as SG24-8513, ppc64le or /etc/hosts
+TOKEN_PATTERN = re.compile(r"[A-Za-z0-9]+(?:[._\-/][A-Za-z0-9]+)*")
+
+
+def lexical_terms(text: str) -> List[str]:
+    """Lowercased terms of a text; compound identifiers are indexed whole and by part."""
+    terms = []
+    for match in TOKEN_PATTERN.finditer(text):
+        token = match.group().lower()
+        terms.append(token)
+        parts = re.split(r"[._\-/]", token)
+        if len(parts) > 1:
+            terms.extend(part for part in parts if part)
+    return terms
+
+
+def document_key(doc) -> Tuple[str, str, str]:
+    """Identity of a chunk across the lexical and vector indexes."""
+    return (str(doc.metadata.get("source")), str(doc.metadata.get("page")), doc.page_content)
+
+
+def corpus_fingerprint(docs: List[Any]) -> str:
+    """Hash of chunk texts and metadata; changes whenever the corpus or the chunking does."""
+    digest = hashlib.sha256()
+    for doc in docs:
+        digest.update(json.dumps([doc.page_content, doc.metadata], sort_keys=True, default=str).encode("utf-8"))
+    return digest.hexdigest()
+
+
+class BM25Index:
+    """
+    In-process BM25 inverted index over document chunks.
+
+    Postings map each term to (chunk number, term frequency) pairs, so a query
+    only touches the chunks that contain one of its terms.
+    """
+
+    def __init__(self, docs: List[Any], postings: Dict[str, List[List[int]]], lengths: List[int],
+                 fingerprint: str, k1: float = 1.2, b: float = 0.75):
+        self.docs = docs
+        self.postings = postings
+        self.lengths = lengths
+        self.fingerprint = fingerprint
+        self.k1 = k1
+        self.b = b
+        self.average_length = sum(lengths) / len(lengths) if lengths else 0.0
+
+    @classmethod
+    def build(cls, docs: List[Any]) -> "BM25Index":
+        """Index LangChain documents."""
+        postings = defaultdict(list)
+        lengths = []
+        for number, doc in enumerate(docs):
+            terms = lexical_terms(doc.page_content)
+            lengths.append(len(terms))
+            for term, frequency in Counter(terms).items():
+                postings[term].append([number, frequency])
+        return cls(docs, dict(postings), lengths, corpus_fingerprint(docs))
+
+    def save(self, path: str):
+        """Write the index next to its collection."""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        data = {
+            "fingerprint": self.fingerprint,
+            "k1": self.k1,
+            "b": self.b,
+            "docs": [{"text": doc.page_content, "metadata": doc.metadata} for doc in self.docs],
+            "lengths": self.lengths,
+            "postings": self.postings,
+        }
+        temporary = path + ".tmp"
+        with open(temporary, "w") as file:
+            json.dump(data, file, default=str)
+        os.replace(temporary, path)
+
+    @classmethod
+    def load(cls, path: str, document_class) -> "BM25Index":
+        """Read an index written by save()."""
+        with open(path) as file:
+            data = json.load(file)
+        docs = [document_class(page_content=d["text"], metadata=d["metadata"]) for d in data["docs"]]
+        return cls(docs, data["postings"], data["lengths"], data["fingerprint"], data["k1"], data["b"])
+
+    @classmethod
+    def load_or_build(cls, path: str, docs: List[Any]) -> "BM25Index":
+        """Reuse the stored index if it was built from the same chunks, otherwise rebuild and store it."""
+        if docs and os.path.exists(path):
+            try:
+                index = cls.load(path, type(docs[0]))
+                if index.fingerprint == corpus_fingerprint(docs):
+                    return index
+            except (OSError, ValueError, KeyError) as e:
+                print(f"Ignoring unreadable lexical index {path}: {e}")
+        index = cls.build(docs)
+        index.save(path)
+        return index
+
+    def search(self, query: str, k: int, sources: Optional[List[str]] = None) -> List[Tuple[Any, float]]:
+        """The k best chunks for a query with their BM25 scores; sources restricts them to those documents."""
+        total = len(self.docs)
+        scores = defaultdict(float)
+        for term in set(lexical_terms(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (total - len(postings) + 0.5) / (len(postings) + 0.5))
+            for number, frequency in postings:
+                norm = self.k1 * (1 - self.b + self.b * self.lengths[number] / self.average_length)
+                scores[number] += idf * frequency * (self.k1 + 1) / (frequency + norm)
+        if sources is not None:
+            allowed = set(sources)
+            scores = {number: score for number, score in scores.items()
+                      if str(self.docs[number].metadata.get("source")) in allowed}
+        best = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+        return [(self.docs[number], score) for number, score in best]
+
+
+def reciprocal_rank_fusion(rankings: List[List[Tuple[Any, float]]], k: int = RRF_K) -> List[Tuple[Any, float]]:
+    """Merge ranked (document, score) lists; each list adds 1 / (k + rank) to a document's score."""
+    fused = {}
+    for ranking in rankings:
+        for rank, (doc, _) in enumerate(ranking, start=1):
+            key = document_key(doc)
+            if key not in fused:
+                fused[key] = [doc, 0.0]
+            fused[key][1] += 1.0 / (k + rank)
+    return sorted(((doc, score) for doc, score in fused.values()), key=lambda pair: pair[1], reverse=True)
+
+
+class HybridRetriever:
+    """
+    Dense vector search fused with BM25 keyword search.
+
+    Dense search finds paraphrases, BM25 finds exact names and identifiers
+    (model numbers, commands) that embeddings blur. Both run at the same time
+    on a small thread pool, so fusion costs no more than the slower of the two.
+    """
+
+    def __init__(self, vector_store, lexical_index: BM25Index, mode: str = RAG_RETRIEVAL,
+                 lexical_path: Optional[str] = None):
+        self.vector_store = vector_store
+        self.lexical_index = lexical_index
+        self.mode = mode
+        # Where the lexical index is saved again after documents change
+        self.lexical_path = lexical_path
+        self.executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="retrieval")
+
+    @property
+    def embeddings(self):
+        return self.vector_store.embedding_func
+
+    def search(self, question: str, k: int,
+               sources: Optional[List[str]] = None) -> Tuple[List[Tuple[Any, float]], Dict[str, int]]:
+        """
+        The k best chunks for a question.
+
+        Args:
+            question: The user's question
+            k: Number of chunks
+            sources: Only search the chunks of these documents (source metadata); all if None
+
+        Returns:
+            Tuple of (ranked (document, score) pairs, counts of dense/lexical/fused hits)
+        """
+        if self.mode != "hybrid" or self.lexical_index is None:
+            dense = self.vector_store.similarity_search_with_score(question, k=k, sources=sources)
+            return dense, {"dense": len(dense), "lexical": 0, "fused": len(dense)}
+
+        dense_future = self.executor.submit(self.vector_store.similarity_search_with_score, question, k=k,
+                                            sources=sources)
+        lexical_future = self.executor.submit(self.lexical_index.search, question, k, sources)
+        dense, lexical = dense_future.result(), lexical_future.result()
+        fused = reciprocal_rank_fusion([dense, lexical])[:k]
+        return fused, {"dense": len(dense), "lexical": len(lexical), "fused": len(fused)}
+
+    def documents(self) -> List[str]:
+        """Sources of the documents that can be searched."""
+        return self.vector_store.documents()
+
+    def chunk_vectors(self, docs: List[Any]) -> List[Optional[Any]]:
+        """Stored embeddings of found chunks, None where the vector store has none, so they need not be recomputed."""
+        return self.vector_store.chunk_vectors(docs)
+
+    def _replace_lexical(self, source: str, docs: List[Any]):
+        """Rebuild the lexical index with the chunks of one document replaced."""
+        if self.lexical_index is None:
+            return
+        kept = [doc for doc in self.lexical_index.docs if str(doc.metadata.get("source")) != source]
+        index = BM25Index.build(kept + docs)
+        if self.lexical_path:
+            index.save(self.lexical_path)
+        self.lexical_index = index
+
+    def remove_document(self, source: str):
+        """Stop searching one document."""
+        self.vector_store.remove_document(source)
+        self._replace_lexical(source, [])
+
+    def replace_document(self, source: str, docs: List[Any]):
+        """Search new chunks for one document, e.g. after its PDF changed."""
+        self.vector_store.replace_document(source, docs)
+        self._replace_lexical(source, docs)
+
+    def close(self):
+        """Stop the search threads once the retriever is no longer served."""
+        self.executor.shutdown(wait=False)
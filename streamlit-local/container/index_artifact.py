@@ -0,0 +1,217 @@
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import numpy as np
+import pandas as pd
+from typing import List, Dict, Any, Optional, Tuple
+from onnx_embeddings import RAG_EMBEDDINGS, RAG_ONNX_DIR
+
+# Directory searched for prebuilt artifacts at startup, one subdirectory per version
+RAG_ARTIFACT_DIR = os.getenv("RAG_ARTIFACT_DIR", "/work/artifacts")
+# Path of the artifact's numpy files inside Milvus' object storage bucket; when set,
+# Milvus imports them server-side with bulk insert instead of receiving rows over gRPC
+RAG_ARTIFACT_REMOTE_PATH = os.getenv("RAG_ARTIFACT_REMOTE_PATH", "")
+
+MANIFEST = "manifest.json"
+CHUNKS = "chunks.parquet"
+EMBEDDINGS = "embeddings.npy"
+# Column files in the layout of Milvus numpy bulk insert, one per field
+BULK_INSERT_DIR = "bulk_insert"
+FORMAT_VERSION = 1
+# Organization sentence-transformers resolves bare model names to
+DEFAULT_MODEL_ORGANIZATION = "sentence-transformers"
+
+
+def file_sha256(path: str) -> str:
+    """SHA-256 of a file's content."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def model_id(model_name: str) -> str:
+    """
+    Hub repository id of an embedding model, however it was named.
+
+    "all-MiniLM-L6-v2", "sentence-transformers/all-MiniLM-L6-v2" and a
+    snapshot directory of the Hugging Face cache all load the same weights,
+    so they give the same id. A suffix such as ":onnx-int8" (OnnxEmbeddings)
+    is kept, since those vectors differ.
+    """
+    name, separator, variant = model_name.partition(":")
+    parts = os.path.normpath(name).split(os.sep)
+    cached = [part for part in parts if part.startswith("models--")]
+    if cached:
+        # .../models--sentence-transformers--all-MiniLM-L6-v2/snapshots/<revision>
+        name = cached[-1][len("models--"):].replace("--", "/")
+    elif "/" not in name:
+        name = f"{DEFAULT_MODEL_ORGANIZATION}/{name}"
+    return name + separator + variant
+
+
+def artifact_settings(embeddings, chunker) -> Dict[str, Any]:
+    """Everything besides the PDFs that changes the chunks or their vectors."""
+    model = embeddings.client
+    return {
+        # Normalized, so the CLI and the app agree however they name the model
+        "model": model_id(getattr(embeddings, "model_name", str(model))),
+        "max_seq_length": int(model.max_seq_length),
+        "splitter": type(chunker).__name__,
+        "chunk_tokens": getattr(chunker, "max_tokens", None),
+        "chunk_overlap": getattr(chunker, "overlap", None),
+    }
+
+
+def artifact_version(sources: Dict[str, str], settings: Dict[str, Any]) -> str:
+    """Version of an artifact: a hash of the PDF hashes and the settings."""
+    key = json.dumps({"format": FORMAT_VERSION, "sources": sources, "settings": settings}, sort_keys=True)
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]
+
+
+def write_artifact(root: str, docs: List[Any], vectors: np.ndarray, sources: Dict[str, str],
+                   settings: Dict[str, Any]) -> str:
+    """
+    Write chunks and embeddings as a versioned artifact.
+
+    Args:
+        root: Directory holding artifacts
+        docs: Chunks with source/page metadata
+        vectors: One embedding per chunk
+        sources: SHA-256 of each PDF, keyed by file name
+        settings: Output of artifact_settings()
+
+    Returns:
+        Directory of the artifact
+    """
+    version = artifact_version(sources, settings)
+    directory = os.path.join(root, version)
+    os.makedirs(os.path.join(directory, BULK_INSERT_DIR), exist_ok=True)
+    vectors = np.asarray(vectors, dtype=np.float32)
+
+    frame = pd.DataFrame({
+        "text": [doc.page_content for doc in docs],
+        "source": [str(doc.metadata.get("source", "")) for doc in docs],
+        "page": [int(doc.metadata.get("page", -1)) for doc in docs],
+        "row": np.arange(len(docs), dtype=np.int64),
+    })
+    frame.to_parquet(os.path.join(directory, CHUNKS), index=False)
+    np.save(os.path.join(directory, EMBEDDINGS), vectors)
+    for column, dtype in (("text", str), ("source", str), ("page", np.int64), ("row", np.int64)):
+        np.save(os.path.join(directory, BULK_INSERT_DIR, f"{column}.npy"), np.asarray(frame[column].tolist(), dtype=dtype))
+    np.save(os.path.join(directory, BULK_INSERT_DIR, "vector.npy"), vectors)
+
+    # Written last, so an interrupted build is never picked up
+    with open(os.path.join(directory, MANIFEST), "w") as file:
+        json.dump({"version": version, "format": FORMAT_VERSION, "created": time.time(), "sources": sources,
+                   "settings": settings, "count": len(docs), "dimension": int(vectors.shape[1])}, file, indent=2)
+    return directory
+
+
+def find_artifact(root: str, sources: Dict[str, str], settings: Dict[str, Any]) -> Optional[str]:
+    """Directory of the artifact built from exactly these PDFs and settings, if there is one."""
+    directory = os.path.join(root, artifact_version(sources, settings))
+    manifest_path = os.path.join(directory, MANIFEST)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path) as file:
+        manifest = json.load(file)
+    # The version is a hash; compare the inputs themselves as well
+    if manifest.get("sources") != sources or manifest.get("settings") != settings:
+        return None
+    return directory
+
+
+def artifact_differences(root: str, sources: Dict[str, str], settings: Dict[str, Any]) -> Dict[str, List[str]]:
+    """What each artifact under root was built with differently, e.g. {"3f2a...": ["model"]}."""
+    differences = {}
+    if not os.path.isdir(root):
+        return differences
+    for version in sorted(os.listdir(root)):
+        manifest_path = os.path.join(root, version, MANIFEST)
+        if not os.path.exists(manifest_path):
+            continue
+        with open(manifest_path) as file:
+            manifest = json.load(file)
+        built_with = manifest.get("settings", {})
+        differences[version] = (["sources"] if manifest.get("sources") != sources else []) + \
+            [key for key in sorted(set(built_with) | set(settings)) if built_with.get(key) != settings.get(key)]
+    return differences
+
+
+def load_artifact(directory: str, document_class) -> Tuple[List[Any], np.ndarray, Dict[str, Any]]:
+    """Chunks, memory-mapped embeddings and manifest of an artifact."""
+    with open(os.path.join(directory, MANIFEST)) as file:
+        manifest = json.load(file)
+    frame = pd.read_parquet(os.path.join(directory, CHUNKS))
+    docs = [
+        document_class(page_content=text, metadata={"source": source, "page": int(page)})
+        for text, source, page in zip(frame["text"], frame["source"], frame["page"])
+    ]
+    vectors = np.load(os.path.join(directory, EMBEDDINGS), mmap_mode="r")
+    return docs, vectors, manifest
+
+
+def bulk_insert_files(remote_path: str) -> List[str]:
+    """Files of an artifact uploaded to Milvus' bucket, as do_bulk_insert expects them."""
+    return [f"{remote_path.rstrip('/')}/{BULK_INSERT_DIR}/{column}.npy"
+            for column in ("text", "source", "page", "row", "vector")]
+
+
+def build(args):
+    """Download or read PDFs, chunk and embed them, and write an artifact."""
+    import shutil
+    import requests
+    import urllib.parse
+    from langchain.schema import Document
+    from token_chunker import TokenChunker
+    from parallel_pdf import load_pdf
+    from onnx_embeddings import load_embeddings
+
+    # Built the way the app builds it, so an app running the same backend finds the artifact
+    embeddings = load_embeddings(args.embeddings, args.model, args.onnx_dir, args.cache_folder,
+                                 model_kwargs={'device': 'cpu'}, encode_kwargs={'normalize_embeddings': True})
+    chunker = TokenChunker.from_embeddings(embeddings)
+
+    sources, docs = {}, []
+    for pdf in args.pdfs:
+        # Loaded from the same path as in the app, so the chunks carry the same source metadata
+        name = os.path.basename(urllib.parse.urlparse(pdf).path)
+        path = os.path.join("/tmp/", name)
+        if pdf.startswith(("http://", "https://")):
+            with open(path, "wb") as file:
+                file.write(requests.get(pdf).content)
+        elif os.path.abspath(pdf) != path:
+            shutil.copyfile(pdf, path)
+        sources[name] = file_sha256(path)
+        docs.extend(chunker.split_documents(load_pdf(path, Document)))
+
+    start = time.perf_counter()
+    vectors = np.asarray(embeddings.embed_documents([doc.page_content for doc in docs]), dtype=np.float32)
+    print(f"Embedded {len(docs)} chunks in {time.perf_counter() - start:.1f}s")
+    directory = write_artifact(args.output, docs, vectors, sources, artifact_settings(embeddings, chunker))
+    print(f"Wrote {directory}")
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(description="Prebuilt chunk and embedding artifacts for the RAG app")
+    commands = parser.add_subparsers(dest="command", required=True)
+    build_parser = commands.add_parser("build", help="Build an artifact for a set of PDFs")
+    build_parser.add_argument("pdfs", nargs="+", help="PDF files or URLs, as the app would download them")
+    build_parser.add_argument("--output", default=RAG_ARTIFACT_DIR)
+    build_parser.add_argument("--model", default="sentence-transformers/all-MiniLM-L6-v2")
+    build_parser.add_argument("--cache-folder", default=None)
+    build_parser.add_argument("--embeddings", choices=("pytorch", "onnx"), default=RAG_EMBEDDINGS,
+                              help="Embedding backend of the app that will load the artifact (RAG_EMBEDDINGS)")
+    build_parser.add_argument("--onnx-dir", default=RAG_ONNX_DIR, help="Exported ONNX model (RAG_ONNX_DIR)")
+    build_parser.set_defaults(run=build)
+    args = parser.parse_args(argv)
+    args.run(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,614 @@
+import os
+import json
+import time
+import uuid
+import hashlib
+import threading
+import numpy as np
+from collections import OrderedDict
+from typing import List, Dict, Any, Tuple, Optional, Callable
+
+from pymilvus import BulkInsertState, Collection, CollectionSchema, DataType, FieldSchema, MilvusException, utility
+from langchain.schema import Document
+
+from hybrid_retriever import document_key
+from vector_quantization import quantize, pack_bits, rerank, RAG_VECTOR_DTYPE, RAG_RERANK_FACTOR
+
+# Index built on the vector field: HNSW, IVF_FLAT, IVF_SQ8, IVF_PQ or FLAT
+MILVUS_INDEX_TYPE = os.getenv("MILVUS_INDEX_TYPE", "HNSW")
+# MiniLM vectors are normalized, so inner product is cosine similarity
+MILVUS_METRIC = os.getenv("MILVUS_METRIC", "IP")
+# JSON overrides of the build and query parameters, e.g. {"M": 32} and {"ef": 128}
+MILVUS_INDEX_PARAMS = os.getenv("MILVUS_INDEX_PARAMS", "")
+MILVUS_SEARCH_PARAMS = os.getenv("MILVUS_SEARCH_PARAMS", "")
+# In-memory replicas of the collection across query nodes
+MILVUS_REPLICAS = int(os.getenv("MILVUS_REPLICAS", "1"))
+# Float32 copies of the vectors for exact reranking, one file per collection
+RAG_RERANK_DIR = os.getenv("RAG_RERANK_DIR", os.getenv("RAG_INDEX_DIR", "/tmp/rag-index"))
+# One partition per document, so searches restricted to documents only scan theirs
+MILVUS_DOCUMENT_PARTITIONS = os.getenv("MILVUS_DOCUMENT_PARTITIONS", "1") == "1"
+
+# Build and query parameters per index type
+INDEX_DEFAULTS = {
+    "HNSW": ({"M": 16, "efConstruction": 200}, {"ef": 64}),
+    "IVF_FLAT": ({"nlist": 128}, {"nprobe": 16}),
+    "IVF_SQ8": ({"nlist": 128}, {"nprobe": 16}),
+    # 384 dimensions split into 48 sub-vectors of 8 dimensions
+    "IVF_PQ": ({"nlist": 128, "m": 48, "nbits": 8}, {"nprobe": 16}),
+    "FLAT": ({}, {}),
+    "BIN_IVF_FLAT": ({"nlist": 128}, {"nprobe": 16}),
+    "BIN_FLAT": ({}, {}),
+}
+
+TEXT_FIELD = "text"
+VECTOR_FIELD = "vector"
+MAX_TEXT_LENGTH = 65535
+MAX_SOURCE_LENGTH = 1024
+INSERT_BATCH = 512
+QUERY_BATCH = 1024
+DEFAULT_PARTITION = "_default"
+# Collections are built under "<name>_staging_<id>" and renamed once complete
+STAGING_MARKER = "_staging_"
+# Vectors of recent hits kept for chunk_vectors()
+HIT_VECTOR_CACHE_SIZE = 4096
+
+
+def partition_name(source: str) -> str:
+    """Partition of a document; names allow only letters, digits and underscores."""
+    return "doc_" + hashlib.sha256(source.encode("utf-8")).hexdigest()[:16]
+
+
+def source_filter(sources: List[str]) -> str:
+    """Boolean expression selecting the chunks of some documents."""
+    return f"source in {json.dumps(list(sources))}"
+
+
+def index_config(index_type: str = MILVUS_INDEX_TYPE, metric: str = MILVUS_METRIC,
+                 index_params: Optional[Dict[str, Any]] = None, search_params: Optional[Dict[str, Any]] = None,
+                 replicas: int = MILVUS_REPLICAS, vector_dtype: str = RAG_VECTOR_DTYPE,
+                 rerank_factor: int = RAG_RERANK_FACTOR,
+                 partitioned: bool = MILVUS_DOCUMENT_PARTITIONS) -> Dict[str, Any]:
+    """
+    Index, metric, query parameters, replica count and vector storage for a collection.
+
+    Parameters not given come from MILVUS_INDEX_PARAMS / MILVUS_SEARCH_PARAMS,
+    then from the defaults of the index type. The vector dtype decides how
+    vectors are held in memory: float16 uses a FLOAT16_VECTOR field (Milvus 2.4
+    or later), int8 an IVF_SQ8 index, which keeps 8-bit codes in memory, and
+    binary a BINARY_VECTOR field searched by Hamming distance. Partitioned
+    collections keep each document in its own partition.
+    """
+    index_type = index_type.upper()
+    if vector_dtype == "int8":
+        index_type = "IVF_SQ8"
+    elif vector_dtype == "binary":
+        index_type = index_type if index_type.startswith("BIN_") else "BIN_IVF_FLAT"
+        metric = "HAMMING"
+    elif index_type.startswith("BIN_"):
+        raise ValueError(f"Index type '{index_type}' needs binary vectors")
+    if index_type not in INDEX_DEFAULTS:
+        raise ValueError(f"Unsupported index type '{index_type}', expected one of {', '.join(INDEX_DEFAULTS)}")
+    default_index, default_search = INDEX_DEFAULTS[index_type]
+    if index_params is None:
+        index_params = {**default_index, **(json.loads(MILVUS_INDEX_PARAMS) if MILVUS_INDEX_PARAMS else {})}
+    if search_params is None:
+        search_params = {**default_search, **(json.loads(MILVUS_SEARCH_PARAMS) if MILVUS_SEARCH_PARAMS else {})}
+    return {"index_type": index_type, "metric": metric.upper(), "index_params": index_params,
+            "search_params": search_params, "replicas": replicas,
+            "vector_dtype": vector_dtype, "rerank_factor": rerank_factor, "partitioned": partitioned}
+
+
+def stored_config(collection: Collection) -> Dict[str, Any]:
+    """Configuration saved in a collection's description, or the current one for collections without it."""
+    try:
+        config = json.loads(collection.description)
+    except ValueError:
+        config = None
+    if not isinstance(config, dict) or "index_type" not in config:
+        return index_config()
+    return config
+
+
+def alias_target(alias: str) -> Optional[str]:
+    """Name of the collection an alias points to, if the alias exists."""
+    for name in utility.list_collections():
+        if alias in utility.list_aliases(name):
+            return name
+    return None
+
+
+def point_alias(alias: str, collection_name: str) -> Optional[str]:
+    """
+    Point an alias at a collection in one step.
+
+    Searches through the alias move to the new collection atomically. An
+    unversioned collection with the alias' name, as created before aliases
+    were used, is dropped first.
+
+    Returns:
+        The collection the alias pointed to before, if any
+    """
+    previous = alias_target(alias)
+    if previous is None:
+        if alias in utility.list_collections():
+            utility.drop_collection(alias)
+        utility.create_alias(collection_name, alias)
+    elif previous != collection_name:
+        utility.alter_alias(collection_name, alias)
+    return previous
+
+
+class MilvusStore:
+    """
+    A Milvus collection of document chunks with an explicitly chosen index.
+
+    The collection has one row per chunk (text, source, page and the
+    embedding), an index of the configured type and metric, and is loaded with
+    an explicit replica count. Searches use the configured query parameters
+    (ef for HNSW, nprobe for IVF). Scores follow the metric: higher is better
+    for IP, lower for L2 and HAMMING. Implements the similarity_search_with_score()
+    subset of the LangChain vector store API used by the app.
+
+    With compressed vectors and a rerank factor, k * factor candidates are
+    fetched and rescored against float32 copies of the vectors in a
+    memory-mapped file under RAG_RERANK_DIR, addressed by each row's number.
+
+    Searches can be restricted to some documents (their source metadata): in
+    a partitioned collection only those documents' partitions are searched,
+    otherwise a filter on the indexed source field selects their chunks.
+    Single documents can be removed or replaced in place.
+
+    Built with staged=True, a collection is filled and indexed under a
+    temporary name and only renamed to its own name once complete, so a
+    collection found under a version's name is always complete and pods
+    building the same version do not drop each other's work.
+
+    A missing rerank file (it lives on pod-local storage) can be restored
+    from the collection with restore_rerank_vectors().
+
+    The float32 vectors of recent hits, returned by the search itself or read
+    from the rerank file, are kept so chunk_vectors() can hand them to the
+    prompt packer instead of it embedding the chunks again.
+    """
+
+    def __init__(self, embedding, collection: Collection, config: Dict[str, Any]):
+        self.embedding_func = embedding
+        self.collection = collection
+        self.config = config
+        self.full_vectors = None
+        # Keyed by document_key(), so a cached vector always belongs to the same text
+        self.hit_vectors = OrderedDict()
+        self._hit_vectors_lock = threading.Lock()
+        if self._reranked(config):
+            path = self.rerank_path(collection.name)
+            if os.path.exists(path):
+                self.full_vectors = np.load(path, mmap_mode="r")
+            else:
+                print(f"No float32 vectors at {path}, searching without reranking")
+
+    @staticmethod
+    def rerank_path(collection_name: str) -> str:
+        return os.path.join(RAG_RERANK_DIR, f"{collection_name}.f32.npy")
+
+    @staticmethod
+    def _reranked(config: Dict[str, Any]) -> bool:
+        """Whether searches with a configuration rerank against the float32 file."""
+        return config["vector_dtype"] != "float32" and config["rerank_factor"] > 0
+
+    @classmethod
+    def rerank_file_missing(cls, collection_name: str) -> bool:
+        """Whether a collection is searched with reranking but its float32 file is not on this pod."""
+        config = stored_config(Collection(collection_name))
+        return cls._reranked(config) and not os.path.exists(cls.rerank_path(collection_name))
+
+    @staticmethod
+    def schema(dimension: int, vector_dtype: str = "float32", description: str = "Document chunks") -> CollectionSchema:
+        if vector_dtype == "binary":
+            vector_field = FieldSchema(VECTOR_FIELD, DataType.BINARY_VECTOR, dim=dimension)
+        elif vector_dtype == "float16":
+            if not hasattr(DataType, "FLOAT16_VECTOR"):
+                raise ValueError("float16 vectors need pymilvus and Milvus 2.4 or later")
+            vector_field = FieldSchema(VECTOR_FIELD, DataType.FLOAT16_VECTOR, dim=dimension)
+        else:
+            vector_field = FieldSchema(VECTOR_FIELD, DataType.FLOAT_VECTOR, dim=dimension)
+        fields = [
+            FieldSchema("pk", DataType.INT64, is_primary=True, auto_id=True),
+            FieldSchema(TEXT_FIELD, DataType.VARCHAR, max_length=MAX_TEXT_LENGTH),
+            FieldSchema("source", DataType.VARCHAR, max_length=MAX_SOURCE_LENGTH),
+            FieldSchema("page", DataType.INT64),
+            # Position of the chunk in the float32 rerank file
+            FieldSchema("row", DataType.INT64),
+            vector_field,
+        ]
+        return CollectionSchema(fields, description=description)
+
+    @staticmethod
+    def _field_data(vectors: np.ndarray, vector_dtype: str) -> List[Any]:
+        """Vectors in the form pymilvus expects for the vector field."""
+        if vector_dtype == "binary":
+            return [bytes(row) for row in quantize(vectors, "binary")[0]]
+        if vector_dtype == "float16":
+            return list(vectors.astype(np.float16))
+        # int8 is quantized by the IVF_SQ8 index; the field stays float32
+        return vectors
+
+    @classmethod
+    def create(cls, docs: List[Any], embedding, collection_name: str, config: Dict[str, Any],
+               drop_old: bool = True, staged: bool = False) -> "MilvusStore":
+        """Embed documents and create, index and load a collection for them."""
+        vectors = np.asarray(embedding.embed_documents([doc.page_content for doc in docs]), dtype=np.float32)
+        return cls.create_from_vectors(docs, vectors, embedding, collection_name, config, drop_old, staged)
+
+    @classmethod
+    def _new_collection(cls, collection_name: str, dimension: int, config: Dict[str, Any],
+                        drop_old: bool) -> Collection:
+        if utility.has_collection(collection_name):
+            if not drop_old:
+                raise ValueError(f"Collection '{collection_name}' already exists")
+            utility.drop_collection(collection_name)
+        # The configuration is kept with the collection, so open() can search it as it was built
+        return Collection(collection_name, cls.schema(dimension, config["vector_dtype"], json.dumps(config)))
+
+    @staticmethod
+    def _staging_name(collection_name: str) -> str:
+        return f"{collection_name}{STAGING_MARKER}{uuid.uuid4().hex[:8]}"
+
+    @staticmethod
+    def _rename_staged(collection: Collection, collection_name: str) -> Collection:
+        """Give a complete staging collection its own name; if another build got there first, use that one."""
+        try:
+            utility.rename_collection(collection.name, collection_name)
+        except MilvusException:
+            if not utility.has_collection(collection_name):
+                raise
+            # Built from the same inputs, so it holds the same chunks and rows
+            utility.drop_collection(collection.name)
+        return Collection(collection_name)
+
+    @classmethod
+    def _save_rerank_vectors(cls, collection_name: str, vectors: np.ndarray, config: Dict[str, Any]):
+        if cls._reranked(config):
+            os.makedirs(RAG_RERANK_DIR, exist_ok=True)
+            # Replaced rather than rewritten, as a retriever of this pod may have the file mapped
+            path = cls.rerank_path(collection_name)
+            temporary = path + ".tmp.npy"
+            np.save(temporary, np.asarray(vectors, dtype=np.float32))
+            os.replace(temporary, path)
+
+    @staticmethod
+    def _create_indexes(collection: Collection, count: int, config: Dict[str, Any]):
+        index_params = dict(config["index_params"])
+        if "nlist" in index_params:
+            # IVF needs at least one training vector per cluster
+            index_params["nlist"] = max(1, min(index_params["nlist"], count))
+        collection.create_index(VECTOR_FIELD, {"index_type": config["index_type"],
+                                               "metric_type": config["metric"],
+                                               "params": index_params})
+        # Scalar index for filters on the document
+        collection.create_index("source", index_name="source_index")
+
+    @classmethod
+    def _build(cls, collection_name: str, dimension: int, count: int, embedding, config: Dict[str, Any],
+               drop_old: bool, staged: bool, fill: Callable[[Collection], None]) -> "MilvusStore":
+        """
+        Create a collection, fill it with fill(collection), then index and load it.
+
+        A staged build runs under a temporary name, renamed once the collection
+        is indexed and dropped if the build fails.
+        """
+        build_name = cls._staging_name(collection_name) if staged else collection_name
+        collection = cls._new_collection(build_name, dimension, config, drop_old)
+        try:
+            fill(collection)
+            cls._create_indexes(collection, count, config)
+        except BaseException:
+            if staged:
+                utility.drop_collection(build_name)
+            raise
+        if staged:
+            collection = cls._rename_staged(collection, collection_name)
+        store = cls(embedding, collection, config)
+        store.load()
+        return store
+
+    @classmethod
+    def create_from_vectors(cls, docs: List[Any], vectors: np.ndarray, embedding, collection_name: str,
+                            config: Dict[str, Any], drop_old: bool = True, staged: bool = False) -> "MilvusStore":
+        """Create, index and load a collection from precomputed embeddings."""
+        vector_dtype = config["vector_dtype"]
+        vectors = vectors / np.clip(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12, None)
+        cls._save_rerank_vectors(collection_name, vectors, config)
+
+        def fill(collection: Collection):
+            rows_by_source = {}
+            for row, doc in enumerate(docs):
+                rows_by_source.setdefault(str(doc.metadata.get("source", "")), []).append(row)
+            for source, rows in rows_by_source.items():
+                cls._insert(collection, source, [docs[row] for row in rows], rows, vectors[rows], config)
+            collection.flush()
+
+        return cls._build(collection_name, vectors.shape[1], len(docs), embedding, config, drop_old, staged, fill)
+
+    @staticmethod
+    def _insert(collection: Collection, source: str, docs: List[Any], rows: List[int], vectors: np.ndarray,
+                config: Dict[str, Any]):
+        """Insert the chunks of one document, into its own partition if the collection is partitioned."""
+        partition = DEFAULT_PARTITION
+        if config.get("partitioned"):
+            partition = partition_name(source)
+            if not collection.has_partition(partition):
+                # The description keeps the source, so documents() can list the partitions' documents
+                collection.create_partition(partition, description=source[:MAX_SOURCE_LENGTH])
+        for start in range(0, len(docs), INSERT_BATCH):
+            batch = docs[start:start + INSERT_BATCH]
+            collection.insert([
+                [doc.page_content[:MAX_TEXT_LENGTH] for doc in batch],
+                [source[:MAX_SOURCE_LENGTH]] * len(batch),
+                [int(doc.metadata.get("page", -1)) for doc in batch],
+                list(rows[start:start + INSERT_BATCH]),
+                MilvusStore._field_data(vectors[start:start + INSERT_BATCH], config["vector_dtype"]),
+            ], partition_name=partition)
+
+    @classmethod
+    def bulk_import(cls, files: List[str], vectors: np.ndarray, embedding, collection_name: str,
+                    config: Dict[str, Any], drop_old: bool = True, timeout: float = 600,
+                    staged: bool = False) -> "MilvusStore":
+        """
+        Create a collection from column files in Milvus' object storage with bulk insert.
+
+        Milvus reads the files itself, so no rows travel over gRPC. The files
+        are those of a prebuilt artifact (see index_artifact.py) and hold
+        float32 vectors, so this works for the float32 and int8 dtypes.
+
+        Args:
+            files: Paths of the text, source, page, row and vector .npy files in the bucket
+            vectors: The same float32 vectors, for the rerank file and the dimension
+        """
+        if config["vector_dtype"] not in ("float32", "int8"):
+            raise ValueError(f"Bulk import needs float32 vectors, not {config['vector_dtype']}")
+        # The files hold every document, so they are imported into one partition and filtered by source
+        config = {**config, "partitioned": False}
+        cls._save_rerank_vectors(collection_name, vectors, config)
+
+        def fill(collection: Collection):
+            task = utility.do_bulk_insert(collection.name, files=files)
+            deadline = time.monotonic() + timeout
+            while True:
+                state = utility.get_bulk_insert_state(task)
+                if state.state == BulkInsertState.ImportCompleted:
+                    return
+                if state.state in (BulkInsertState.ImportFailed, BulkInsertState.ImportFailedAndCleaned):
+                    raise RuntimeError(f"Bulk insert into '{collection.name}' failed: {state.failed_reason}")
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f"Bulk insert into '{collection.name}' did not finish in {timeout}s")
+                time.sleep(0.5)
+
+        return cls._build(collection_name, vectors.shape[1], len(vectors), embedding, config, drop_old, staged, fill)
+
+    @classmethod
+    def open(cls, embedding, collection_name: str, config: Optional[Dict[str, Any]] = None) -> "MilvusStore":
+        """Use an existing collection, loading it if needed; by default with the configuration it was built with."""
+        collection = Collection(collection_name)
+        if config is None:
+            config = stored_config(collection)
+        store = cls(embedding, collection, config)
+        store.load()
+        return store
+
+    @classmethod
+    def drop(cls, collection_name: str):
+        """Drop a collection, staging collections left by its unfinished builds, and its rerank file."""
+        for name in utility.list_collections():
+            if name == collection_name or name.startswith(collection_name + STAGING_MARKER):
+                utility.drop_collection(name)
+        if os.path.exists(cls.rerank_path(collection_name)):
+            os.remove(cls.rerank_path(collection_name))
+
+    @property
+    def dimension(self) -> int:
+        """Dimension of the vector field."""
+        field = next(f for f in self.collection.schema.fields if f.name == VECTOR_FIELD)
+        return int(field.params["dim"])
+
+    def load(self):
+        """Load the collection into memory with the configured number of replicas."""
+        replicas = self.config["replicas"]
+        if utility.load_state(self.collection.name).name == "Loaded":
+            if len(self.collection.get_replicas().groups) == replicas:
+                return
+            # The replica count of a loaded collection cannot change in place
+            self.collection.release()
+        self.collection.load(replica_number=replicas)
+
+    def similarity_search_by_vector_with_score(self, vector: List[float], k: int = 4,
+                                               search_params: Optional[Dict[str, Any]] = None,
+                                               expr: Optional[str] = None,
+                                               sources: Optional[List[str]] = None) -> List[Tuple[Any, float]]:
+        """
+        The k nearest chunks to an embedding, with their scores.
+
+        Scores are metric scores, or exact cosine similarities when reranked.
+        sources restricts the search to the chunks of those documents.
+        """
+        query = np.asarray(vector, dtype=np.float32)
+        query /= max(np.linalg.norm(query), 1e-12)
+        limit = k * self.config["rerank_factor"] if self.full_vectors is not None else k
+
+        params = dict(search_params if search_params is not None else self.config["search_params"])
+        if "ef" in params:
+            # HNSW returns at most ef results
+            params["ef"] = max(params["ef"], limit)
+        vector_dtype = self.config["vector_dtype"]
+        if vector_dtype == "binary":
+            data = [bytes(pack_bits(query))]
+        elif vector_dtype == "float16":
+            data = [query.astype(np.float16)]
+        else:
+            data = [query.tolist()]
+
+        partition_names = None
+        if sources is not None:
+            if self.config.get("partitioned"):
+                partition_names = [name for name in map(partition_name, sources)
+                                   if self.collection.has_partition(name)]
+                if not partition_names:
+                    return []
+            else:
+                expr = f"({expr}) and {source_filter(sources)}" if expr else source_filter(sources)
+
+        # Without a rerank file the vectors come with the hits, if the field holds float32 (int8 is an index type)
+        return_vectors = self.full_vectors is None and vector_dtype in ("float32", "int8")
+        output_fields = [TEXT_FIELD, "source", "page", "row"] + ([VECTOR_FIELD] if return_vectors else [])
+        results = self.collection.search(
+            data=data,
+            anns_field=VECTOR_FIELD,
+            param={"metric_type": self.config["metric"], "params": params},
+            limit=limit,
+            expr=expr,
+            partition_names=partition_names,
+            output_fields=output_fields,
+        )
+        hits = [
+            (hit.entity.get("row"),
+             Document(page_content=hit.entity.get(TEXT_FIELD),
+                      metadata={"source": hit.entity.get("source"), "page": hit.entity.get("page")}),
+             float(hit.distance),
+             hit.entity.get(VECTOR_FIELD) if return_vectors else None)
+            for hit in results[0]
+        ]
+        if self.full_vectors is None:
+            self._remember_vectors([(doc, vector) for _, doc, _, vector in hits if vector is not None])
+            return [(doc, score) for _, doc, score, _ in hits]
+        docs = {row: doc for row, doc, _, _ in hits}
+        ranked = rerank(self.full_vectors, list(docs), query, k)
+        self._remember_vectors([(docs[row], self.full_vectors[row]) for row, _ in ranked])
+        return [(docs[row], score) for row, score in ranked]
+
+    def _remember_vectors(self, pairs: List[Tuple[Any, Any]]):
+        """Keep the normalized vectors of (document, vector) hits in a bounded LRU cache."""
+        with self._hit_vectors_lock:
+            for doc, vector in pairs:
+                key = document_key(doc)
+                vector = np.asarray(vector, dtype=np.float32)
+                self.hit_vectors[key] = vector / max(np.linalg.norm(vector), 1e-12)
+                self.hit_vectors.move_to_end(key)
+            while len(self.hit_vectors) > HIT_VECTOR_CACHE_SIZE:
+                self.hit_vectors.popitem(last=False)
+
+    def chunk_vectors(self, docs: List[Any]) -> List[Optional[np.ndarray]]:
+        """Stored normalized vectors of chunks found by recent searches; None for the others (e.g. keyword hits)."""
+        with self._hit_vectors_lock:
+            return [self.hit_vectors.get(document_key(doc)) for doc in docs]
+
+    def similarity_search_with_score(self, query: str, k: int = 4,
+                                     sources: Optional[List[str]] = None) -> List[Tuple[Any, float]]:
+        """The k nearest chunks to a question, with their metric scores."""
+        return self.similarity_search_by_vector_with_score(self.embedding_func.embed_query(query), k,
+                                                           sources=sources)
+
+    def _rows(self, output_fields: List[str]) -> List[Dict[str, Any]]:
+        """Every row of the collection with some fields, fetched in batches."""
+        iterator = self.collection.query_iterator(batch_size=QUERY_BATCH, expr="row >= 0",
+                                                  output_fields=output_fields)
+        rows = []
+        try:
+            while True:
+                batch = iterator.next()
+                if not batch:
+                    return rows
+                rows.extend(batch)
+        finally:
+            iterator.close()
+
+    def chunks(self) -> List[Any]:
+        """All chunks of the collection in row order, e.g. to rebuild the keyword index."""
+        rows = sorted(self._rows([TEXT_FIELD, "source", "page", "row"]), key=lambda row: row["row"])
+        return [Document(page_content=row[TEXT_FIELD], metadata={"source": row["source"], "page": row["page"]})
+                for row in rows]
+
+    def restore_rerank_vectors(self):
+        """
+        Write the float32 rerank file again from the collection.
+
+        int8 collections keep float32 vectors in Milvus; float16 and binary
+        ones only hold compressed vectors, so their chunks are embedded again.
+        """
+        if not self._reranked(self.config):
+            return
+        from_field = self.config["vector_dtype"] == "int8"
+        rows = self._rows([TEXT_FIELD, "row"] + ([VECTOR_FIELD] if from_field else []))
+        if not rows:
+            return
+        if from_field:
+            vectors = np.asarray([row[VECTOR_FIELD] for row in rows], dtype=np.float32)
+        else:
+            vectors = np.asarray(self.embedding_func.embed_documents([row[TEXT_FIELD] for row in rows]),
+                                 dtype=np.float32)
+        vectors = vectors / np.clip(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12, None)
+
+        # Rows of removed chunks stay zero, as nothing addresses them
+        full_vectors = np.zeros((max(row["row"] for row in rows) + 1, self.dimension), dtype=np.float32)
+        full_vectors[[row["row"] for row in rows]] = vectors
+        os.makedirs(RAG_RERANK_DIR, exist_ok=True)
+        path = self.rerank_path(self.collection.name)
+        temporary = path + ".tmp.npy"
+        np.save(temporary, full_vectors)
+        os.replace(temporary, path)
+        self.full_vectors = np.load(path, mmap_mode="r")
+
+    def documents(self) -> List[str]:
+        """Sources of the documents in the collection."""
+        if self.config.get("partitioned"):
+            return sorted(p.description for p in self.collection.partitions if p.name != DEFAULT_PARTITION)
+        # Unpartitioned (bulk imported) collections can hold any number of chunks
+        return sorted({row["source"] for row in self._rows(["source"])})
+
+    def remove_document(self, source: str):
+        """Delete the chunks of one document; dropping its partition if it has one."""
+        name = partition_name(source)
+        if self.config.get("partitioned") and self.collection.has_partition(name):
+            # A loaded partition cannot be dropped
+            self.collection.partition(name).release()
+            self.collection.drop_partition(name)
+        else:
+            self.collection.delete(source_filter([source]))
+
+    def replace_document(self, source: str, docs: List[Any], vectors: Optional[np.ndarray] = None):
+        """
+        Replace the chunks of one document, or add a new one, leaving the others untouched.
+
+        Args:
+            source: Source metadata of the document
+            docs: Its new chunks
+            vectors: Their embeddings; computed if not given
+        """
+        if vectors is None:
+            vectors = self.embedding_func.embed_documents([doc.page_content for doc in docs])
+        vectors = np.asarray(vectors, dtype=np.float32)
+        vectors = vectors / np.clip(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12, None)
+
+        if self.full_vectors is not None:
+            # New rows are appended to the rerank file before they can be found; rows of removed
+            # chunks stay unused. The file is replaced, not rewritten, as searches map the old one
+            first_row = len(self.full_vectors)
+            path = self.rerank_path(self.collection.name)
+            temporary = path + ".tmp.npy"
+            np.save(temporary, np.concatenate([np.asarray(self.full_vectors, dtype=np.float32), vectors]))
+            os.replace(temporary, path)
+            self.full_vectors = np.load(path, mmap_mode="r")
+        else:
+            # Rows only address the rerank file; kept distinct anyway
+            first_row = self.collection.num_entities
+
+        self.remove_document(source)
+        self._insert(self.collection, source, docs, list(range(first_row, first_row + len(docs))), vectors,
+                     self.config)
+        self.collection.flush()
+        if self.config.get("partitioned"):
+            self.collection.partition(partition_name(source)).load(replica_number=self.config["replicas"])
+
+    def stats(self) -> Dict[str, Any]:
+        return {"collection": self.collection.name, "rows": self.collection.num_entities,
+                "index_type": self.config["index_type"], "metric": self.config["metric"],
+                "search_params": self.config["search_params"], "replicas": self.config["replicas"],
+                "vector_dtype": self.config["vector_dtype"], "reranked": self.full_vectors is not None}
@@ -0,0 +1,368 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import numpy as np
+from typing import List, Dict, Any, Callable, Tuple
+
+MILVUS_HOST = os.getenv("MILVUS_HOST", "milvus-service")
+MILVUS_PORT = os.getenv("MILVUS_PORT", "19530")
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+EMBEDDING_CACHE = os.getenv("EMBEDDING_CACHE")
+BENCH_COLLECTION = "rag_bench"
+
+
+def load_embeddings():
+    """The embedding model used by the app."""
+    from langchain.embeddings import HuggingFaceEmbeddings
+    return HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL, cache_folder=EMBEDDING_CACHE,
+                                 model_kwargs={'device': 'cpu'}, encode_kwargs={'normalize_embeddings': True})
+
+
+def load_chunks(pdf_path: str, embeddings) -> List[Any]:
+    """Chunks of a PDF as the app ingests them."""
+    from langchain.schema import Document
+    from token_chunker import TokenChunker
+    from parallel_pdf import load_pdf
+    return TokenChunker.from_embeddings(embeddings).split_documents(load_pdf(pdf_path, Document))
+
+
+def load_queries(path: str, chunks: List[Any], count: int) -> List[str]:
+    """Questions from a file (one per line), or the first sentence of randomly chosen chunks."""
+    if path:
+        with open(path) as file:
+            return [line.strip() for line in file if line.strip()]
+    sample = random.Random(0).sample(chunks, min(count, len(chunks)))
+    return [chunk.page_content.split(". ")[0][:200] for chunk in sample]
+
+
+def percentile(values: List[float], q: float) -> float:
+    return float(np.percentile(values, q)) if values else 0.0
+
+
+def time_searches(search: Callable[[List[float]], List[Tuple[Any, float]]],
+                  query_vectors: List[List[float]]) -> Tuple[List[float], List[List[Any]]]:
+    """Run one search per query vector; returns latencies in ms and the documents found."""
+    latencies, results = [], []
+    for vector in query_vectors:
+        start = time.perf_counter()
+        found = search(vector)
+        latencies.append((time.perf_counter() - start) * 1000)
+        results.append([doc for doc, _ in found])
+    return latencies, results
+
+
+def recall(results: List[List[Any]], truth: List[List[Any]]) -> float:
+    """Share of the exact top-k chunks that a search also returned."""
+    hits = total = 0
+    for found, expected in zip(results, truth):
+        found_texts = {doc.page_content for doc in found}
+        hits += sum(1 for doc in expected if doc.page_content in found_texts)
+        total += len(expected)
+    return hits / total if total else 0.0
+
+
+def print_rows(rows: List[Dict[str, Any]]):
+    """Print result rows as an aligned table."""
+    if not rows:
+        return
+    columns = list(rows[0].keys())
+    cells = [[f"{row[c]:.3f}" if isinstance(row[c], float) else str(row[c]) for c in columns] for row in rows]
+    widths = [max(len(c), *(len(r[i]) for r in cells)) for i, c in enumerate(columns)]
+    print("  ".join(c.ljust(w) for c, w in zip(columns, widths)))
+    for r in cells:
+        print("  ".join(v.ljust(w) for v, w in zip(r, widths)))
+
+
+def bench_backends(args):
+    """Search latency and recall of Milvus against the in-process exact and HNSW indexes."""
+    from local_vector_store import LocalVectorStore
+
+    embeddings = load_embeddings()
+    chunks = load_chunks(args.pdf, embeddings)
+    queries = load_queries(args.queries, chunks, args.num_queries)
+    query_vectors = embeddings.embed_documents(queries)
+    vectors = np.asarray(embeddings.embed_documents([c.page_content for c in chunks]), dtype=np.float32)
+    print(f"{len(chunks)} chunks, {len(queries)} queries, k={args.k}")
+
+    rows = []
+    truth = None
+    with tempfile.TemporaryDirectory() as directory:
+        for kind in ("exact", "hnsw"):
+            start = time.perf_counter()
+            LocalVectorStore.from_vectors(chunks, vectors, embeddings, os.path.join(directory, kind), kind)
+            build = time.perf_counter() - start
+            start = time.perf_counter()
+            store = LocalVectorStore.load(os.path.join(directory, kind), embeddings, type(chunks[0]))
+            startup = time.perf_counter() - start
+            latencies, results = time_searches(
+                lambda v: store.similarity_search_by_vector_with_score(v, k=args.k), query_vectors)
+            if kind == "exact":
+                truth = results
+            rows.append({"backend": f"local-{store.kind}", "build s": build, "startup s": startup,
+                         "p50 ms": percentile(latencies, 50), "p95 ms": percentile(latencies, 95),
+                         "recall": recall(results, truth)})
+
+    if not args.skip_milvus:
+        from pymilvus import connections, utility
+        from milvus_store import MilvusStore, index_config
+
+        start = time.perf_counter()
+        connections.connect(host=MILVUS_HOST, port=MILVUS_PORT)
+        connect = time.perf_counter() - start
+        start = time.perf_counter()
+        store = MilvusStore.create_from_vectors(chunks, vectors, embeddings, BENCH_COLLECTION, index_config())
+        build = time.perf_counter() - start
+        latencies, results = time_searches(
+            lambda v: store.similarity_search_by_vector_with_score(v, k=args.k), query_vectors)
+        rows.append({"backend": f"milvus-{store.config['index_type']}", "build s": build, "startup s": connect,
+                     "p50 ms": percentile(latencies, 50), "p95 ms": percentile(latencies, 95),
+                     "recall": recall(results, truth)})
+        utility.drop_collection(BENCH_COLLECTION)
+
+    print_rows(rows)
+
+
+def exact_neighbours(chunks: List[Any], vectors: np.ndarray, query_vectors: List[List[float]], k: int) -> List[List[Any]]:
+    """Exact top-k chunks by inner product, the ground truth for recall."""
+    scores = np.asarray(query_vectors, dtype=np.float32) @ vectors.T
+    top = np.argsort(-scores, axis=1)[:, :k]
+    return [[chunks[i] for i in row] for row in top]
+
+
+def bench_sweep(args):
+    """Recall@k against latency of Milvus index types over their query-time parameter."""
+    from pymilvus import connections, utility
+    from milvus_store import MilvusStore, index_config
+
+    embeddings = load_embeddings()
+    chunks = load_chunks(args.pdf, embeddings)
+    queries = load_queries(args.queries, chunks, args.num_queries)
+    query_vectors = embeddings.embed_documents(queries)
+    vectors = np.asarray(embeddings.embed_documents([c.page_content for c in chunks]), dtype=np.float32)
+    truth = exact_neighbours(chunks, vectors, query_vectors, args.k)
+    print(f"{len(chunks)} chunks, {len(queries)} queries, k={args.k}, {args.replicas} replica(s)")
+
+    connections.connect(host=MILVUS_HOST, port=MILVUS_PORT)
+    rows = []
+    try:
+        for index_type in args.index_types.split(","):
+            config = index_config(index_type, "IP", replicas=args.replicas)
+            start = time.perf_counter()
+            store = MilvusStore.create_from_vectors(chunks, vectors, embeddings, BENCH_COLLECTION, config)
+            build = time.perf_counter() - start
+            # The query-time knob of the index type: ef for HNSW, nprobe for IVF, none for FLAT
+            knob = next(iter(config["search_params"]), None)
+            values = [int(v) for v in (args.ef if knob == "ef" else args.nprobe).split(",")] if knob else [None]
+            for value in values:
+                params = {knob: value} if knob else {}
+                latencies, results = time_searches(
+                    lambda v: store.similarity_search_by_vector_with_score(v, k=args.k, search_params=params),
+                    query_vectors)
+                rows.append({"index": config["index_type"], "params": json.dumps(config["index_params"]),
+                             "search": f"{knob}={value}" if knob else "-", "build s": build,
+                             "p50 ms": percentile(latencies, 50), "p95 ms": percentile(latencies, 95),
+                             "QPS": len(latencies) / (sum(latencies) / 1000), "recall": recall(results, truth)})
+    finally:
+        if utility.has_collection(BENCH_COLLECTION):
+            utility.drop_collection(BENCH_COLLECTION)
+    print_rows(rows)
+
+
+def vector_bytes(count: int, dimension: int, dtype: str) -> int:
+    """Memory held by the vectors of one index, before index overhead."""
+    per_vector = {"float32": 4 * dimension, "float16": 2 * dimension, "int8": dimension, "binary": dimension // 8}
+    return count * per_vector[dtype]
+
+
+def bench_quantization(args):
+    """Memory, QPS and recall@k of compressed vectors against float32, with and without reranking."""
+    from local_vector_store import LocalVectorStore
+
+    embeddings = load_embeddings()
+    chunks = load_chunks(args.pdf, embeddings)
+    queries = load_queries(args.queries, chunks, args.num_queries)
+    query_vectors = embeddings.embed_documents(queries)
+    vectors = np.asarray(embeddings.embed_documents([c.page_content for c in chunks]), dtype=np.float32)
+    truth = exact_neighbours(chunks, vectors, query_vectors, args.k)
+    print(f"{len(chunks)} chunks, {len(queries)} queries, k={args.k}")
+
+    dtypes = args.dtypes.split(",")
+    rows = []
+
+    def measure(backend, dtype, factor, search):
+        latencies, results = time_searches(search, query_vectors)
+        rows.append({"backend": backend, "dtype": dtype, "rerank": f"x{factor}" if factor else "-",
+                     "vector MB": vector_bytes(len(chunks), vectors.shape[1], dtype) / 2 ** 20,
+                     "p50 ms": percentile(latencies, 50), "QPS": len(latencies) / (sum(latencies) / 1000),
+                     "recall": recall(results, truth)})
+
+    with tempfile.TemporaryDirectory() as directory:
+        for dtype in dtypes:
+            store = LocalVectorStore.from_vectors(chunks, vectors, embeddings, os.path.join(directory, dtype),
+                                                  "exact", dtype)
+            for factor in ([0] if dtype == "float32" else [0, args.rerank_factor]):
+                store.rerank_factor = factor
+                measure("local", dtype, factor, lambda v: store.similarity_search_by_vector_with_score(v, k=args.k))
+
+    if args.milvus:
+        from pymilvus import connections, utility
+        from milvus_store import MilvusStore, index_config
+
+        connections.connect(host=MILVUS_HOST, port=MILVUS_PORT)
+        try:
+            for dtype in dtypes:
+                for factor in ([0] if dtype == "float32" else [0, args.rerank_factor]):
+                    config = index_config(vector_dtype=dtype, rerank_factor=factor)
+                    store = MilvusStore.create_from_vectors(chunks, vectors, embeddings, BENCH_COLLECTION, config)
+                    measure(f"milvus-{config['index_type']}", dtype, factor,
+                            lambda v: store.similarity_search_by_vector_with_score(v, k=args.k))
+        finally:
+            if utility.has_collection(BENCH_COLLECTION):
+                utility.drop_collection(BENCH_COLLECTION)
+
+    print_rows(rows)
+
+
+def bench_embeddings(args):
+    """Startup time, throughput and agreement of the ONNX int8 embedding backend against PyTorch."""
+    rows = []
+
+    # ONNX first, so its startup is measured before torch has been imported
+    start = time.perf_counter()
+    from onnx_embeddings import OnnxEmbeddings, cosine_agreement
+    onnx_embeddings = OnnxEmbeddings.load_or_export(EMBEDDING_MODEL, args.onnx_dir, EMBEDDING_CACHE)
+    onnx_startup = time.perf_counter() - start
+
+    texts = [chunk.page_content for chunk in load_chunks(args.pdf, onnx_embeddings)]
+    texts = texts[:args.max_texts]
+    print(f"{len(texts)} chunks")
+
+    onnx_vectors = None
+    for threads in [int(t) for t in args.threads.split(",")]:
+        onnx_embeddings = OnnxEmbeddings(args.onnx_dir, threads=threads)
+        start = time.perf_counter()
+        vectors = onnx_embeddings.embed_documents(texts)
+        seconds = time.perf_counter() - start
+        query_ms = []
+        for text in texts[:50]:
+            query_start = time.perf_counter()
+            onnx_embeddings.embed_query(text[:200])
+            query_ms.append((time.perf_counter() - query_start) * 1000)
+        rows.append({"backend": "onnx-int8", "threads": onnx_embeddings.threads, "startup s": onnx_startup,
+                     "chunks/s": len(texts) / seconds, "query p50 ms": percentile(query_ms, 50)})
+        onnx_vectors = vectors
+
+    start = time.perf_counter()
+    torch_embeddings = load_embeddings()
+    torch_startup = time.perf_counter() - start
+    start = time.perf_counter()
+    torch_vectors = torch_embeddings.embed_documents(texts)
+    seconds = time.perf_counter() - start
+    query_ms = []
+    for text in texts[:50]:
+        query_start = time.perf_counter()
+        torch_embeddings.embed_query(text[:200])
+        query_ms.append((time.perf_counter() - query_start) * 1000)
+    rows.append({"backend": "pytorch", "threads": "-", "startup s": torch_startup,
+                 "chunks/s": len(texts) / seconds, "query p50 ms": percentile(query_ms, 50)})
+
+    print_rows(rows)
+    agreement = cosine_agreement(torch_vectors, onnx_vectors)
+    print(f"Cosine similarity of ONNX int8 to PyTorch embeddings: min {agreement['min']:.4f}, "
+          f"mean {agreement['mean']:.4f}")
+    if agreement["min"] < args.min_cosine:
+        print(f"WARNING: below the required {args.min_cosine}")
+        return 1
+
+
+def bench_pdf(args):
+    """Page extraction time of PyPDFLoader against the process pool, and whether their pages agree."""
+    from langchain.document_loaders import PyPDFLoader
+    from langchain.schema import Document
+    from parallel_pdf import iter_page_batches
+
+    start = time.perf_counter()
+    reference = PyPDFLoader(args.pdf).load()
+    sequential = time.perf_counter() - start
+    rows = [{"loader": "PyPDFLoader", "workers": 1, "first pages s": sequential, "total s": sequential,
+             "pages/s": len(reference) / sequential, "speedup": 1.0}]
+
+    mismatched = 0
+    for workers in [int(w) for w in args.workers.split(",")]:
+        start = time.perf_counter()
+        first = None
+        pages = []
+        for batch in iter_page_batches(args.pdf, Document, workers, args.pages_per_task):
+            # When the splitter could start
+            first = first or time.perf_counter() - start
+            pages.extend(batch)
+        seconds = time.perf_counter() - start
+        rows.append({"loader": "parallel", "workers": workers, "first pages s": first, "total s": seconds,
+                     "pages/s": len(pages) / seconds, "speedup": sequential / seconds})
+        mismatched += sum(1 for ours, theirs in zip(pages, reference)
+                          if ours.page_content != theirs.page_content or ours.metadata != theirs.metadata)
+        mismatched += abs(len(pages) - len(reference))
+
+    print_rows(rows)
+    if mismatched:
+        print(f"WARNING: {mismatched} pages differ from PyPDFLoader's")
+        return 1
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(description="Benchmarks for the RAG retrieval stack")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    backends = commands.add_parser("backends", help="Compare Milvus with the in-process vector indexes")
+    backends.add_argument("pdf", help="PDF to ingest")
+    backends.add_argument("--queries", help="File with one question per line (default: sampled from the PDF)")
+    backends.add_argument("--num-queries", type=int, default=200)
+    backends.add_argument("-k", type=int, default=10)
+    backends.add_argument("--skip-milvus", action="store_true", help="Only benchmark the in-process indexes")
+    backends.set_defaults(run=bench_backends)
+
+    sweep = commands.add_parser("sweep", help="Recall@k against latency of Milvus index types and search parameters")
+    sweep.add_argument("pdf", help="PDF to ingest")
+    sweep.add_argument("--queries", help="File with one question per line (default: sampled from the PDF)")
+    sweep.add_argument("--num-queries", type=int, default=200)
+    sweep.add_argument("-k", type=int, default=10)
+    sweep.add_argument("--index-types", default="HNSW,IVF_FLAT,IVF_SQ8,IVF_PQ")
+    sweep.add_argument("--ef", default="16,32,64,128,256", help="HNSW ef values")
+    sweep.add_argument("--nprobe", default="1,4,8,16,32,64", help="IVF nprobe values")
+    sweep.add_argument("--replicas", type=int, default=1)
+    sweep.set_defaults(run=bench_sweep)
+
+    quantization = commands.add_parser("quantization", help="Compressed vectors against the float32 baseline")
+    quantization.add_argument("pdf", help="PDF to ingest")
+    quantization.add_argument("--queries", help="File with one question per line (default: sampled from the PDF)")
+    quantization.add_argument("--num-queries", type=int, default=200)
+    quantization.add_argument("-k", type=int, default=10)
+    quantization.add_argument("--dtypes", default="float32,float16,int8,binary")
+    quantization.add_argument("--rerank-factor", type=int, default=4)
+    quantization.add_argument("--milvus", action="store_true", help="Also measure Milvus collections")
+    quantization.set_defaults(run=bench_quantization)
+
+    embedding = commands.add_parser("embeddings", help="ONNX int8 embeddings against PyTorch")
+    embedding.add_argument("pdf", help="PDF whose chunks are embedded")
+    embedding.add_argument("--onnx-dir", default=os.getenv("RAG_ONNX_DIR", "/tmp/onnx/all-MiniLM-L6-v2"))
+    embedding.add_argument("--threads", default="1,2,4,8", help="Intra-op thread counts to try")
+    embedding.add_argument("--max-texts", type=int, default=2000)
+    embedding.add_argument("--min-cosine", type=float, default=0.98)
+    embedding.set_defaults(run=bench_embeddings)
+
+    pdf = commands.add_parser("pdf", help="Parallel page extraction against PyPDFLoader")
+    pdf.add_argument("pdf", help="PDF to extract")
+    pdf.add_argument("--workers", default="2,4,8", help="Worker process counts to try")
+    pdf.add_argument("--pages-per-task", type=int, default=0, help="0 sizes page ranges from the page count")
+    pdf.set_defaults(run=bench_pdf)
+
+    args = parser.parse_args(argv)
+    return args.run(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
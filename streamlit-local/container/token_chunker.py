@@ -0,0 +1,163 @@
+import os
+import re
+import sys
+import time
+from typing import List, Dict, Any
+
+# Chunk size in word pieces; 0 means the embedding model's own limit (256 for all-MiniLM-L6-v2)
+RAG_CHUNK_TOKENS = int(os.getenv("RAG_CHUNK_TOKENS", "0"))
+# Word pieces repeated at the start of the next chunk
+RAG_CHUNK_OVERLAP = int(os.getenv("RAG_CHUNK_OVERLAP", "32"))
+# "tokens" for the tokenizer-aware chunker, "characters" for the original CharacterTextSplitter
+RAG_SPLITTER = os.getenv("RAG_SPLITTER", "tokens")
+
+# Sentence ends, and blank lines between paragraphs
+SENTENCE_BOUNDARY = re.compile(r"(?<=[.!?])\s+|\n\s*\n")
+
+
+def split_sentences(text: str) -> List[str]:
+    """Split page text into sentences, joining the hard line breaks of PDF extraction."""
+    sentences = []
+    for sentence in SENTENCE_BOUNDARY.split(text):
+        sentence = " ".join(sentence.split())
+        if sentence:
+            sentences.append(sentence)
+    return sentences
+
+
+class TokenChunker:
+    """
+    Split documents into chunks that fill the embedding model's input window.
+
+    Sentences are measured with the model's own fast tokenizer (one batch call
+    per page) and packed until the next one would exceed max_tokens; a sentence
+    longer than that is cut at word-piece boundaries. Each chunk starts with the
+    trailing sentences of the previous one, up to overlap tokens. Chunks never
+    span pages, so the source/page metadata used for citations stays exact.
+    """
+
+    def __init__(self, tokenizer, max_tokens: int, overlap: int = RAG_CHUNK_OVERLAP):
+        """
+        Args:
+            tokenizer: A Hugging Face fast tokenizer
+            max_tokens: Input window of the embedding model, including special tokens
+            overlap: Word pieces repeated from the end of the previous chunk
+        """
+        self.tokenizer = tokenizer
+        self.max_tokens = max_tokens
+        # [CLS] and [SEP] take two positions of the window
+        self.content_tokens = max_tokens - tokenizer.num_special_tokens_to_add(pair=False)
+        self.overlap = min(overlap, self.content_tokens // 2)
+
+    @classmethod
+    def from_embeddings(cls, embeddings, max_tokens: int = RAG_CHUNK_TOKENS,
+                        overlap: int = RAG_CHUNK_OVERLAP) -> "TokenChunker":
+        """Chunker using the tokenizer and input limit of a LangChain HuggingFaceEmbeddings model."""
+        model = embeddings.client
+        return cls(model.tokenizer, max_tokens or model.max_seq_length, overlap)
+
+    def _cut(self, sentence: str, offsets: List[tuple]) -> List[str]:
+        """Cut a sentence that is longer than a chunk at word-piece boundaries."""
+        pieces = []
+        step = self.content_tokens - self.overlap
+        for start in range(0, len(offsets), step):
+            window = offsets[start:start + self.content_tokens]
+            pieces.append(sentence[window[0][0]:window[-1][1]])
+            if start + self.content_tokens >= len(offsets):
+                break
+        return pieces
+
+    def split_text(self, text: str) -> List[str]:
+        """Split one page of text into chunks."""
+        sentences = split_sentences(text)
+        if not sentences:
+            return []
+        encoded = self.tokenizer(sentences, add_special_tokens=False, return_offsets_mapping=True)
+
+        units = []
+        for sentence, offsets in zip(sentences, encoded["offset_mapping"]):
+            if len(offsets) <= self.content_tokens:
+                units.append((sentence, len(offsets)))
+            else:
+                for piece in self._cut(sentence, offsets):
+                    units.append((piece, len(self.tokenizer.tokenize(piece))))
+
+        chunks = []
+        current, used = [], 0
+        for unit, tokens in units:
+            # Joining with a space never merges word pieces, so lengths add up
+            if current and used + tokens > self.content_tokens:
+                chunks.append(" ".join(u for u, _ in current))
+                carried, carried_tokens = [], 0
+                for previous in reversed(current):
+                    if carried_tokens + previous[1] > self.overlap:
+                        break
+                    carried.insert(0, previous)
+                    carried_tokens += previous[1]
+                # Keep the overlap small enough that the new sentence fits
+                while carried and carried_tokens + tokens > self.content_tokens:
+                    carried_tokens -= carried.pop(0)[1]
+                current, used = carried, carried_tokens
+            current.append((unit, tokens))
+            used += tokens
+        if current:
+            chunks.append(" ".join(u for u, _ in current))
+        return chunks
+
+    def split_documents(self, documents: List[Any]) -> List[Any]:
+        """Split LangChain documents, keeping each page's metadata on its chunks."""
+        chunks = []
+        for doc in documents:
+            for text in self.split_text(doc.page_content):
+                chunks.append(type(doc)(page_content=text, metadata=dict(doc.metadata)))
+        return chunks
+
+
+def chunking_report(tokenizer, chunks: List[Any], max_tokens: int) -> Dict[str, Any]:
+    """Chunk count, token length and the share of chunks the embedding model truncates."""
+    if not chunks:
+        return {"chunks": 0, "mean_tokens": 0.0, "max_tokens": 0, "truncated": 0.0}
+    lengths = [len(ids) for ids in tokenizer([c.page_content for c in chunks], add_special_tokens=True)["input_ids"]]
+    return {
+        "chunks": len(chunks),
+        "mean_tokens": sum(lengths) / len(lengths),
+        "max_tokens": max(lengths),
+        "truncated": sum(1 for n in lengths if n > max_tokens) / len(lengths),
+    }
+
+
+def compare_splitters(pdf_path: str, model_name: str, cache_folder: str = None):
+    """Print chunking and embedding cost of CharacterTextSplitter against TokenChunker for one PDF."""
+    from langchain.document_loaders import PyPDFLoader
+    from langchain.embeddings import HuggingFaceEmbeddings
+    from langchain.text_splitter import CharacterTextSplitter
+
+    pages = PyPDFLoader(pdf_path).load()
+    embeddings = HuggingFaceEmbeddings(model_name=model_name, cache_folder=cache_folder,
+                                       model_kwargs={'device': 'cpu'}, encode_kwargs={'normalize_embeddings': True})
+    chunker = TokenChunker.from_embeddings(embeddings)
+    splitters = {
+        "characters": CharacterTextSplitter(separator="\n", chunk_size=768, chunk_overlap=0),
+        "tokens": chunker,
+    }
+
+    print(f"{'splitter':<12}{'chunks':>8}{'mean tok':>10}{'max tok':>9}{'truncated':>11}{'split s':>9}{'embed s':>9}")
+    for name, splitter in splitters.items():
+        start = time.perf_counter()
+        chunks = splitter.split_documents(pages)
+        split_seconds = time.perf_counter() - start
+        report = chunking_report(chunker.tokenizer, chunks, chunker.max_tokens)
+        start = time.perf_counter()
+        embeddings.embed_documents([c.page_content for c in chunks])
+        embed_seconds = time.perf_counter() - start
+        print(f"{name:<12}{report['chunks']:>8}{report['mean_tokens']:>10.1f}{report['max_tokens']:>9}"
+              f"{report['truncated']:>11.1%}{split_seconds:>9.2f}{embed_seconds:>9.2f}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("usage: python token_chunker.py <pdf> [model name] [cache folder]")
+        sys.exit(1)
+    compare_splitters(sys.argv[1],
+                      sys.argv[2] if len(sys.argv) > 2 else "sentence-transformers/all-MiniLM-L6-v2",
+                      sys.argv[3] if len(sys.argv) > 3 else None)
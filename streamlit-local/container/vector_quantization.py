@@ -0,0 +1,92 @@
+import os
+import numpy as np
+from typing import List, Tuple
+
+# Stored precision of the embeddings: float32, float16, int8 or binary
+RAG_VECTOR_DTYPE = os.getenv("RAG_VECTOR_DTYPE", "float32")
+# Fetch k * factor candidates from the compressed vectors and rerank them with the
+# float32 vectors kept on disk; 0 disables reranking
+RAG_RERANK_FACTOR = int(os.getenv("RAG_RERANK_FACTOR", "4"))
+
+VECTOR_DTYPES = ("float32", "float16", "int8", "binary")
+
+# Popcount of every byte value, for Hamming distances of packed bit vectors
+BIT_COUNTS = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+# Rows upcast to float32 at a time when scoring float16/int8 codes; 1024 rows of
+# 384 dimensions are 1.5 MB, small enough to stay in cache for the matmul
+SCORE_BLOCK_ROWS = 1024
+
+
+def quantize(vectors: np.ndarray, dtype: str) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Compress normalized float32 vectors.
+
+    float16 halves the size, int8 quarters it with one scale per dimension,
+    binary keeps only the sign of each dimension (1/32 of the size).
+
+    Returns:
+        Tuple of (codes, per-dimension scale; ones unless dtype is int8)
+    """
+    if dtype not in VECTOR_DTYPES:
+        raise ValueError(f"Unsupported vector dtype '{dtype}', expected one of {', '.join(VECTOR_DTYPES)}")
+    vectors = np.asarray(vectors, dtype=np.float32)
+    scale = np.ones(vectors.shape[1], dtype=np.float32)
+    if dtype == "float32":
+        return vectors, scale
+    if dtype == "float16":
+        return vectors.astype(np.float16), scale
+    if dtype == "int8":
+        scale = np.clip(np.abs(vectors).max(axis=0), 1e-12, None) / 127.0
+        return np.round(vectors / scale).astype(np.int8), scale.astype(np.float32)
+    return np.packbits(vectors > 0, axis=1), scale
+
+
+def pack_bits(vector: np.ndarray) -> np.ndarray:
+    """Sign bits of one vector, packed like quantize(..., "binary")."""
+    return np.packbits(np.asarray(vector) > 0)
+
+
+def approximate_scores(codes: np.ndarray, scale: np.ndarray, dtype: str, query: np.ndarray) -> np.ndarray:
+    """
+    Similarity of a float32 query to every compressed vector, higher is better.
+
+    Binary codes are compared by Hamming distance, mapped to the cosine of the
+    angle it estimates so all dtypes share one scale. float16 and int8 codes are
+    upcast in row blocks and scored with a float32 (BLAS) matmul; numpy has no
+    fast float16 or int8 matmul, and upcasting the whole matrix per query costs
+    as much memory as the float32 vectors.
+    """
+    if dtype == "binary":
+        dimension = len(query)
+        distances = BIT_COUNTS[np.bitwise_xor(codes, pack_bits(query))].sum(axis=1, dtype=np.int32)
+        return np.cos(np.pi * distances / dimension)
+    query = np.asarray(query, dtype=np.float32)
+    if dtype == "float32":
+        return codes @ query
+    if dtype == "int8":
+        # codes * scale @ query == codes @ (scale * query), folded once per query
+        query = query * scale
+    scores = np.empty(len(codes), dtype=np.float32)
+    for start in range(0, len(codes), SCORE_BLOCK_ROWS):
+        end = start + SCORE_BLOCK_ROWS
+        scores[start:end] = codes[start:end].astype(np.float32) @ query
+    return scores
+
+
+def top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """Indices of the k highest scores, best first."""
+    k = min(k, len(scores))
+    if k == 0:
+        return np.array([], dtype=np.int64)
+    top = np.argpartition(-scores, k - 1)[:k]
+    return top[np.argsort(-scores[top])]
+
+
+def rerank(full_vectors: np.ndarray, candidates: np.ndarray, query: np.ndarray, k: int) -> List[Tuple[int, float]]:
+    """Exact inner products of candidates against float32 vectors (usually memory-mapped), best k first."""
+    candidates = np.sort(np.asarray(candidates, dtype=np.int64))
+    # Sorted row order keeps the reads from a memory map sequential
+    scores = np.asarray(full_vectors[candidates], dtype=np.float32) @ query
+    best = top_k(scores, k)
+    return [(int(candidates[i]), float(scores[i])) for i in best]
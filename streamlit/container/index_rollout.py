@@ -0,0 +1,274 @@
+import os
+import time
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# Longest wait for searches on a replaced index before it is dropped anyway
+RAG_DRAIN_TIMEOUT = float(os.getenv("RAG_DRAIN_TIMEOUT", "60"))
+# How often a pod checks whether another pod activated a new index version
+RAG_VERSION_POLL_INTERVAL = float(os.getenv("RAG_VERSION_POLL_INTERVAL", "10"))
+
+# File naming the index in use among the versioned local indexes, the local counterpart of a Milvus alias
+CURRENT = "CURRENT"
+
+
+def read_current(directory: str) -> Optional[str]:
+    """Name of the local index in use, if one was activated."""
+    try:
+        with open(os.path.join(directory, CURRENT)) as file:
+            return file.read().strip() or None
+    except OSError:
+        return None
+
+
+def write_current(directory: str, name: str):
+    """Make name the local index in use; readers see either the old or the new name."""
+    os.makedirs(directory, exist_ok=True)
+    temporary = os.path.join(directory, CURRENT + ".tmp")
+    with open(temporary, "w") as file:
+        file.write(name)
+    os.replace(temporary, os.path.join(directory, CURRENT))
+
+
+class ServingIndex:
+    """
+    The retriever answering questions, replaced atomically by a newer version.
+
+    Searches take the current retriever with acquire(), which counts them per
+    version, so a replaced version can be dropped once its last search has
+    finished (drain()). Whoever activates and publishes a version holds
+    switch_lock meanwhile, so the two steps are seen together.
+    """
+
+    def __init__(self):
+        self.switch_lock = threading.Lock()
+        self._condition = threading.Condition()
+        self._inflight = Counter()
+        self.version = None
+        self.retriever = None
+        self.published_at = None
+
+    @property
+    def ready(self) -> bool:
+        """Whether there is an index to search."""
+        return self.retriever is not None
+
+    def publish(self, version: str, retriever) -> Tuple[Optional[str], Any]:
+        """
+        Serve a new version; searches already running finish on the old one.
+
+        Returns:
+            Tuple of (previous version, previous retriever), both None at first
+        """
+        with self._condition:
+            previous = (self.version, self.retriever)
+            self.version, self.retriever = version, retriever
+            self.published_at = time.time()
+        return previous
+
+    @contextmanager
+    def acquire(self):
+        """Current (version, retriever), counted as in flight until the block ends."""
+        with self._condition:
+            if self.retriever is None:
+                raise RuntimeError("No index is being served yet")
+            version, retriever = self.version, self.retriever
+            self._inflight[version] += 1
+        try:
+            yield version, retriever
+        finally:
+            with self._condition:
+                self._inflight[version] -= 1
+                if not self._inflight[version]:
+                    del self._inflight[version]
+                    self._condition.notify_all()
+
+    def drain(self, version: str, timeout: float = RAG_DRAIN_TIMEOUT) -> bool:
+        """Wait until no search uses version; False if some still did after timeout seconds."""
+        with self._condition:
+            return self._condition.wait_for(lambda: not self._inflight.get(version), timeout)
+
+    def inflight(self) -> Dict[str, int]:
+        """Searches running, per version."""
+        with self._condition:
+            return dict(self._inflight)
+
+
+class IngestionJob:
+    """
+    Build a new index version in a background thread while the current one serves.
+
+    The job calls three functions of the app:
+        build(progress, current_version) -> (version, retriever), or None when
+            current_version is already up to date; a retriever for
+            current_version itself replaces the served one, e.g. once files
+            it was missing are restored
+        activate(version): make the version the one found at startup (a Milvus
+            alias, or the CURRENT file of local indexes)
+        retire(version): drop an index that is no longer served
+        active() -> version: the version activated last by any pod (optional)
+
+    After build, the new version is activated and published, searches on the
+    previous version are drained, and the previous version is retired. Other
+    pods serving the previous version switch to the new one within their
+    VersionFollower's interval, so retiring waits retire_grace seconds after
+    activation; it is skipped if another pod has activated the previous
+    version again meanwhile.
+    """
+
+    def __init__(self, serving: ServingIndex, build: Callable, activate: Callable[[str], None],
+                 retire: Callable[[str], None], drain_timeout: float = RAG_DRAIN_TIMEOUT,
+                 active: Optional[Callable[[], Optional[str]]] = None,
+                 retire_grace: float = 2 * RAG_VERSION_POLL_INTERVAL):
+        self.serving = serving
+        self.build = build
+        self.activate = activate
+        self.retire = retire
+        self.drain_timeout = drain_timeout
+        self.active = active
+        self.retire_grace = retire_grace
+        self.steps: List[Tuple[float, str]] = []
+        self.built_version = None
+        self.started_at = None
+        self.finished_at = None
+        self.error = None
+        self._thread = None
+
+    def progress(self, message: str):
+        """Record a step; shown in the app while the job runs."""
+        self.steps.append((time.time(), message))
+        print(message)
+
+    def _run(self):
+        """Thread body."""
+        try:
+            current = self.serving.version
+            result = self.build(self.progress, current)
+            if result is None:
+                self.progress(f"Index {current} is up to date")
+                return
+            version, retriever = result
+            with self.serving.switch_lock:
+                self.activate(version)
+                previous, previous_retriever = self.serving.publish(version, retriever)
+            activated_at = time.time()
+            self.built_version = version
+            self.progress(f"Serving {version}")
+            if previous is None or previous == version:
+                return
+
+            self.progress(f"Waiting for searches on {previous} to finish...")
+            if not self.serving.drain(previous, self.drain_timeout):
+                self.progress(f"Searches on {previous} still running after {self.drain_timeout:.0f}s, dropping it anyway")
+            if previous_retriever is not None:
+                previous_retriever.close()
+            remaining = activated_at + self.retire_grace - time.time()
+            if remaining > 0:
+                self.progress(f"Waiting {remaining:.0f}s for other pods to switch to {version}...")
+                time.sleep(remaining)
+            if self.active is not None and self.active() == previous:
+                self.progress(f"{previous} was activated again by another pod, keeping it")
+                return
+            self.retire(previous)
+            self.progress(f"Dropped {previous}")
+        except Exception as e:
+            self.error = str(e)
+            self.progress(f"Ingestion failed: {e}")
+        finally:
+            self.finished_at = time.time()
+
+    def start(self) -> "IngestionJob":
+        """Start the background thread."""
+        self.started_at = time.time()
+        self._thread = threading.Thread(target=self._run, name="ingestion", daemon=True)
+        self._thread.start()
+        return self
+
+    @property
+    def running(self) -> bool:
+        """Whether the job is still running."""
+        return self._thread is not None and self._thread.is_alive()
+
+    @property
+    def step(self) -> str:
+        """The latest step."""
+        return self.steps[-1][1] if self.steps else "Starting..."
+
+    def status(self) -> Dict[str, Any]:
+        """Progress of the job for display."""
+        end = self.finished_at or time.time()
+        return {
+            "running": self.running,
+            "serving": self.serving.version,
+            "built": self.built_version,
+            "steps": [f"{at - self.started_at:6.1f}s {message}" for at, message in self.steps],
+            "seconds": round(end - self.started_at, 1) if self.started_at else 0.0,
+            "error": self.error,
+        }
+
+
+class VersionFollower:
+    """
+    Serve the index version activated last, whichever pod activated it.
+
+    Pods sharing the vector store each run ingestion; a pod whose served
+    version is no longer the active one opens the active version and
+    switches to it, at most interval seconds after it was activated, and
+    closes the old retriever once its searches have drained. The pod that
+    activated the version retires the old one.
+    """
+
+    def __init__(self, serving: ServingIndex, active: Callable[[], Optional[str]],
+                 open_version: Callable[[str], Any], interval: float = RAG_VERSION_POLL_INTERVAL,
+                 drain_timeout: float = RAG_DRAIN_TIMEOUT):
+        self.serving = serving
+        self.active = active
+        self.open_version = open_version
+        self.interval = interval
+        self.drain_timeout = drain_timeout
+        self.switches = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def poll(self) -> bool:
+        """Switch to the active version if it is not the served one; True if switched."""
+        version = self.active()
+        if not version or version == self.serving.version:
+            return False
+        # Opening may take a while (loading, restoring files), so it happens outside the lock
+        retriever = self.open_version(version)
+        if retriever is None:
+            return False
+        with self.serving.switch_lock:
+            if version == self.serving.version or self.active() != version:
+                # This pod's own ingestion published it meanwhile, or yet another version is active
+                retriever.close()
+                return False
+            previous, previous_retriever = self.serving.publish(version, retriever)
+        self.switches += 1
+        print(f"Serving {version}, activated by another pod")
+        if previous is not None:
+            self.serving.drain(previous, self.drain_timeout)
+        if previous_retriever is not None:
+            previous_retriever.close()
+        return True
+
+    def _run(self):
+        """Thread body."""
+        while not self._stop.wait(self.interval):
+            try:
+                self.poll()
+            except Exception as e:
+                print(f"Checking the active index version failed: {e}")
+
+    def start(self) -> "VersionFollower":
+        """Start the background thread."""
+        self._thread = threading.Thread(target=self._run, name="version-follower", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop the background thread."""
+        self._stop.set()
@@ -0,0 +1,239 @@
+import os
+import json
+import numpy as np
+from typing import List, Dict, Any, Optional, Tuple
+
+from hybrid_retriever import corpus_fingerprint, document_key
+from vector_quantization import quantize, approximate_scores, top_k, rerank, RAG_VECTOR_DTYPE, RAG_RERANK_FACTOR
+
+try:
+    import hnswlib
+except ImportError:
+    hnswlib = None
+
+# "milvus" for the Milvus service, "local" for the in-process index
+RAG_VECTOR_STORE = os.getenv("RAG_VECTOR_STORE", "milvus")
+# Directory holding the memory-mapped vectors and the HNSW graph
+RAG_LOCAL_INDEX_DIR = os.getenv("RAG_LOCAL_INDEX_DIR", "/work/index")
+# "exact", "hnsw", or "auto" to search exactly up to RAG_EXACT_MAX_VECTORS
+RAG_LOCAL_INDEX = os.getenv("RAG_LOCAL_INDEX", "auto")
+RAG_EXACT_MAX_VECTORS = int(os.getenv("RAG_EXACT_MAX_VECTORS", "50000"))
+# HNSW graph degree, build and search beam widths
+HNSW_M = int(os.getenv("RAG_HNSW_M", "16"))
+HNSW_EF_CONSTRUCTION = int(os.getenv("RAG_HNSW_EF_CONSTRUCTION", "200"))
+HNSW_EF_SEARCH = int(os.getenv("RAG_HNSW_EF", "64"))
+
+MANIFEST = "manifest.json"
+VECTORS = "vectors.f32.npy"
+SCALE = "scale.npy"
+DOCUMENTS = "documents.json"
+GRAPH = "hnsw.bin"
+
+
+class LocalVectorStore:
+    """
+    In-process vector index over normalized embeddings.
+
+    Vectors live in a .npy file that is memory-mapped, so pods sharing the
+    volume share the page cache and a restart does not re-embed. Small corpora
+    are searched exactly with one matrix-vector product; larger ones through an
+    hnswlib graph stored next to the vectors. Scores are cosine similarities
+    (inner products of normalized vectors), higher is better. Implements the
+    similarity_search_with_score() subset of the LangChain vector store API
+    used by the app.
+
+    With a compressed dtype (float16, int8, binary) the exact scan runs over
+    the compressed codes, and the best k * rerank_factor candidates are
+    rescored against the float32 vectors, of which only those rows are read.
+
+    Searches restricted to some documents (their source metadata) only read
+    those documents' rows, or filter the HNSW graph traversal to them.
+    chunk_vectors() returns the stored vectors of chunks, so the prompt packer
+    does not embed them again.
+    """
+
+    def __init__(self, embedding, docs: List[Any], vectors: np.ndarray, graph=None,
+                 codes: np.ndarray = None, scale: np.ndarray = None, dtype: str = "float32",
+                 rerank_factor: int = RAG_RERANK_FACTOR):
+        self.embedding_func = embedding
+        self.docs = docs
+        self.vectors = vectors
+        self.graph = graph
+        self.kind = "hnsw" if graph is not None else "exact"
+        self.dtype = dtype
+        self.codes = codes if codes is not None else vectors
+        self.scale = scale
+        self.rerank_factor = rerank_factor
+        rows_by_source = {}
+        for row, doc in enumerate(docs):
+            rows_by_source.setdefault(str(doc.metadata.get("source", "")), []).append(row)
+        self.rows_by_source = {source: np.array(rows, dtype=np.int64) for source, rows in rows_by_source.items()}
+        self.row_by_key = {document_key(doc): row for row, doc in enumerate(docs)}
+
+    @staticmethod
+    def _choose_kind(count: int, kind: str) -> str:
+        if kind == "auto":
+            kind = "exact" if count <= RAG_EXACT_MAX_VECTORS else "hnsw"
+        if kind == "hnsw" and hnswlib is None:
+            print("hnswlib is not installed, searching exactly")
+            kind = "exact"
+        return kind
+
+    @staticmethod
+    def _choose_dtype(kind: str, dtype: str) -> str:
+        if kind == "hnsw" and dtype != "float32":
+            # hnswlib keeps float32 vectors in its graph
+            print(f"The HNSW index stores float32 vectors, ignoring vector dtype {dtype}")
+            return "float32"
+        return dtype
+
+    @staticmethod
+    def _codes_file(dtype: str) -> str:
+        return f"codes.{dtype}.npy"
+
+    @classmethod
+    def from_documents(cls, docs: List[Any], embedding, directory: str = RAG_LOCAL_INDEX_DIR,
+                       kind: str = RAG_LOCAL_INDEX, dtype: str = RAG_VECTOR_DTYPE) -> "LocalVectorStore":
+        """Embed documents and write the index to a directory."""
+        vectors = np.asarray(embedding.embed_documents([doc.page_content for doc in docs]), dtype=np.float32)
+        return cls.from_vectors(docs, vectors, embedding, directory, kind, dtype)
+
+    @classmethod
+    def from_vectors(cls, docs: List[Any], vectors: np.ndarray, embedding, directory: str = RAG_LOCAL_INDEX_DIR,
+                     kind: str = RAG_LOCAL_INDEX, dtype: str = RAG_VECTOR_DTYPE) -> "LocalVectorStore":
+        """Write an index from precomputed embeddings."""
+        os.makedirs(directory, exist_ok=True)
+        vectors = vectors / np.clip(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12, None)
+        kind = cls._choose_kind(len(docs), kind)
+        dtype = cls._choose_dtype(kind, dtype)
+        if os.path.exists(os.path.join(directory, MANIFEST)):
+            os.remove(os.path.join(directory, MANIFEST))
+
+        # The float32 vectors are always kept: for HNSW, exact search and reranking
+        arrays = {VECTORS: vectors}
+        if dtype != "float32":
+            codes, scale = quantize(vectors, dtype)
+            arrays[cls._codes_file(dtype)] = codes
+            np.save(os.path.join(directory, SCALE), scale)
+        for name, array in arrays.items():
+            stored = np.lib.format.open_memmap(os.path.join(directory, name), mode="w+",
+                                               dtype=array.dtype, shape=array.shape)
+            stored[:] = array
+            stored.flush()
+            del stored
+
+        with open(os.path.join(directory, DOCUMENTS), "w") as file:
+            json.dump([{"text": doc.page_content, "metadata": doc.metadata} for doc in docs], file, default=str)
+
+        if kind == "hnsw":
+            graph = hnswlib.Index(space="ip", dim=vectors.shape[1])
+            graph.init_index(max_elements=len(vectors), ef_construction=HNSW_EF_CONSTRUCTION, M=HNSW_M)
+            graph.add_items(vectors, np.arange(len(vectors)))
+            graph.save_index(os.path.join(directory, GRAPH))
+
+        # Written last, so an interrupted build is never mistaken for a complete one
+        with open(os.path.join(directory, MANIFEST), "w") as file:
+            json.dump({"fingerprint": corpus_fingerprint(docs), "kind": kind, "dtype": dtype,
+                       "count": len(docs), "dimension": int(vectors.shape[1])}, file)
+        return cls.load(directory, embedding, type(docs[0]))
+
+    @classmethod
+    def load(cls, directory: str, embedding, document_class) -> "LocalVectorStore":
+        """Open an index written by from_documents(); the vectors are memory-mapped, not read."""
+        with open(os.path.join(directory, MANIFEST)) as file:
+            manifest = json.load(file)
+        with open(os.path.join(directory, DOCUMENTS)) as file:
+            docs = [document_class(page_content=d["text"], metadata=d["metadata"]) for d in json.load(file)]
+        vectors = np.load(os.path.join(directory, VECTORS), mmap_mode="r")
+
+        graph = None
+        if manifest["kind"] == "hnsw":
+            graph = hnswlib.Index(space="ip", dim=manifest["dimension"])
+            graph.load_index(os.path.join(directory, GRAPH), max_elements=manifest["count"])
+            graph.set_ef(HNSW_EF_SEARCH)
+
+        dtype = manifest.get("dtype", "float32")
+        codes = scale = None
+        if dtype != "float32":
+            codes = np.load(os.path.join(directory, cls._codes_file(dtype)), mmap_mode="r")
+            scale = np.load(os.path.join(directory, SCALE))
+        return cls(embedding, docs, vectors, graph, codes, scale, dtype)
+
+    @classmethod
+    def load_or_build(cls, docs: List[Any], embedding, directory: str = RAG_LOCAL_INDEX_DIR,
+                      kind: str = RAG_LOCAL_INDEX, dtype: str = RAG_VECTOR_DTYPE,
+                      vectors: np.ndarray = None) -> "LocalVectorStore":
+        """Open the index in directory if it holds these chunks, otherwise build it from vectors or by embedding."""
+        manifest_path = os.path.join(directory, MANIFEST)
+        if docs and os.path.exists(manifest_path):
+            try:
+                with open(manifest_path) as file:
+                    manifest = json.load(file)
+                wanted = cls._choose_kind(len(docs), kind)
+                if (manifest["fingerprint"] == corpus_fingerprint(docs) and manifest["kind"] == wanted
+                        and manifest.get("dtype", "float32") == cls._choose_dtype(wanted, dtype)):
+                    return cls.load(directory, embedding, type(docs[0]))
+            except (OSError, ValueError, KeyError, RuntimeError) as e:
+                print(f"Rebuilding unreadable local index in {directory}: {e}")
+        if vectors is not None:
+            return cls.from_vectors(docs, np.asarray(vectors, dtype=np.float32), embedding, directory, kind, dtype)
+        return cls.from_documents(docs, embedding, directory, kind, dtype)
+
+    def similarity_search_by_vector_with_score(self, vector: List[float], k: int = 4,
+                                               sources: Optional[List[str]] = None) -> List[Tuple[Any, float]]:
+        """The k nearest chunks to an embedding, with cosine similarities; sources restricts them to those documents."""
+        query = np.asarray(vector, dtype=np.float32)
+        query /= max(np.linalg.norm(query), 1e-12)
+        rows = None
+        if sources is not None:
+            selected = [self.rows_by_source[source] for source in sources if source in self.rows_by_source]
+            rows = np.sort(np.concatenate(selected)) if selected else np.array([], dtype=np.int64)
+        k = min(k, len(self.docs) if rows is None else len(rows))
+        if k == 0:
+            return []
+
+        if self.graph is not None:
+            if rows is None:
+                labels, distances = self.graph.knn_query(query, k=k)
+            else:
+                allowed = set(rows.tolist())
+                labels, distances = self.graph.knn_query(query, k=k, filter=lambda label: label in allowed)
+            # hnswlib's "ip" space reports 1 - inner product
+            return [(self.docs[int(label)], float(1.0 - distance)) for label, distance in zip(labels[0], distances[0])]
+
+        # Positions in the scanned subset map back to rows
+        row_of = (lambda i: int(i)) if rows is None else (lambda i: int(rows[i]))
+        if self.dtype == "float32":
+            vectors = self.vectors if rows is None else self.vectors[rows]
+            scores = vectors @ query
+            return [(self.docs[row_of(i)], float(scores[i])) for i in top_k(scores, k)]
+
+        codes = self.codes if rows is None else self.codes[rows]
+        scores = approximate_scores(codes, self.scale, self.dtype, query)
+        if self.rerank_factor <= 0:
+            return [(self.docs[row_of(i)], float(scores[i])) for i in top_k(scores, k)]
+        candidates = [row_of(i) for i in top_k(scores, k * self.rerank_factor)]
+        return [(self.docs[i], score) for i, score in rerank(self.vectors, candidates, query, k)]
+
+    def similarity_search_with_score(self, query: str, k: int = 4,
+                                     sources: Optional[List[str]] = None) -> List[Tuple[Any, float]]:
+        """The k nearest chunks to a question, with cosine similarities."""
+        return self.similarity_search_by_vector_with_score(self.embedding_func.embed_query(query), k, sources)
+
+    def chunk_vectors(self, docs: List[Any]) -> List[Optional[np.ndarray]]:
+        """Stored normalized vectors of chunks, including keyword hits; None for chunks not in the index."""
+        rows = [self.row_by_key.get(document_key(doc)) for doc in docs]
+        return [None if row is None else np.asarray(self.vectors[row], dtype=np.float32) for row in rows]
+
+    def chunks(self) -> List[Any]:
+        """All chunks of the index in row order, e.g. to rebuild the keyword index."""
+        return list(self.docs)
+
+    def documents(self) -> List[str]:
+        """Sources of the documents in the index."""
+        return sorted(self.rows_by_source)
+
+    def stats(self) -> Dict[str, Any]:
+        """Index kind, size and the bytes scanned per query."""
+        return {"kind": self.kind, "dtype": self.dtype, "vectors": len(self.docs),
+                "bytes": int(self.codes.nbytes), "float32_bytes": int(self.vectors.nbytes)}
@@ -0,0 +1,194 @@
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+from typing import List, Dict
+
+# "pytorch" for sentence-transformers, "onnx" for the quantized ONNX Runtime model
+RAG_EMBEDDINGS = os.getenv("RAG_EMBEDDINGS", "pytorch")
+# Directory of the exported model; exported on first use if missing
+RAG_ONNX_DIR = os.getenv("RAG_ONNX_DIR", "/work/onnx/all-MiniLM-L6-v2")
+# Intra-op threads; 0 uses every CPU the pod may run on
+RAG_ONNX_THREADS = int(os.getenv("RAG_ONNX_THREADS", "0"))
+RAG_ONNX_BATCH_SIZE = int(os.getenv("RAG_ONNX_BATCH_SIZE", "32"))
+
+FP32_MODEL = "model.onnx"
+INT8_MODEL = "model.int8.onnx"
+CONFIG = "embedding_config.json"
+INPUT_NAMES = ["input_ids", "attention_mask", "token_type_ids"]
+
+
+def default_threads() -> int:
+    """CPUs available to this process (respects cpusets, unlike os.cpu_count())."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def mean_pooling(token_embeddings: np.ndarray, attention_mask: np.ndarray) -> np.ndarray:
+    """Average of the token embeddings over real tokens, as AutoModelForSentenceEmbedding.mean_pooling."""
+    mask = attention_mask[..., None].astype(np.float32)
+    return (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+
+
+def export_onnx(source: str, output_dir: str, cache_folder: str = None, max_seq_length: int = 256,
+                quantize: bool = True) -> str:
+    """
+    Export a sentence-transformers BERT model to ONNX and quantize its weights to int8.
+
+    Needs torch, transformers and onnx; the exported model needs only onnxruntime
+    and the tokenizer.
+
+    Args:
+        source: Model name or snapshot directory
+        output_dir: Where the model, the tokenizer and the config are written
+        cache_folder: Hugging Face cache holding the model
+        max_seq_length: Input limit of the sentence-transformers model (sentence_bert_config.json)
+        quantize: Also write a dynamically int8-quantized model
+
+    Returns:
+        output_dir
+    """
+    import torch
+    from transformers import AutoModel, AutoTokenizer
+
+    os.makedirs(output_dir, exist_ok=True)
+    tokenizer = AutoTokenizer.from_pretrained(source, cache_dir=cache_folder)
+    model = AutoModel.from_pretrained(source, cache_dir=cache_folder)
+    model.eval()
+
+    sample = tokenizer(["An example sentence", "Another one"], padding=True, return_tensors="pt")
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in INPUT_NAMES + ["last_hidden_state"]}
+    with torch.no_grad():
+        torch.onnx.export(model, tuple(sample[name] for name in INPUT_NAMES), os.path.join(output_dir, FP32_MODEL),
+                          input_names=INPUT_NAMES, output_names=["last_hidden_state"],
+                          dynamic_axes=dynamic_axes, opset_version=14)
+
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        quantize_dynamic(os.path.join(output_dir, FP32_MODEL), os.path.join(output_dir, INT8_MODEL),
+                         weight_type=QuantType.QInt8)
+
+    tokenizer.save_pretrained(output_dir)
+    with open(os.path.join(output_dir, CONFIG), "w") as file:
+        json.dump({"source": source, "max_seq_length": max_seq_length, "quantized": quantize}, file)
+    return output_dir
+
+
+class OnnxEmbeddings:
+    """
+    Sentence embeddings from an exported model run by ONNX Runtime.
+
+    A drop-in for HuggingFaceEmbeddings in the app: embed_documents and
+    embed_query return mean-pooled, normalized vectors, and client.tokenizer /
+    client.max_seq_length are there for the chunker. Texts are batched by
+    length so little compute goes to padding. Importing it does not load torch.
+    """
+
+    def __init__(self, model_dir: str, threads: int = RAG_ONNX_THREADS, batch_size: int = RAG_ONNX_BATCH_SIZE,
+                 quantized: bool = True):
+        import onnxruntime
+        from transformers import AutoTokenizer
+
+        with open(os.path.join(model_dir, CONFIG)) as file:
+            config = json.load(file)
+        self.max_seq_length = config["max_seq_length"]
+        self.batch_size = batch_size
+        self.threads = threads or default_threads()
+        quantized = quantized and config.get("quantized", False)
+        self.model_name = f"{config['source']}:onnx-{'int8' if quantized else 'fp32'}"
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = self.threads
+        # One request at a time; parallelism comes from inside each operator
+        options.inter_op_num_threads = 1
+        options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = onnxruntime.InferenceSession(os.path.join(model_dir, INT8_MODEL if quantized else FP32_MODEL),
+                                                    options, providers=["CPUExecutionProvider"])
+        self.input_names = {i.name for i in self.session.get_inputs()}
+
+    @classmethod
+    def load_or_export(cls, source: str, model_dir: str = RAG_ONNX_DIR, cache_folder: str = None,
+                       **kwargs) -> "OnnxEmbeddings":
+        """Open the exported model in model_dir, exporting it from source first if needed."""
+        if not os.path.exists(os.path.join(model_dir, CONFIG)):
+            export_onnx(source, model_dir, cache_folder)
+        return cls(model_dir, **kwargs)
+
+    @property
+    def client(self):
+        # HuggingFaceEmbeddings exposes the SentenceTransformer as client
+        return self
+
+    def _embed_batch(self, texts: List[str]) -> np.ndarray:
+        encoded = self.tokenizer(texts, padding=True, truncation=True, max_length=self.max_seq_length,
+                                 return_tensors="np")
+        feed = {name: encoded[name].astype(np.int64) for name in INPUT_NAMES if name in self.input_names}
+        token_embeddings = self.session.run(None, feed)[0]
+        pooled = mean_pooling(token_embeddings, encoded["attention_mask"])
+        return pooled / np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """Embeddings of several texts, in their order."""
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        vectors = [None] * len(texts)
+        for start in range(0, len(order), self.batch_size):
+            batch = order[start:start + self.batch_size]
+            for i, vector in zip(batch, self._embed_batch([texts[i] for i in batch])):
+                vectors[i] = vector.tolist()
+        return vectors
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed_batch([text])[0].tolist()
+
+
+def load_embeddings(backend: str = RAG_EMBEDDINGS, model_name: str = "sentence-transformers/all-MiniLM-L6-v2",
+                    model_dir: str = RAG_ONNX_DIR, cache_folder: str = None, **huggingface_kwargs):
+    """
+    The embedding model of the app, so offline builds embed exactly as it does.
+
+    Args:
+        backend: "onnx" for OnnxEmbeddings, anything else for HuggingFaceEmbeddings
+        model_name: Hub id of the model (exported to model_dir if backend is "onnx")
+        model_dir: Directory of the exported ONNX model
+        cache_folder: Hugging Face cache holding the model
+        huggingface_kwargs: Further HuggingFaceEmbeddings arguments
+    """
+    if backend == "onnx":
+        # Int8-quantized model run by ONNX Runtime, without loading torch
+        return OnnxEmbeddings.load_or_export(model_name, model_dir, cache_folder=cache_folder)
+    from langchain.embeddings import HuggingFaceEmbeddings
+    return HuggingFaceEmbeddings(model_name=model_name, cache_folder=cache_folder, **huggingface_kwargs)
+
+
+def cosine_agreement(reference: np.ndarray, candidate: np.ndarray) -> Dict[str, float]:
+    """Cosine similarity between two embeddings of the same texts."""
+    reference = np.asarray(reference, dtype=np.float32)
+    candidate = np.asarray(candidate, dtype=np.float32)
+    cosines = (reference * candidate).sum(axis=1) / (
+        np.linalg.norm(reference, axis=1) * np.linalg.norm(candidate, axis=1))
+    return {"min": float(cosines.min()), "mean": float(cosines.mean())}
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(description="Export the embedding model to ONNX")
+    commands = parser.add_subparsers(dest="command", required=True)
+    export = commands.add_parser("export", help="Export and quantize a model")
+    export.add_argument("source", help="Model name or snapshot directory")
+    export.add_argument("output", nargs="?", default=RAG_ONNX_DIR)
+    export.add_argument("--cache-folder", default=None)
+    export.add_argument("--max-seq-length", type=int, default=256)
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    export_onnx(args.source, args.output, args.cache_folder, args.max_seq_length)
+    print(f"Exported {args.source} to {args.output} in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
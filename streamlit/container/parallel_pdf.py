@@ -0,0 +1,84 @@
+import os
+import math
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Iterator, List, Tuple
+
+# Processes extracting the pages of one PDF; 0 uses the pod's CPUs up to MAX_DEFAULT_WORKERS, 1 extracts in-process
+RAG_PDF_WORKERS = int(os.getenv("RAG_PDF_WORKERS", "0"))
+# Pages per task; 0 gives each worker about four ranges, so the first ones reach the splitter early
+RAG_PDF_PAGES_PER_TASK = int(os.getenv("RAG_PDF_PAGES_PER_TASK", "0"))
+
+# Every task opens the PDF again, so tasks are not made smaller than this
+MIN_PAGES_PER_TASK = 8
+RANGES_PER_WORKER = 4
+# Each worker is a full interpreter with pypdf loaded; on SMT8 nodes the affinity mask can hold dozens of CPUs
+MAX_DEFAULT_WORKERS = 8
+
+
+def page_count(path: str) -> int:
+    """Number of pages of a PDF."""
+    from pypdf import PdfReader
+    return len(PdfReader(path).pages)
+
+
+def extract_pages(path: str, start: int, end: int) -> List[Tuple[int, str]]:
+    """Text of pages start to end - 1 as PyPDFLoader extracts it; runs in a worker process."""
+    from pypdf import PdfReader
+    reader = PdfReader(path)
+    return [(number, reader.pages[number].extract_text()) for number in range(start, end)]
+
+
+def page_ranges(count: int, workers: int, pages_per_task: int = 0) -> List[Tuple[int, int]]:
+    """Consecutive (start, end) page ranges covering a document."""
+    if pages_per_task <= 0:
+        pages_per_task = max(MIN_PAGES_PER_TASK, math.ceil(count / (workers * RANGES_PER_WORKER)))
+    return [(start, min(start + pages_per_task, count)) for start in range(0, count, pages_per_task)]
+
+
+def iter_page_batches(path: str, document_class, workers: int = RAG_PDF_WORKERS,
+                      pages_per_task: int = RAG_PDF_PAGES_PER_TASK) -> Iterator[List[Any]]:
+    """
+    Pages of a PDF as documents, one page range at a time, in page order.
+
+    The ranges are extracted in parallel by a process pool; each is yielded
+    as soon as it and the ranges before it are done, so splitting can start
+    before the whole PDF is read. Documents carry the same metadata as
+    PyPDFLoader's (source path and 0-based page number).
+
+    Args:
+        path: PDF file
+        document_class: Class of the documents, e.g. langchain.schema.Document
+        workers: Worker processes; 0 for the available CPUs up to MAX_DEFAULT_WORKERS, 1 to extract in this process
+        pages_per_task: Pages per range; 0 to size ranges from the page and worker counts
+
+    Yields:
+        Lists of page documents
+    """
+    if not workers:
+        # Imported here so worker processes, which import this module, stay light
+        from onnx_embeddings import default_threads
+        workers = min(default_threads(), MAX_DEFAULT_WORKERS)
+    ranges = page_ranges(page_count(path), workers, pages_per_task)
+
+    def documents(pages: List[Tuple[int, str]]) -> List[Any]:
+        return [document_class(page_content=text, metadata={"source": path, "page": number})
+                for number, text in pages]
+
+    if workers <= 1 or len(ranges) <= 1:
+        for start, end in ranges:
+            yield documents(extract_pages(path, start, end))
+        return
+
+    # Spawned rather than forked: the app process runs threads (Streamlit, ONNX Runtime, torch)
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=min(workers, len(ranges)), mp_context=context) as pool:
+        futures = [pool.submit(extract_pages, path, start, end) for start, end in ranges]
+        for future in futures:
+            yield documents(future.result())
+
+
+def load_pdf(path: str, document_class, workers: int = RAG_PDF_WORKERS,
+             pages_per_task: int = RAG_PDF_PAGES_PER_TASK) -> List[Any]:
+    """All pages of a PDF as documents, like PyPDFLoader(path).load()."""
+    return [page for batch in iter_page_batches(path, document_class, workers, pages_per_task) for page in batch]
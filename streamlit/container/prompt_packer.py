@@ -0,0 +1,255 @@
+import os
+import time
+import httpx
+import asyncio
+import hashlib
+import numpy as np
+from collections import OrderedDict
+from typing import List, Dict, Any, Tuple, Callable, Optional
+
+# Over-retrieve this many chunks and let the packer choose
+RAG_FETCH_K = int(os.getenv("RAG_FETCH_K", "12"))
+# Context window of the llama-server slot and tokens reserved for the answer
+RAG_CONTEXT_TOKENS = int(os.getenv("RAG_CONTEXT_TOKENS", "4096"))
+RAG_ANSWER_TOKENS = int(os.getenv("RAG_ANSWER_TOKENS", "200"))
+# Upper bound for retrieved context, to keep prefill short even when more would fit
+RAG_CHUNK_TOKEN_BUDGET = int(os.getenv("RAG_CHUNK_TOKEN_BUDGET", "1500"))
+# Chunks less similar to the question than this are dropped
+RAG_MIN_SIMILARITY = float(os.getenv("RAG_MIN_SIMILARITY", "0.2"))
+# Chunks this similar to an already selected chunk are treated as duplicates
+RAG_DUPLICATE_SIMILARITY = float(os.getenv("RAG_DUPLICATE_SIMILARITY", "0.92"))
+# MMR trade-off between relevance (1.0) and diversity (0.0)
+RAG_MMR_LAMBDA = float(os.getenv("RAG_MMR_LAMBDA", "0.7"))
+
+# A truncated chunk shorter than this is not worth including
+MIN_PARTIAL_TOKENS = 48
+# Seconds to estimate token counts after /tokenize failed before trying it again
+TOKENIZER_RETRY_SECONDS = 30
+
+
+def mmr_order(query_vector: np.ndarray, vectors: np.ndarray, relevance: np.ndarray,
+              lambda_mult: float = RAG_MMR_LAMBDA,
+              duplicate_similarity: float = RAG_DUPLICATE_SIMILARITY) -> List[int]:
+    """
+    Order candidates by maximal marginal relevance and drop near-duplicates.
+
+    Args:
+        query_vector: Normalized question embedding
+        vectors: Normalized candidate embeddings, one row per candidate
+        relevance: Similarity of each candidate to the question
+        lambda_mult: Weight of relevance against redundancy
+        duplicate_similarity: Candidates at least this similar to a selected one are dropped
+
+    Returns:
+        Indices of the candidates in selection order
+    """
+    if len(vectors) == 0:
+        return []
+    pairwise = vectors @ vectors.T
+    remaining = list(range(len(vectors)))
+    selected = []
+    while remaining:
+        if selected:
+            redundancy = pairwise[np.ix_(remaining, selected)].max(axis=1)
+        else:
+            redundancy = np.zeros(len(remaining))
+        scores = lambda_mult * relevance[remaining] - (1 - lambda_mult) * redundancy
+        best = remaining[int(np.argmax(scores))]
+        remaining.remove(best)
+        if selected and pairwise[best, selected].max() >= duplicate_similarity:
+            continue
+        selected.append(best)
+    return selected
+
+
+class PromptPacker:
+    """
+    Choose and trim retrieved chunks to fit a token budget.
+
+    Over-retrieved chunks whose cosine similarity to the question is below a
+    cutoff are dropped, the rest are ordered by MMR without near-duplicates, and
+    chunks are added in retrieval order until the budget measured with
+    llama-server /tokenize is used up; the last chunk is cut to the remaining
+    tokens. Similarity comes from the chunk embeddings rather than the store's
+    score, so it means the same for any metric and for keyword-only hits.
+    The vector store's own vectors are used where the search returns them;
+    only the other chunks are embedded. Token counts and chunk embeddings are
+    cached, so repeated chunks cost nothing.
+    """
+
+    def __init__(self, llama_host: str, llama_port: str,
+                 context_tokens: int = RAG_CONTEXT_TOKENS,
+                 answer_tokens: int = RAG_ANSWER_TOKENS,
+                 chunk_token_budget: int = RAG_CHUNK_TOKEN_BUDGET,
+                 min_similarity: float = RAG_MIN_SIMILARITY,
+                 cache_size: int = 4096):
+        self.url = f"http://{llama_host}:{llama_port}"
+        self.context_tokens = context_tokens
+        self.answer_tokens = answer_tokens
+        self.chunk_token_budget = chunk_token_budget
+        self.min_similarity = min_similarity
+        self.cache_size = cache_size
+        self.token_cache = OrderedDict()
+        self.vector_cache = OrderedDict()
+        # /tokenize is skipped until this time after a failure
+        self.tokenizer_retry_at = 0.0
+
+    def _remember(self, cache: OrderedDict, key: str, value: Any):
+        """Insert into a bounded LRU cache."""
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > self.cache_size:
+            cache.popitem(last=False)
+
+    @staticmethod
+    def _key(text: str) -> str:
+        return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+    async def tokenize_async(self, client: httpx.AsyncClient, text: str) -> List[int]:
+        """Token ids of a text according to the model served by llama-server."""
+        response = await client.post(f"{self.url}/tokenize", json={"content": text})
+        response.raise_for_status()
+        return response.json()["tokens"]
+
+    async def count_tokens_async(self, texts: List[str]) -> List[int]:
+        """Token counts of several texts; falls back to an estimate if /tokenize is unavailable."""
+        counts = [None] * len(texts)
+        missing = []
+        for i, text in enumerate(texts):
+            key = self._key(text)
+            if key in self.token_cache:
+                self.token_cache.move_to_end(key)
+                counts[i] = self.token_cache[key]
+            else:
+                missing.append(i)
+
+        if missing and time.time() >= self.tokenizer_retry_at:
+            try:
+                async with httpx.AsyncClient(timeout=30) as client:
+                    tokens = await asyncio.gather(*(self.tokenize_async(client, texts[i]) for i in missing))
+                for i, ids in zip(missing, tokens):
+                    counts[i] = len(ids)
+                    self._remember(self.token_cache, self._key(texts[i]), len(ids))
+            except Exception as e:
+                print(f"llama-server /tokenize unavailable, estimating token counts "
+                      f"for {TOKENIZER_RETRY_SECONDS}s: {e}")
+                self.tokenizer_retry_at = time.time() + TOKENIZER_RETRY_SECONDS
+
+        # Rough estimate of four characters per token
+        return [count if count is not None else len(text) // 4 + 1 for count, text in zip(counts, texts)]
+
+    async def truncate_async(self, text: str, max_tokens: int) -> str:
+        """The longest prefix of a text that is at most max_tokens tokens."""
+        if time.time() >= self.tokenizer_retry_at:
+            try:
+                async with httpx.AsyncClient(timeout=30) as client:
+                    tokens = await self.tokenize_async(client, text)
+                    if len(tokens) <= max_tokens:
+                        return text
+                    response = await client.post(f"{self.url}/detokenize", json={"tokens": tokens[:max_tokens]})
+                    response.raise_for_status()
+                    return response.json()["content"]
+            except Exception as e:
+                print(f"llama-server /detokenize unavailable, truncating by characters: {e}")
+        return text[:max_tokens * 4]
+
+    def embed_chunks(self, embeddings, texts: List[str],
+                     stored: Optional[List[Optional[np.ndarray]]] = None) -> Tuple[np.ndarray, int]:
+        """
+        Normalized embeddings of chunk texts, cached by text.
+
+        Args:
+            embeddings: LangChain embeddings for chunks without a vector
+            texts: Chunk texts
+            stored: Vectors the store returned for the chunks, None where it had none
+
+        Returns:
+            Tuple of (one row per text, number of chunks embedded)
+        """
+        known = {text: vector for text, vector in zip(texts, stored or []) if vector is not None}
+        missing = [text for text in dict.fromkeys(texts)
+                   if text not in known and self._key(text) not in self.vector_cache]
+        if missing:
+            for text, vector in zip(missing, embeddings.embed_documents(missing)):
+                self._remember(self.vector_cache, self._key(text), np.asarray(vector, dtype=np.float32))
+        vectors = np.vstack([np.asarray(known[text], dtype=np.float32) if text in known
+                             else self.vector_cache[self._key(text)] for text in texts])
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.clip(norms, 1e-12, None), len(missing)
+
+    async def pack_async(self,
+                         question: str,
+                         docs_with_scores: List[Tuple[Any, float]],
+                         embeddings,
+                         build_prompt: Callable[[str, List[Tuple[Any, float]]], str],
+                         format_chunk: Callable[[Tuple[Any, float]], str],
+                         vectors: Optional[List[Optional[np.ndarray]]] = None
+                         ) -> Tuple[List[Tuple[Any, float]], Dict[str, Any]]:
+        """
+        Select the chunks for a question.
+
+        Args:
+            question: The user's question
+            docs_with_scores: Over-retrieved (document, score) pairs, best first
+            embeddings: LangChain embeddings used for MMR
+            build_prompt: Builds the full prompt from the question and chosen chunks
+            format_chunk: Renders one chunk as it appears in the prompt
+            vectors: Stored vectors of the chunks (HybridRetriever.chunk_vectors()), None where unknown
+
+        Returns:
+            Tuple of (chosen (document, score) pairs in retrieval order, report)
+        """
+        report = {"retrieved": len(docs_with_scores), "above_cutoff": 0, "after_dedup": 0,
+                  "embedded": 0, "packed": 0, "truncated": False, "context_tokens": 0, "prompt_tokens": 0}
+
+        if not docs_with_scores:
+            return [], report
+
+        query_vector = np.asarray(embeddings.embed_query(question), dtype=np.float32)
+        query_vector /= max(np.linalg.norm(query_vector), 1e-12)
+        texts = [doc.page_content for doc, _ in docs_with_scores]
+        vectors, report["embedded"] = self.embed_chunks(embeddings, texts, vectors)
+        relevance = vectors @ query_vector
+
+        relevant = [i for i in range(len(docs_with_scores)) if relevance[i] >= self.min_similarity]
+        report["above_cutoff"] = len(relevant)
+        if not relevant:
+            return [], report
+
+        # Remove near-duplicates, keeping the most relevant of each group
+        chosen = mmr_order(query_vector, vectors[relevant], relevance[relevant])
+        candidates = [docs_with_scores[relevant[i]] for i in sorted(chosen)]
+        report["after_dedup"] = len(candidates)
+
+        # Budget left for chunks once the instructions, question and answer are accounted for
+        overhead, *chunk_tokens = await self.count_tokens_async(
+            [build_prompt(question, [])] + [format_chunk(pair) for pair in candidates]
+        )
+        budget = min(self.chunk_token_budget, self.context_tokens - self.answer_tokens - overhead)
+
+        packed = []
+        used = 0
+        for pair, tokens in zip(candidates, chunk_tokens):
+            if used + tokens <= budget:
+                packed.append(pair)
+                used += tokens
+                continue
+            remaining = budget - used
+            if remaining >= MIN_PARTIAL_TOKENS:
+                doc, score = pair
+                # The chunk header takes a few tokens of its own
+                content = await self.truncate_async(doc.page_content, remaining - 24)
+                packed.append((type(doc)(page_content=content, metadata=doc.metadata), score))
+                report["truncated"] = True
+            break
+
+        # Verify the assembled prompt; token merges at chunk boundaries can shift the count slightly
+        prompt_tokens = (await self.count_tokens_async([build_prompt(question, packed)]))[0]
+        while packed and prompt_tokens > self.context_tokens - self.answer_tokens:
+            packed.pop()
+            prompt_tokens = (await self.count_tokens_async([build_prompt(question, packed)]))[0]
+
+        report["packed"] = len(packed)
+        report["context_tokens"] = prompt_tokens - overhead
+        report["prompt_tokens"] = prompt_tokens
+        return packed, report
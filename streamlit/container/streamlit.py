@@ -1,15 +1,30 @@
 import streamlit as st
 import requests
 import os
+import re
+import shutil
+import functools
 from pymilvus import connections, utility
-from langchain.embeddings import HuggingFaceEmbeddings
-from langchain.vectorstores import Milvus
-from langchain.document_loaders import PyPDFLoader
 from langchain.text_splitter import CharacterTextSplitter
+from langchain.schema import Document
 import httpx
 import json
 import asyncio
+import threading
+import time
 import urllib.parse
+from concurrent.futures import Future
+from prompt_packer import PromptPacker, RAG_FETCH_K
+from token_chunker import TokenChunker, chunking_report, RAG_SPLITTER
+from parallel_pdf import iter_page_batches
+from onnx_embeddings import load_embeddings, RAG_EMBEDDINGS, RAG_ONNX_DIR
+from hybrid_retriever import BM25Index, HybridRetriever, RAG_INDEX_DIR
+from local_vector_store import LocalVectorStore, RAG_VECTOR_STORE, RAG_LOCAL_INDEX_DIR, RAG_LOCAL_INDEX
+from vector_quantization import RAG_VECTOR_DTYPE
+from milvus_store import MilvusStore, index_config, alias_target, point_alias
+from index_artifact import (file_sha256, artifact_settings, artifact_version, find_artifact, load_artifact,
+                            artifact_differences, bulk_insert_files, RAG_ARTIFACT_DIR, RAG_ARTIFACT_REMOTE_PATH)
+from index_rollout import ServingIndex, IngestionJob, VersionFollower, read_current, write_current
 
 # Streamlit app title
 st.title("Retrieval Augmented Generation based on a given pdf")
@@ -19,21 +34,53 @@ MILVUS_HOST = "milvus-service"
 MILVUS_PORT = "19530"
 LLAMA_HOST = "llama-service"
 LLAMA_PORT = "8080"
+# Name shared by all index versions: the Milvus alias, and the prefix of versioned collections
+COLLECTION_ALIAS = "lighthouse"
 
-# Function to download and process PDFs
+# Function to load the embedding model, shared by the served index and ingestion
 @st.cache_resource
-def load_and_process_pdfs():
-    pdf_urls = [
-        os.getenv("PDF_URL")
-    ]
-    # Parse the URL
-    url_parts = urllib.parse.urlparse(os.getenv("PDF_URL"))
-    # Get the path
-    path_query = url_parts.path
-    # Split the path into path and filename
-    path_filename = os.path.split(path_query)
-    # Get the filename
-    pdf_names = [os.path.basename(path_filename[1])]
+def get_embeddings():
+    # Shared with the index_artifact CLI, so prebuilt artifacts match for either backend
+    return load_embeddings(RAG_EMBEDDINGS, "sentence-transformers/all-MiniLM-L6-v2", RAG_ONNX_DIR)
+
+# Function to locate the keyword index of an index version
+def lexical_index_path(name):
+    return os.path.join(RAG_INDEX_DIR, f"{name}.bm25.json")
+
+# Function to list the PDFs to ingest; PDF_URL holds one URL, or several separated by spaces or commas
+def get_pdfs():
+    pdf_urls = [url for url in re.split(r"[\s,]+", os.getenv("PDF_URL", "")) if url]
+    # Get the filename of each URL's path
+    pdf_names = [os.path.basename(urllib.parse.urlparse(url).path) for url in pdf_urls]
+    return pdf_urls, pdf_names
+
+# Function to create the text splitter; the token chunker sizes chunks with the embedding model's own tokenizer
+def get_text_splitter(embeddings):
+    if RAG_SPLITTER == "tokens":
+        return TokenChunker.from_embeddings(embeddings)
+    return CharacterTextSplitter(separator="\n", chunk_size=768, chunk_overlap=0)
+
+# Function to download a PDF to /tmp, whose path becomes the source of its chunks
+def download_pdf(url, name, progress):
+    output_path = os.path.join("/tmp/", name)
+    if not os.path.exists(name):
+        progress(f"Downloading {name}...")
+        res = requests.get(url)
+        with open(output_path, 'wb') as file:
+            file.write(res.content)
+    return output_path
+
+# Function to split a PDF into chunks; page ranges are extracted by a process pool and split as they arrive
+def split_pdf(output_path, name, text_splitter, progress):
+    chunks = []
+    for docs in iter_page_batches(output_path, Document):
+        chunks.extend(text_splitter.split_documents(docs))
+        progress(f"Processing {name}: {docs[-1].metadata['page'] + 1} pages, {len(chunks)} chunks...")
+    return chunks
+
+# Function to download and process PDFs into a new index version, unless current already holds them
+def load_and_process_pdfs(embeddings, progress, current=None):
+    pdf_urls, pdf_names = get_pdfs()
 #def load_and_process_pdfs():
 #    pdf_urls = [
         #"https://www.redbooks.ibm.com/redbooks/pdfs/sg248513.pdf",
@@ -43,52 +90,210 @@ def load_and_process_pdfs():
     #pdf_names = ["The_Forgotten_Lighthouse_Book.pdf"]
     #pdf_names = ["IBM_Redbook_8513.pdf", "IBM_Redbook_8512.pdf"]
     
-    all_docs = []
-    
+    text_splitter = get_text_splitter(embeddings)
+
+    # Download first: the PDF hashes decide whether the index is up to date or a prebuilt one can be used
+    pdf_paths = []
+    sources = {}
     for url, name in zip(pdf_urls, pdf_names):
-        if not os.path.exists(name):
-            output_path = os.path.join("/tmp/", name)
-            st.write(f"Downloading {name}...")
-            res = requests.get(url)
-            with open(output_path, 'wb') as file:
-                file.write(res.content)
+        output_path = download_pdf(url, name, progress)
+        pdf_paths.append(output_path)
+        sources[name] = file_sha256(output_path)
+    
+    # Versions are named after everything that goes into them, so unchanged PDFs are not re-ingested
+    settings = artifact_settings(embeddings, text_splitter)
+    if RAG_VECTOR_STORE == "local":
+        config = {"store": "local", "kind": RAG_LOCAL_INDEX, "vector_dtype": RAG_VECTOR_DTYPE}
+    else:
+        config = index_config()
+    index_name = f"{COLLECTION_ALIAS}_{artifact_version(sources, {**settings, 'store': config})}"
+    # Pod-local files are lost on restart; the version is only up to date once they are rebuilt
+    if index_name == current and not missing_side_files(index_name):
+        return None
+    # Staged builds only get their name once complete, so a collection found under it was built by
+    # another pod (or before a restart) and is reused
+    if index_name == current or (RAG_VECTOR_STORE != "local" and utility.has_collection(index_name)):
+        progress(f"Opening index {index_name}...")
+        retriever = open_complete_index(index_name, embeddings, progress)
+        if retriever is not None:
+            progress("Processing complete!")
+            return index_name, retriever
+    progress(f"Building index {index_name}...")
+    
+    all_docs = []
+    vectors = None
+    artifact = find_artifact(RAG_ARTIFACT_DIR, sources, settings)
+    if artifact:
+        # Chunks and embeddings built offline for exactly these PDFs
+        progress(f"Loading prebuilt index {os.path.basename(artifact)}...")
+        all_docs, vectors, _ = load_artifact(artifact, Document)
+    else:
+        # Artifacts built for other PDFs or settings (e.g. the other embedding backend) are ignored
+        for version, differing in artifact_differences(RAG_ARTIFACT_DIR, sources, settings).items():
+            print(f"Prebuilt index {version} in {RAG_ARTIFACT_DIR} does not match: {', '.join(differing)} differ")
+        for name, output_path in zip(pdf_names, pdf_paths):
+            progress(f"Processing {name}...")
+            split_docs = split_pdf(output_path, name, text_splitter, progress)
+            all_docs.extend(split_docs)
         
-        st.write(f"Processing {name}...")
-        loader = PyPDFLoader(output_path)
-        docs = loader.load()
-        text_splitter = CharacterTextSplitter(separator="\n", chunk_size=768, chunk_overlap=0)
-        split_docs = text_splitter.split_documents(docs)
-        all_docs.extend(split_docs)
+        report = chunking_report(embeddings.client.tokenizer, all_docs, embeddings.client.max_seq_length)
+        progress(f"{report['chunks']} chunks, {report['mean_tokens']:.0f} tokens on average, "
+                 f"{report['truncated']:.0%} longer than the embedding model reads")
     
-    st.write("Embedding documents...")
-    embeddings = HuggingFaceEmbeddings(model_name="all-MiniLM-L6-v2")
+    if RAG_VECTOR_STORE == "local":
+        # Searched in-process, memory-mapped from the index volume; reused across restarts
+        progress("Creating in-process index...")
+        started = time.perf_counter()
+        vector_store = LocalVectorStore.load_or_build(all_docs, embeddings, os.path.join(RAG_LOCAL_INDEX_DIR, index_name),
+                                                      vectors=vectors)
+    else:
+        # A new collection next to the one being served; index type, metric, query parameters
+        # and replicas come from MILVUS_* settings
+        progress(f"Creating vector store ({config['index_type']}, {config['metric']}, "
+                 f"{config['vector_dtype']} vectors, {config['replicas']} replica(s))...")
+        started = time.perf_counter()
+        if artifact and RAG_ARTIFACT_REMOTE_PATH:
+            # Milvus reads the artifact from its own bucket
+            vector_store = MilvusStore.bulk_import(bulk_insert_files(RAG_ARTIFACT_REMOTE_PATH), vectors,
+                                                   embeddings, index_name, config, drop_old=False, staged=True)
+        elif artifact:
+            vector_store = MilvusStore.create_from_vectors(all_docs, vectors, embeddings, index_name, config,
+                                                           drop_old=False, staged=True)
+        else:
+            vector_store = MilvusStore.create(all_docs, embeddings, index_name, config, drop_old=False, staged=True)
     
-    st.write("Connecting to Milvus...")
-    connections.connect(host=MILVUS_HOST, port=MILVUS_PORT)
-    colls = utility.list_collections()
-    for coll in colls:
-        utility.drop_collection(coll)
+    progress(f"Vector store ready in {time.perf_counter() - started:.1f}s")
     
-    st.write("Creating vector store...")
-    vector_store = Milvus.from_documents(
-        all_docs,
-        embedding=embeddings,
-        collection_name="lighthouse",
-        connection_args={"host": MILVUS_HOST, "port": MILVUS_PORT}
-    )
+    progress("Building keyword index...")
+    lexical_index = BM25Index.load_or_build(lexical_index_path(index_name), all_docs)
     
-    st.write("Processing complete!")
-    return vector_store
+    progress("Processing complete!")
+    return index_name, HybridRetriever(vector_store, lexical_index, lexical_path=lexical_index_path(index_name))
+
+# Function to open an index version built earlier, e.g. before a restart
+def open_index(name, embeddings):
+    try:
+        if RAG_VECTOR_STORE == "local":
+            vector_store = LocalVectorStore.load(os.path.join(RAG_LOCAL_INDEX_DIR, name), embeddings, Document)
+        else:
+            vector_store = MilvusStore.open(embeddings, name)
+            if vector_store.dimension != len(embeddings.embed_query("dimension")):
+                print(f"Index {name} was built with another embedding model")
+                return None
+    except Exception as e:
+        print(f"Cannot open index {name}: {e}")
+        return None
+    # Without its keyword index (/tmp is emptied on restart) the version is searched by similarity
+    # only, until ingestion restores it
+    path = lexical_index_path(name)
+    lexical_index = BM25Index.load(path, Document) if os.path.exists(path) else None
+    return HybridRetriever(vector_store, lexical_index, lexical_path=path)
+
+# Function to list the files of an index version kept on this pod's storage that are missing
+def missing_side_files(name):
+    missing = [] if os.path.exists(lexical_index_path(name)) else ["keyword index"]
+    if RAG_VECTOR_STORE != "local" and MilvusStore.rerank_file_missing(name):
+        missing.append("rerank vectors")
+    return missing
+
+# Function to rebuild the keyword index and the rerank vectors of an index version from its vector store
+def restore_side_files(retriever, name, progress):
+    if RAG_VECTOR_STORE != "local" and MilvusStore.rerank_file_missing(name):
+        progress(f"Restoring the rerank vectors of {name}...")
+        retriever.vector_store.restore_rerank_vectors()
+    if retriever.lexical_index is None:
+        progress(f"Rebuilding the keyword index of {name}...")
+        retriever.lexical_index = BM25Index.load_or_build(lexical_index_path(name), retriever.vector_store.chunks())
+
+# Function to open an index version with the files this pod keeps for it, rebuilding missing ones
+def open_complete_index(name, embeddings, progress):
+    retriever = open_index(name, embeddings)
+    if retriever is not None:
+        restore_side_files(retriever, name, progress)
+    return retriever
+
+# Function to re-ingest one PDF in place, leaving the other documents of the index untouched
+def reload_document(retriever, source):
+    pdf_urls, pdf_names = get_pdfs()
+    name = os.path.basename(source)
+    output_path = download_pdf(dict(zip(pdf_names, pdf_urls))[name], name, print)
+    chunks = split_pdf(output_path, name, get_text_splitter(get_embeddings()), print)
+    retriever.replace_document(source, chunks)
+
+# Function to make an index version the one opened at startup
+def activate_index(name):
+    if RAG_VECTOR_STORE == "local":
+        write_current(RAG_LOCAL_INDEX_DIR, name)
+    else:
+        point_alias(COLLECTION_ALIAS, name)
+
+# Function to find the index version activated last, by this pod or another one
+def active_index():
+    if RAG_VECTOR_STORE == "local":
+        return read_current(RAG_LOCAL_INDEX_DIR)
+    return alias_target(COLLECTION_ALIAS)
+
+# Function to drop an index version that is no longer served
+def retire_index(name):
+    if RAG_VECTOR_STORE == "local":
+        shutil.rmtree(os.path.join(RAG_LOCAL_INDEX_DIR, name), ignore_errors=True)
+    else:
+        MilvusStore.drop(name)
+    if os.path.exists(lexical_index_path(name)):
+        os.remove(lexical_index_path(name))
+
+# The index answering questions, shared by all sessions; starts with the version activated last
+@st.cache_resource
+def get_serving_index():
+    serving = ServingIndex()
+    if RAG_VECTOR_STORE != "local":
+        connections.connect(host=MILVUS_HOST, port=MILVUS_PORT)
+    current = active_index()
+    if current:
+        retriever = open_index(current, get_embeddings())
+        if retriever:
+            serving.publish(current, retriever)
+    return serving
+
+# Switches to versions activated by other pods, so the pod retiring the previous one does not pull it away
+@st.cache_resource
+def get_version_follower():
+    open_version = functools.partial(open_complete_index, embeddings=get_embeddings(), progress=print)
+    return VersionFollower(get_serving_index(), active_index, open_version).start()
+
+# Background ingestion, shared by all sessions
+@st.cache_resource
+def get_ingestion():
+    return {"lock": threading.Lock(), "job": None}
+
+# Function to (re-)ingest the PDFs in the background unless that is already running
+def start_ingestion():
+    ingestion = get_ingestion()
+    with ingestion["lock"]:
+        if ingestion["job"] is None or not ingestion["job"].running:
+            build = functools.partial(load_and_process_pdfs, get_embeddings())
+            ingestion["job"] = IngestionJob(get_serving_index(), build, activate_index, retire_index,
+                                            active=active_index).start()
+    return ingestion["job"]
+
+# Function to render one search result as it appears in the prompt
+def format_chunk(chunk):
+    return f"[Document: {chunk[0].metadata.get('source', 'Unknown')}, Page: {chunk[0].metadata.get('page', 'Unknown')}]: " + chunk[0].page_content.replace("\n", " ") + "\n\n"
 
 # Function to build prompt
 def build_prompt(question, topn_chunks: list[str]):
     prompt = "Instructions: Compose a concise answer to the query using the provided search results, no need to mention you found it in the resuts\n\n"
     prompt += "Search results:\n"
     for chunk in topn_chunks:
-        prompt += f"[Document: {chunk[0].metadata.get('source', 'Unknown')}, Page: {chunk[0].metadata.get('page', 'Unknown')}]: " + chunk[0].page_content.replace("\n", " ") + "\n\n"
+        prompt += format_chunk(chunk)
     prompt += f"Query: {question}\n\nAnswer: "
     return prompt
 
+# Chooses the search results that fit the context window, shared by all sessions
+@st.cache_resource
+def get_prompt_packer():
+    return PromptPacker(LLAMA_HOST, LLAMA_PORT)
+
 # Asynchronous function to get LLAMA response
 async def get_llama_response(prompt):
     json_data = {
@@ -109,23 +314,116 @@ async def get_llama_response(prompt):
                     pass
     return full_response
 
-# Load and process PDFs
-with st.spinner("Loading and processing PDFs... This may take a few minutes."):
-    vector_store = load_and_process_pdfs()
+# Answers being generated right now, shared by all sessions
+@st.cache_resource
+def get_inflight_answers():
+    return {"lock": threading.Lock(), "futures": {}, "requests": 0, "coalesced": 0}
+
+# Identical prompts submitted at the same time share one generation
+def get_coalesced_llama_response(prompt):
+    inflight = get_inflight_answers()
+    with inflight["lock"]:
+        inflight["requests"] += 1
+        future = inflight["futures"].get(prompt)
+        leader = future is None
+        if leader:
+            future = Future()
+            inflight["futures"][prompt] = future
+        else:
+            inflight["coalesced"] += 1
+
+    if leader:
+        try:
+            future.set_result(asyncio.run(get_llama_response(prompt)))
+        except Exception as e:
+            future.set_exception(e)
+        finally:
+            with inflight["lock"]:
+                del inflight["futures"][prompt]
+    return future.result()
+
+# Open the index built last, then check for new PDFs in the background
+with st.spinner("Loading embedding model and index..."):
+    serving = get_serving_index()
+    get_version_follower()
+job = get_ingestion()["job"]
+# Without anything to serve, a failed ingestion is retried by the next page load
+if job is None or (not serving.ready and not job.running):
+    job = start_ingestion()
+
+# Re-ingesting keeps answering from the current index until the new one replaces it; drawn
+# before the first ingestion finishes, so a failed one can be retried from this page too
+if st.sidebar.button("Re-ingest PDFs", disabled=job.running):
+    job = start_ingestion()
+
+# Nothing can be searched until the first ingestion finishes
+if not serving.ready:
+    with st.spinner("Loading and processing PDFs... This may take a few minutes."):
+        step = st.empty()
+        while job.running and not serving.ready:
+            step.write(job.step)
+            time.sleep(0.5)
+        step.empty()
+    if not serving.ready:
+        st.error(f"Could not build the index: {job.error}. Reload the page or use \"Re-ingest PDFs\" to try again.")
+        st.stop()
+
+if job.running:
+    st.info(f"Re-ingesting in the background ({job.step}); answers come from {serving.version} until it is done.")
+with st.sidebar.expander("Index"):
+    st.json({**job.status(), "searches_in_flight": serving.inflight()})
+
+# Remove or reload single documents of the Milvus collection, each in its own partition
+if RAG_VECTOR_STORE != "local":
+    with st.sidebar.expander("Documents"):
+        pdf_urls, pdf_names = get_pdfs()
+        configured = [os.path.join("/tmp/", name) for name in pdf_names]
+        document = st.selectbox("Document", sorted(set(serving.retriever.documents()) | set(configured)),
+                                format_func=os.path.basename)
+        reload_clicked = st.button("Reload", disabled=job.running or document not in configured,
+                                   help="Download, split and embed this PDF again")
+        remove_clicked = st.button("Remove", disabled=job.running or document is None)
+        if reload_clicked:
+            with st.spinner(f"Reloading {os.path.basename(document)}..."):
+                reload_document(serving.retriever, document)
+        if remove_clicked:
+            serving.retriever.remove_document(document)
+
+# Restrict questions to some documents; Milvus then searches only their partitions
+documents = serving.retriever.documents()
+selected_documents = st.sidebar.multiselect("Search in documents", documents, format_func=os.path.basename,
+                                            help="All documents when none is selected")
 
 # User input
 question = st.text_input("Enter your question about the pdf you picked:")
 
 if question:
-    # Perform similarity search
-    docs = vector_store.similarity_search_with_score(question, k=3)
+    # Perform keyword and similarity search, fetching more results than fit so the packer can choose
+    with serving.acquire() as (index_version, retriever):
+        docs, hits = retriever.search(question, k=RAG_FETCH_K, sources=selected_documents or None)
+        # Vectors the store already holds, so the packer only embeds the chunks it has none for
+        vectors = retriever.chunk_vectors([doc for doc, _ in docs])
+    
+    # Keep relevant, non-redundant results within the token budget
+    packed, packing = asyncio.run(get_prompt_packer().pack_async(
+        question, docs, get_embeddings(), build_prompt, format_chunk, vectors))
+    if not packed:
+        st.warning("No passage of the pdf looks relevant to this question; the answer is not grounded in it.")
     
     # Build prompt
-    prompt = build_prompt(question, docs)
+    prompt = build_prompt(question, packed)
     
     # Get LLAMA response
     with st.spinner("Generating answer..."):
-        answer = asyncio.run(get_llama_response(prompt))
+        answer = get_coalesced_llama_response(prompt)
     
     # Display answer
     st.write("Answer:", answer)
+    inflight = get_inflight_answers()
+    searched = f"{len(selected_documents)} of {len(documents)}" if selected_documents else f"all {len(documents)}"
+    st.caption(f"Search in {index_version} ({searched} documents): {hits['dense']} similarity and {hits['lexical']} keyword results, {hits['fused']} after fusion")
+    st.caption(f"Context: {packing['packed']} of {packing['retrieved']} search results "
+               f"({packing['above_cutoff']} relevant, {packing['after_dedup']} after removing near-duplicates, "
+               f"{packing['embedded']} embedded again), "
+               f"{packing['prompt_tokens']} prompt tokens")
+    st.caption(f"LLM requests: {inflight['requests']}, answered by a shared generation: {inflight['coalesced']}")